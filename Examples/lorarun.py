@@ -1,7 +1,7 @@
 import time
 from LightLora import lorautil
 
-isSendSynchro = False # is send synchronous?
+isSendSynchro = True # sendPacket queues and the radio paces the sends, no need to wait
 
 lr = lorautil.LoraUtil()	# the LoraUtil object
 
@@ -14,7 +14,8 @@ lr = lorautil.LoraUtil()	# the LoraUtil object
 
 def syncSend(lutil, txt) :
 	''' send a packet synchronously '''
-	lutil.sendPacket(0xff, 0x41, txt.encode())
+	if not lutil.sendPacket(0xff, 0x41, txt.encode()):
+		print("send queue full")
 	if(isSendSynchro) :
 		return # we're done here if sendpacket is synchronouse
 	sendTime = 0
@@ -45,6 +46,8 @@ def doreader():
 				ctr = ctr + 1
 			except Exception as ex:
 				print(str(ex))
+			if packet:
+				packet.release() # hand it back to the pool
 		if time.time() > endt:
 			txt = 'P Lora' + str(ctr)
 			syncSend(lr, txt)
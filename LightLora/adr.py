@@ -0,0 +1,155 @@
+''' adaptive data rate: transmit settings per peer from the snr of its packets.
+
+Every packet from a peer arrives with an snr measured at our listen settings.
+Its margin is how far that is above the demodulation floor of our spreading
+factor. With the worst of the recent snrs, assuming the link is about the same
+both ways and the peer sent at our listen power, the adapter picks for the peer:
+the fastest spreading factor and bandwidth that keeps marginDb of margin, coding
+rate 4/5 if there's CR_MARGIN to spare, and whatever transmit power the rest of
+the margin allows it to drop. Everything is in integer quarter dB so updates are
+cheap enough to run for every packet received.
+
+	adapter = adr.LinkAdapter(lru.lora, marginDb=5)
+	lru.setAdaptive(adapter)
+
+LoraUtil applies the profile for each frame's destination just before sending it
+and goes back to the listen settings to receive. The shadowed registers make an
+unchanged setting free. Coding rate and power don't need the receiver's help (the
+coding rate is in the explicit header). Spreading factor and bandwidth do, the
+peer has to be listening at what we send with, so they only change with
+adaptRate=True, for peers known to listen at the chosen rate. A reliable.ReliableLink
+calls noteLoss when an ack doesn't come, which drops the peer back to the listen
+profile until its packets come in again.
+'''
+import math
+
+BROADCAST = 0xff
+
+# lowest snr each spreading factor demodulates at, quarter dB, indexed by sf
+SNR_FLOOR = (0, 0, 0, 0, 0, 0, -20, -30, -40, -50, -60, -70, -80)
+
+CR_MARGIN = 12		# quarter dB of spare margin before dropping to coding rate 4/5
+
+class Profile:
+	''' the settings used to send to one peer '''
+	__slots__ = ('spreading', 'bandwidth', 'codingRate', 'power')
+
+	def __init__(self, spreading=9, bandwidth=125000, codingRate=8, power=17):
+		self.spreading = spreading
+		self.bandwidth = bandwidth
+		self.codingRate = codingRate	# denominator of 4/x
+		self.power = power				# dBm
+
+class LinkAdapter:
+	''' per peer transmit profiles for an sx127x. The listen profile is its current
+		settings. peers is the table size (the least recently heard is replaced),
+		window the snr samples kept per peer, minSamples how many are needed before
+		the peer gets its own profile. spreadingFactors and bandwidths are the rates
+		allowed with adaptRate. Power stays within minPower..maxPower dBm, maxPower
+		defaults to the current power. '''
+	def __init__(self, sx12, peers=8, window=8, marginDb=5, minSamples=3, adaptRate=False,
+				 spreadingFactors=(7, 8, 9, 10, 11, 12), bandwidths=None, minPower=2, maxPower=None):
+		self.listen = Profile(sx12.spreading, sx12.bandwidth, sx12.codingRate,
+							  sx12.txPower if maxPower is None else maxPower)
+		self.marginQ = int(marginDb * 4)
+		self.minSamples = minSamples
+		self.minPower = minPower
+		self.window = window
+		# the rates to try, fastest (shortest symbol) first, with the snr lost to extra bandwidth
+		rates = [(sf, bw) for sf in spreadingFactors for bw in (bandwidths or (self.listen.bandwidth,))] \
+				if adaptRate else [(self.listen.spreading, self.listen.bandwidth)]
+		rates.sort(key=lambda rate: (1 << rate[0]) / rate[1])
+		self._rateSf = bytearray(rate[0] for rate in rates)
+		self._rateBw = [rate[1] for rate in rates]
+		self._ratePenalty = [int(round(40 * math.log10(rate[1] / self.listen.bandwidth))) for rate in rates]
+		# the table
+		self.addresses = bytearray(peers)
+		self.used = 0
+		self.samples = bytearray(peers * window)	# raw snr register values
+		self.count = bytearray(peers)				# samples in the window
+		self.next = bytearray(peers)				# where the next sample goes
+		self.lastHeard = [0] * peers
+		self.dirty = bytearray(peers)
+		self.profiles = [Profile() for i in range(peers)]
+		self._clock = 0
+
+	def _find(self, address):
+		for i in range(self.used):
+			if self.addresses[i] == address:
+				return i
+		return -1
+
+	def update(self, address, snrRaw):
+		''' add the snr register value of a packet from address '''
+		i = self._find(address)
+		if i < 0:
+			if self.used < len(self.addresses):
+				i = self.used
+				self.used = self.used + 1
+			else:
+				i = self.lastHeard.index(min(self.lastHeard)) # replace the quietest peer
+			self.addresses[i] = address
+			self.count[i] = 0
+			self.next[i] = 0
+		self._clock = self._clock + 1
+		self.lastHeard[i] = self._clock
+		self.samples[i * self.window + self.next[i]] = snrRaw
+		self.next[i] = (self.next[i] + 1) % self.window
+		if self.count[i] < self.window:
+			self.count[i] = self.count[i] + 1
+		self.dirty[i] = 1
+
+	def noteLoss(self, address):
+		''' a send to address went unanswered, go back to the listen profile until
+			fresh samples come in '''
+		i = self._find(address)
+		if i >= 0:
+			self.count[i] = 0
+			self.next[i] = 0
+
+	def worstSnr(self, address):
+		''' the lowest recent snr from address in quarter dB, None if not enough samples '''
+		i = self._find(address)
+		if i < 0 or self.count[i] < self.minSamples:
+			return None
+		worst = 127
+		base = i * self.window
+		for k in range(self.count[i]):
+			snr = self.samples[base + k]
+			if snr > 127:
+				snr = snr - 256
+			if snr < worst:
+				worst = snr
+		return worst
+
+	def _choose(self, i, snr):
+		profile = self.profiles[i]
+		listen = self.listen
+		headroom = 0
+		rate = len(self._rateSf) - 1	# the most robust if none have the margin
+		for k in range(len(self._rateSf)):
+			headroom = snr - self._ratePenalty[k] - SNR_FLOOR[self._rateSf[k]] - self.marginQ
+			if headroom >= 0:
+				rate = k
+				break
+		profile.spreading = self._rateSf[rate]
+		profile.bandwidth = self._rateBw[rate]
+		profile.codingRate = listen.codingRate
+		if headroom >= CR_MARGIN:
+			profile.codingRate = 5
+			headroom = headroom - CR_MARGIN
+		profile.power = listen.power
+		if headroom > 0:
+			profile.power = max(listen.power - (headroom >> 2), self.minPower)
+
+	def profileFor(self, address):
+		''' the Profile to send to address with (don't change it) '''
+		if address == BROADCAST:
+			return self.listen
+		i = self._find(address)
+		if i < 0 or self.count[i] < self.minSamples:
+			return self.listen
+		if self.dirty[i]:
+			self._choose(i, self.worstSnr(address))
+			self.dirty[i] = 0
+		return self.profiles[i]
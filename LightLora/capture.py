@@ -0,0 +1,118 @@
+''' packet capture: every frame received and sent, appended to a compact binary log.
+
+	cap = capture.Capture('/lora.cap')
+	lru.setCapture(cap)
+	...
+	lru.service()		# in the main loop, writes whole blocks to the file
+	cap.close()			# writes what's left
+
+The file starts with MAGIC and VERSION, then a record per frame:
+	flags, length, ms (4 bytes), rssi, snr, frf (3 bytes), sf | bandwidth << 4, frame...
+ms is the time since the record before (little endian), flags has TX for a sent
+frame and START on the first record after opening. rssi and snr are the raw
+register values (0 for sent frames), frf the frequency register bytes (0 if
+the driver didn't know them, like right after a reset) and bandwidth the
+register index. Frames are only copied into a RAM ring, the file
+gets whole blocks from service() so flash is never written from an interrupt.
+The ring lines up with the file blocks, so after a close leaves a part block
+the next session's first write just fills it and the rest stay aligned.
+Tools/capturetool.py reads, summarizes and replays captures.
+'''
+from LightLora import lorastats
+
+MAGIC = b'LLCP'
+VERSION = 1
+RECORD_HEADER = 12
+
+TX = 0x01		# record flags
+START = 0x02
+
+class Capture:
+	''' appends to the capture file at path. The RAM ring is blocks * blockSize bytes,
+		blockSize is the size of each file write (a multiple of the filesystem
+		block). Records that don't fit while the ring waits for service() are
+		dropped and counted. '''
+	def __init__(self, path, blockSize=512, blocks=4, ticksMs=None):
+		self.blockSize = blockSize
+		self.size = blockSize * blocks
+		self.ticksMs = ticksMs or lorastats.ticks_ms
+		self.records = 0
+		self.dropped = 0
+		self._ring = bytearray(self.size)
+		self._file = open(path, 'ab')
+		offset = self._file.tell()
+		self._head = offset % blockSize	# where the interrupts add, only they move it
+		self._tail = self._head			# where service writes from, only it moves it
+		self._header = bytearray(RECORD_HEADER)
+		self._last = 0			# time of the last record
+		self._flags = START
+		if offset == 0:
+			self._put(MAGIC, len(MAGIC))
+			self._header[0] = VERSION
+			self._put(self._header, 1)
+
+	def _used(self):
+		return (self._head - self._tail) % self.size
+
+	# copy into the ring, in two pieces if it wraps
+	def _put(self, data, length):
+		ring = self._ring
+		head = self._head
+		first = min(length, self.size - head)
+		ring[head:head + first] = memoryview(data)[:first]
+		if first < length:
+			ring[0:length - first] = memoryview(data)[first:length]
+		self._head = (head + length) % self.size
+
+	def add(self, flags, frame, length, rssiRaw, snrRaw, sx12):
+		''' record length bytes of frame, with the radio settings of sx12. Cheap
+			enough for the (soft) transmit interrupt, it doesn't touch the file '''
+		if RECORD_HEADER + length > self.size - 1 - self._used():
+			self.dropped = self.dropped + 1
+			return
+		now = self.ticksMs()
+		ms = 0 if self._flags & START else max(lorastats.ticks_diff(now, self._last), 0)
+		self._last = now
+		header = self._header
+		header[0] = flags | self._flags
+		header[1] = length
+		header[2] = ms & 0xff
+		header[3] = (ms >> 8) & 0xff
+		header[4] = (ms >> 16) & 0xff
+		header[5] = (ms >> 24) & 0xff
+		header[6] = rssiRaw
+		header[7] = snrRaw
+		frf = sx12._frf
+		if frf:
+			header[8] = frf[0]
+			header[9] = frf[1]
+			header[10] = frf[2]
+		else:
+			header[8] = header[9] = header[10] = 0	# unknown, not the last record's
+		header[11] = sx12.spreading | (sx12._bwIndex << 4)
+		self._put(header, RECORD_HEADER)
+		self._put(frame, length)
+		self._flags = 0
+		self.records = self.records + 1
+
+	def service(self):
+		''' write the full blocks to the file. LoraUtil.service calls this '''
+		while True:
+			tail = self._tail
+			count = self.blockSize - tail % self.blockSize	# to the end of the file block
+			if self._used() < count:
+				return
+			self._file.write(memoryview(self._ring)[tail:tail + count])
+			self._tail = (tail + count) % self.size
+
+	def close(self):
+		''' write everything left and close the file '''
+		self.service()
+		used = self._used()
+		tail = self._tail
+		first = min(used, self.size - tail)
+		self._file.write(memoryview(self._ring)[tail:tail + first])
+		if first < used:
+			self._file.write(memoryview(self._ring)[0:used - first])
+		self._tail = self._head
+		self._file.close()
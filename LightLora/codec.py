@@ -0,0 +1,183 @@
+''' compact binary payloads for telemetry.
+
+A record is a fixed list of numbers. Each one is scaled to an integer (fixed
+point, a scale of 100 keeps two decimals), optionally taken relative to the same
+field of the previous record, zigzag encoded so small negative numbers stay
+small, and written as a varint: 7 bits a byte, the high bit set if more follow.
+Slowly changing readings come out at about a byte a field instead of the
+handful a text version takes.
+
+	rc = codec.RecordCodec((100, 10, 1))	# temperature, humidity, a count
+	lru.setCodec(rc)
+	lru.sendRecord(0x42, 0x41, (21.37, 55.2, 1042))
+	...
+	values = lru.readRecord(pkt)			# [21.37, 55.2, 1042] or None
+
+The payload is KIND_RECORD or KIND_DELTA, a sequence number, then the varints.
+A delta record only decodes right after the one before it from the same
+source, so every keyEvery-th record is sent whole and a receiver that missed
+one catches up there. Each destination gets its own stream (last record,
+sequence and key count) on both ends, so a node sending to several addresses
+doesn't break the deltas for any of them. A record repeating the sequence
+number last decoded (a resend) is ignored. Anything with encode(values, out,
+dst), decode(src, payload, out, dst), restart(dst) and size can be used as a
+LoraUtil codec.
+'''
+
+KIND_RECORD = 0x04	# first payload byte, next to the reliable and fragment kinds
+KIND_DELTA = 0x05
+
+def zigzag(value):
+	''' map signed to unsigned so small magnitudes stay small: 0, -1, 1, -2 -> 0, 1, 2, 3 '''
+	return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+def unzigzag(value):
+	return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+def putVarint(buf, at, value):
+	''' write unsigned value at buf[at], returns the index after it '''
+	while value > 0x7f:
+		buf[at] = (value & 0x7f) | 0x80
+		value = value >> 7
+		at = at + 1
+	buf[at] = value
+	return at + 1
+
+class RecordCodec:
+	''' encodes records of len(scales) numbers. A field is sent as round(value * scale)
+		and decoded as an int if its scale is 1, else a float. keyEvery is how often a
+		whole record is sent (1 sends them all whole). destinations is how many
+		addresses the send side keeps a stream for, sources how many sender and
+		destination pairs the receive side does. When full the quietest is replaced
+		and starts over with a whole record. '''
+	def __init__(self, scales, keyEvery=8, sources=8, destinations=4):
+		self.scales = scales
+		self.size = len(scales)
+		self.keyEvery = max(keyEvery, 1)
+		self.maxLength = 2 + 10 * self.size		# a varint is at most 10 bytes for 64 bit values
+		# send side, the last record sent to each destination, scaled
+		self._dstAddress = bytearray(destinations)
+		self._dstSeq = bytearray(destinations)
+		self._dstSinceKey = [0] * destinations
+		self._dstLast = [[0] * self.size for i in range(destinations)]
+		self._dstUsed = [0] * destinations
+		self._dstCount = 0
+		# receive side, the last record from each source to each destination
+		self._srcAddress = bytearray(sources)
+		self._srcDst = bytearray(sources)
+		self._srcSeq = bytearray(sources)
+		self._srcValid = bytearray(sources)
+		self._srcLast = [[0] * self.size for i in range(sources)]
+		self._srcUsed = [0] * sources
+		self._used = 0
+		self._clock = 0
+		self._at = 0
+		self.outOfSync = 0		# delta records that came without the one before
+		self.badRecords = 0		# truncated records
+		self.duplicates = 0		# records repeating the last one decoded
+
+	def restart(self, dst=None):
+		''' make the next record to dst (None for all) whole. Call it if an encoded
+			record wasn't sent '''
+		for i in range(self._dstCount):
+			if dst is None or self._dstAddress[i] == dst:
+				self._dstSinceKey[i] = 0
+
+	def _destination(self, address):
+		self._clock = self._clock + 1
+		for i in range(self._dstCount):
+			if self._dstAddress[i] == address:
+				self._dstUsed[i] = self._clock
+				return i
+		if self._dstCount < len(self._dstAddress):
+			i = self._dstCount
+			self._dstCount = self._dstCount + 1
+		else:
+			i = self._dstUsed.index(min(self._dstUsed)) # replace the quietest destination
+		self._dstAddress[i] = address
+		self._dstSinceKey[i] = 0
+		self._dstUsed[i] = self._clock
+		return i
+
+	def encode(self, values, out, dst=0xff):
+		''' write values for address dst into out (at least maxLength bytes), returns
+			the length '''
+		d = self._destination(dst)
+		key = self._dstSinceKey[d] == 0
+		self._dstSinceKey[d] = (self._dstSinceKey[d] + 1) % self.keyEvery
+		self._dstSeq[d] = (self._dstSeq[d] + 1) & 0xff
+		out[0] = KIND_RECORD if key else KIND_DELTA
+		out[1] = self._dstSeq[d]
+		at = 2
+		last = self._dstLast[d]
+		for i in range(self.size):
+			value = int(round(values[i] * self.scales[i]))
+			at = putVarint(out, at, zigzag(value if key else value - last[i]))
+			last[i] = value
+		return at
+
+	def _source(self, address, dst):
+		self._clock = self._clock + 1
+		for i in range(self._used):
+			if self._srcAddress[i] == address and self._srcDst[i] == dst:
+				self._srcUsed[i] = self._clock
+				return i
+		if self._used < len(self._srcAddress):
+			i = self._used
+			self._used = self._used + 1
+		else:
+			i = self._srcUsed.index(min(self._srcUsed)) # replace the quietest source
+		self._srcAddress[i] = address
+		self._srcDst[i] = dst
+		self._srcValid[i] = 0
+		self._srcUsed[i] = self._clock
+		return i
+
+	def _getVarint(self, buf):
+		value = 0
+		shift = 0
+		at = self._at
+		while at < len(buf):
+			byte = buf[at]
+			at = at + 1
+			value = value | ((byte & 0x7f) << shift)
+			if byte < 0x80:
+				self._at = at
+				return value
+			shift = shift + 7
+		self._at = -1	# ran off the end
+		return 0
+
+	def decode(self, src, payload, out, dst=0xff):
+		''' decode a record from address src to address dst into out (a list of size
+			values). Returns False if it isn't a record, is a repeat or can't be
+			decoded yet '''
+		if len(payload) < 2:
+			return False
+		kind = payload[0]
+		if kind != KIND_RECORD and kind != KIND_DELTA:
+			return False
+		i = self._source(src, dst)
+		if self._srcValid[i] and payload[1] == self._srcSeq[i]:
+			self.duplicates = self.duplicates + 1 # sent again, what we have is still right
+			return False
+		if kind == KIND_DELTA and (not self._srcValid[i] or payload[1] != (self._srcSeq[i] + 1) & 0xff):
+			self._srcValid[i] = 0
+			self.outOfSync = self.outOfSync + 1
+			return False
+		last = self._srcLast[i]
+		self._at = 2
+		for f in range(self.size):
+			value = unzigzag(self._getVarint(payload))
+			if self._at < 0:
+				self._srcValid[i] = 0
+				self.badRecords = self.badRecords + 1
+				return False
+			if kind == KIND_DELTA:
+				value = last[f] + value
+			last[f] = value
+			scale = self.scales[f]
+			out[f] = value if scale == 1 else value / scale
+		self._srcSeq[i] = payload[1]
+		self._srcValid[i] = 1
+		return True
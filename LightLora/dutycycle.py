@@ -0,0 +1,58 @@
+''' airtime accounting for regional duty cycle limits (1% in much of the 868 band) '''
+from LightLora import lorastats
+
+class AirtimeBudget:
+	''' a sliding window airtime budget in fixed memory. The window is split into
+		buckets so it slides in steps of windowMs/buckets. Times are in ms,
+		airtime in us. Call with the current ticks_ms at least every few days. '''
+	def __init__(self, dutyCycle=0.01, windowMs=3600000, buckets=20, nowMs=None):
+		self.dutyCycle = dutyCycle
+		self.windowMs = windowMs
+		self.budgetUs = int(dutyCycle * windowMs * 1000)
+		self.bucketMs = max(windowMs // buckets, 1)
+		self.airtime = [0] * buckets	# us sent during each bucket
+		self._bucket = 0				# bucket number (since start) of the newest bucket
+		self._elapsedMs = 0				# time since start, so ticks wrapping doesn't matter
+		self._lastMs = lorastats.ticks_ms() if nowMs is None else nowMs
+
+	def _advance(self, nowMs):
+		self._elapsedMs = self._elapsedMs + lorastats.ticks_diff(nowMs, self._lastMs)
+		self._lastMs = nowMs
+		bucket = self._elapsedMs // self.bucketMs
+		count = len(self.airtime)
+		# clear the buckets that slid out of the window
+		for b in range(max(self._bucket + 1, bucket - count + 1), bucket + 1):
+			self.airtime[b % count] = 0
+		self._bucket = max(bucket, self._bucket)
+
+	def used(self, nowMs):
+		''' airtime (us) used in the window '''
+		self._advance(nowMs)
+		return sum(self.airtime)
+
+	def remaining(self, nowMs):
+		''' airtime (us) left in the window '''
+		return max(self.budgetUs - self.used(nowMs), 0)
+
+	def canSend(self, airtimeUs, nowMs):
+		return self.used(nowMs) + airtimeUs <= self.budgetUs
+
+	def record(self, airtimeUs, nowMs):
+		''' note airtimeUs was just used '''
+		self._advance(nowMs)
+		self.airtime[self._bucket % len(self.airtime)] += airtimeUs
+
+	def waitMs(self, airtimeUs, nowMs):
+		''' about how long until airtimeUs fits in the budget (0 if it does now) '''
+		over = self.used(nowMs) + airtimeUs - self.budgetUs
+		if over <= 0:
+			return 0
+		count = len(self.airtime)
+		wait = self.bucketMs - self._elapsedMs % self.bucketMs
+		# the oldest buckets drop out first
+		for i in range(count):
+			over = over - self.airtime[(self._bucket + 1 + i) % count]
+			if over <= 0:
+				return wait
+			wait = wait + self.bucketMs
+		return wait
@@ -0,0 +1,265 @@
+''' splits messages bigger than one frame into fragments and puts them back together.
+
+A fragment is a LoraUtil packet whose payload starts with
+	KIND_FRAGMENT, message id, index, flags, data...
+flags has LAST set on the final fragment. Every fragment but the last carries
+FRAGMENT_SIZE bytes of data, so a message is at most 256 fragments (about 63k).
+
+Sending, from a buffer or anything that yields bytes chunks (like a generator
+reading a file a piece at a time):
+	lru.sendMessage(0x42, 0x41, bigBuffer)
+	lru.service()			# in the main loop, queues the rest as the send queue drains
+Receiving whole messages, in memory bounded by maxMessages * maxSize:
+	reasm = fragment.Reassembler(maxMessages=2, maxSize=2048)
+	msg = reasm.add(pkt)	# (src, id, memoryview) once complete, else None
+Or streaming, without ever holding the whole message:
+	stream = fragment.FragmentStream()
+	for src, msgId, index, data, last in stream.add(pkt):
+		f.write(data)
+'''
+from LightLora import lorastats, sx127x
+
+KIND_FRAGMENT = 0x03	# first payload byte, next to reliable.KIND_DATA and KIND_ACK
+LAST = 0x01
+
+HEADER = 4
+FRAGMENT_SIZE = sx127x.MAX_PKT_LENGTH - 4 - HEADER	# data per fragment after both headers
+MAX_FRAGMENTS = 256
+
+def parse(pkt):
+	''' (message id, index, flags, data) for a fragment packet, None if it isn't one '''
+	payload = pkt.payload
+	if len(payload) < HEADER or payload[0] != KIND_FRAGMENT:
+		return None
+	return payload[1], payload[2], payload[3], payload[HEADER:]
+
+class FragmentSender:
+	''' feeds one message into a LoraUtil send queue a fragment at a time.
+		source is a bytes-like object or an iterable of bytes chunks, it's only
+		read as far as the next fragment so a generator never has to produce the
+		whole message. One send queue slot is left free for other traffic. '''
+	def __init__(self, loraUtil, dstAddress, localAddress, source, msgId):
+		self.lu = loraUtil
+		self.dstAddress = dstAddress
+		self.localAddress = localAddress
+		self.msgId = msgId & 0xff
+		self.index = 0			# the next fragment
+		self.done = False
+		self.failed = False		# more than MAX_FRAGMENTS, the rest wasn't sent
+		self._frame = bytearray(HEADER + FRAGMENT_SIZE)
+		self._frame[0] = KIND_FRAGMENT
+		self._frame[1] = self.msgId
+		self._fill = 0			# data bytes in _frame
+		self._ready = False		# _frame holds a fragment waiting for a queue slot
+		if isinstance(source, (bytes, bytearray, memoryview)):
+			source = (source,)
+		self._chunks = iter(source)
+		self._chunk = None
+		self._offset = 0
+
+	# True if the source has data left, moving on to the next chunk when needed
+	def _more(self):
+		while self._chunk is None or self._offset >= len(self._chunk):
+			try:
+				self._chunk = memoryview(next(self._chunks))
+			except StopIteration:
+				self._chunk = None
+				return False
+			self._offset = 0
+		return True
+
+	def _build(self):
+		frame = self._frame
+		fill = 0
+		while fill < FRAGMENT_SIZE and self._more():
+			n = min(FRAGMENT_SIZE - fill, len(self._chunk) - self._offset)
+			frame[HEADER + fill:HEADER + fill + n] = self._chunk[self._offset:self._offset + n]
+			self._offset = self._offset + n
+			fill = fill + n
+		last = not self._more()
+		if not last and self.index == MAX_FRAGMENTS - 1:
+			self.failed = True
+			last = True			# send what fits rather than nothing
+		frame[2] = self.index
+		frame[3] = LAST if last else 0
+		self._fill = fill
+		self._ready = True
+
+	def pump(self):
+		''' queue fragments while the send queue has room, leaving a slot for other
+			packets if there's more than one. True once all are queued '''
+		ring = self.lu.txQueue
+		while not self.done and ring.count < max(ring.depth - 1, 1):
+			if not self._ready:
+				self._build()
+			if not self.lu.sendPacket(self.dstAddress, self.localAddress,
+									  memoryview(self._frame)[:HEADER + self._fill]):
+				break	# refused by the duty cycle limit, try again later
+			self._ready = False
+			self.done = bool(self._frame[3] & LAST)
+			self.index = self.index + 1
+		return self.done
+
+class Reassembler:
+	''' puts fragmented messages back together in fixed memory. Up to maxMessages
+		messages of at most maxSize bytes can be in progress at once, fragments may
+		arrive in any order. A partial message is dropped when nothing arrives for
+		it in timeoutMs, or when its slot is needed and it is the quietest. '''
+	def __init__(self, maxMessages=2, maxSize=2048, timeoutMs=30000, ticksMs=None):
+		self.buffers = [bytearray(maxSize) for i in range(maxMessages)]
+		self.inUse = bytearray(maxMessages)
+		self.sources = bytearray(maxMessages)
+		self.ids = bytearray(maxMessages)
+		self.received = [0] * maxMessages		# bit i set: fragment i is in
+		self.lastIndex = [-1] * maxMessages		# index of the LAST fragment once it's in
+		self.lengths = [0] * maxMessages
+		self.lastHeard = [0] * maxMessages
+		self.timeoutMs = timeoutMs
+		self.ticksMs = ticksMs or lorastats.ticks_ms
+		self.completed = 0
+		self.timedOut = 0
+		self.evicted = 0
+		self.tooLarge = 0
+
+	def _find(self, src, msgId):
+		for i in range(len(self.inUse)):
+			if self.inUse[i] and self.sources[i] == src and self.ids[i] == msgId:
+				return i
+		return -1
+
+	def _claim(self, src, msgId, now):
+		if 0 in self.inUse:
+			i = self.inUse.index(0)
+		else:
+			i = 0
+			for j in range(1, len(self.inUse)):
+				if lorastats.ticks_diff(self.lastHeard[i], self.lastHeard[j]) > 0:
+					i = j
+			self.evicted = self.evicted + 1
+		self.inUse[i] = 1
+		self.sources[i] = src
+		self.ids[i] = msgId
+		self.received[i] = 0
+		self.lastIndex[i] = -1
+		self.lengths[i] = 0
+		self.lastHeard[i] = now
+		return i
+
+	def expire(self, now=None):
+		''' drop partial messages that have gone quiet. add() calls this '''
+		if now is None:
+			now = self.ticksMs()
+		for i in range(len(self.inUse)):
+			if self.inUse[i] and lorastats.ticks_diff(now, self.lastHeard[i]) > self.timeoutMs:
+				self.inUse[i] = 0
+				self.timedOut = self.timedOut + 1
+
+	def add(self, pkt):
+		''' add a received packet. Returns (source, message id, memoryview of the
+			message) when it completes one, else None. The view is good until the
+			next add. The packet is left to the caller to release. '''
+		fields = parse(pkt)
+		if fields is None:
+			return None
+		msgId, index, flags, data = fields
+		now = self.ticksMs()
+		self.expire(now)
+		src = pkt.srcAddress
+		i = self._find(src, msgId)
+		if i < 0:
+			i = self._claim(src, msgId, now)
+		start = index * FRAGMENT_SIZE
+		end = start + len(data)
+		buffer = self.buffers[i]
+		if end > len(buffer):
+			self.inUse[i] = 0
+			self.tooLarge = self.tooLarge + 1
+			return None
+		buffer[start:end] = data
+		self.received[i] = self.received[i] | (1 << index)
+		self.lastHeard[i] = now
+		if flags & LAST:
+			self.lastIndex[i] = index
+			self.lengths[i] = end
+		last = self.lastIndex[i]
+		if last < 0 or self.received[i] != (1 << (last + 1)) - 1:
+			return None
+		self.inUse[i] = 0
+		self.completed = self.completed + 1
+		return src, msgId, memoryview(buffer)[:self.lengths[i]]
+
+class FragmentStream:
+	''' hands up fragments in order as they arrive so a large transfer never has
+		to be held in memory. One message is followed at a time. Up to holdCount
+		early fragments are held (the packets themselves, no copying) until the gap
+		before them fills. If the stream goes quiet for timeoutMs, or its sender
+		starts a new message, it is abandoned and the next message is followed. '''
+	def __init__(self, holdCount=4, timeoutMs=30000, ticksMs=None):
+		self.held = [None] * holdCount
+		self.timeoutMs = timeoutMs
+		self.ticksMs = ticksMs or lorastats.ticks_ms
+		self.source = -1		# -1 when no message is being followed
+		self.msgId = 0
+		self.expected = 0		# index of the next fragment to hand up
+		self.lastHeard = 0
+		self.dropped = 0		# fragments that couldn't be used
+		self.abandoned = 0		# messages given up on part way
+
+	def _releaseHeld(self):
+		for k in range(len(self.held)):
+			if self.held[k]:
+				self.held[k].release()
+				self.held[k] = None
+
+	def _follow(self, src, msgId, now):
+		if self.source >= 0:
+			self.abandoned = self.abandoned + 1
+			self._releaseHeld()
+		self.source = src
+		self.msgId = msgId
+		self.expected = 0
+		self.lastHeard = now
+
+	def add(self, pkt):
+		''' a generator of (source, message id, index, data, last) for the fragments
+			this packet lets through, in order. It takes the packet and releases it
+			once handed up, so iterate it to the end. data is only good until then. '''
+		fields = parse(pkt)
+		if fields is None:
+			pkt.release()
+			return
+		msgId, index, flags, data = fields
+		src = pkt.srcAddress
+		now = self.ticksMs()
+		if self.source < 0 or lorastats.ticks_diff(now, self.lastHeard) > self.timeoutMs or \
+				(src == self.source and msgId != self.msgId):
+			self._follow(src, msgId, now)
+		if src != self.source or msgId != self.msgId or index < self.expected:
+			self.dropped = self.dropped + 1		# another message, or a copy
+			pkt.release()
+			return
+		self.lastHeard = now
+		if index > self.expected:
+			if None in self.held:
+				self.held[self.held.index(None)] = pkt
+			else:
+				self.dropped = self.dropped + 1
+				pkt.release()
+			return
+		while pkt:
+			last = bool(flags & LAST)
+			yield src, msgId, index, data, last
+			pkt.release()
+			if last:
+				self.source = -1
+				self._releaseHeld()
+				return
+			self.expected = self.expected + 1
+			pkt = None
+			for k in range(len(self.held)):
+				held = self.held[k]
+				if held and held.payload[2] == self.expected:
+					self.held[k] = None
+					pkt = held
+					msgId, index, flags, data = parse(pkt)
+					break
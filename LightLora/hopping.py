@@ -0,0 +1,63 @@
+''' frequency hopping: spread the traffic of a network over a channel plan
+instead of sharing one frequency.
+
+Every address has a home channel in the plan. A radio listens on its own and
+sends each frame on the home channel of its destination, then goes back, so
+traffic to different receivers doesn't contend and the network carries about
+as many frames at once as there are busy receivers. The receiver has to be
+listening already to hear anything, so the channel comes from the destination
+address alone and nothing extra goes on air.
+
+	plan = hopping.ChannelPlan(key=0x5a)		# the same on every node
+	lru.setHopping(plan, 0x41)
+
+A broadcast is sent once on every channel that is somebody's home (channels),
+one after the other, so every node hears it where it already listens. That
+costs a frame of airtime per channel, so a network that broadcasts much should
+keep its plan to a few channels with useChannels.
+The frf register bytes of every channel are worked out once, a hop costs one
+spi burst. To stay off busy channels, rank them with LoraUtil.rankChannels and
+give every node the same quietest few for useChannels.
+'''
+from LightLora import sx127x
+
+BROADCAST = 0xff
+
+class ChannelPlan:
+	''' count channels spacingHz apart from firstHz. The default is the 64 US 902-928MHz
+		125kHz channels. key changes which address gets which channel, so neighbouring
+		networks don't line up. home[address] is the home channel of an address and
+		channels the ones that are home to any, where broadcasts are sent. '''
+	def __init__(self, firstHz=902.3e6, spacingHz=200e3, count=64, key=0):
+		count = min(count, 256)
+		self.frequencies = [firstHz + i * spacingHz for i in range(count)]
+		self.frf = [sx127x.frfBytes(frequency) for frequency in self.frequencies]
+		self.count = count
+		self.key = key
+		# a table so the transmit interrupt just looks it up
+		self.home = bytearray(256)
+		self.useChannels(range(count))
+
+	def _mix(self, address):
+		key = self.key
+		return ((((address ^ (key & 0xff)) * 0x9e3779b1 + key) & 0xffffffff) >> 16)
+
+	def useChannels(self, channels):
+		''' spread the home channels over just channels (indexes into frequencies),
+			like the quietest from LoraUtil.rankChannels. The same list gives the same
+			homes on every node. It undoes assign() '''
+		channels = list(channels)
+		for address in range(256):
+			self.home[address] = channels[self._mix(address) % len(channels)]
+		self._homes()
+
+	def assign(self, address, channel):
+		''' give address a particular home channel (on every node) '''
+		self.home[address] = channel % self.count
+		self._homes()
+
+	def _homes(self):
+		self.channels = bytearray(sorted(set(self.home)))
+
+	def channelFor(self, address):
+		return self.home[address]
@@ -0,0 +1,109 @@
+''' an asyncio (uasyncio) front end for LoraUtil.
+	The radio interrupts set a ThreadSafeFlag so waiting coroutines wake as soon
+	as a packet arrives or a send finishes, without polling.
+
+	alora = loraasync.AsyncLora(lorautil.LoraUtil(), 0x41)
+	alora.start()
+	await alora.send(0xff, b'hello')	# returns once it's on the air and done
+	pkt = await alora.recv()
+	async for pkt in alora:
+		...
+'''
+try:
+	import uasyncio as asyncio
+except ImportError:
+	import asyncio
+
+ThreadSafeFlag = getattr(asyncio, 'ThreadSafeFlag', None)
+if ThreadSafeFlag is None:
+	# CPython doesn't have one. set() may come from another thread
+	class ThreadSafeFlag:
+		def __init__(self):
+			self._event = asyncio.Event()
+			self._loop = None
+
+		def set(self):
+			loop = self._loop
+			try:
+				running = asyncio.get_running_loop()
+			except RuntimeError:
+				running = None
+			if loop and running is not loop:
+				loop.call_soon_threadsafe(self._event.set)
+			else:
+				self._event.set()
+
+		async def wait(self):
+			self._loop = asyncio.get_running_loop()
+			await self._event.wait()
+			self._event.clear()
+
+class AsyncLora:
+	''' awaitable send and receive on top of a LoraUtil.
+		localAddress is our address in the packet header. serviceMs is how often
+		the LoraUtil service() housekeeping runs. '''
+	def __init__(self, loraUtil, localAddress, serviceMs=100):
+		self.lu = loraUtil
+		self.localAddress = localAddress
+		self.serviceMs = serviceMs
+		self._flag = ThreadSafeFlag()
+		self._changed = asyncio.Event()	# replaced on every wake, so all waiters see it
+		self._tasks = None
+		loraUtil.setWakeFlag(self._flag)
+
+	def start(self):
+		''' start the background tasks, call from inside the event loop '''
+		if self._tasks is None:
+			self._tasks = (asyncio.create_task(self._pump()), asyncio.create_task(self._service()))
+
+	def stop(self):
+		if self._tasks:
+			for task in self._tasks:
+				task.cancel()
+			self._tasks = None
+
+	async def _pump(self):
+		while True:
+			await self._flag.wait()
+			self._wake()
+
+	async def _service(self):
+		while True:
+			self.lu.service()
+			await asyncio.sleep(self.serviceMs / 1000)
+
+	def _wake(self):
+		changed = self._changed
+		self._changed = asyncio.Event()
+		changed.set()
+
+	async def _waitChange(self):
+		await self._changed.wait()
+
+	async def send(self, dstAddress, payload):
+		''' queue payload for dstAddress and wait until it has been sent '''
+		self.start()
+		rejected = self.lu.stats.txRejected
+		while not self.lu.sendPacket(dstAddress, self.localAddress, payload):
+			if self.lu.stats.txRejected != rejected:
+				return False	# over the duty cycle, waiting won't help soon
+			await self._waitChange()	# send queue full, wait for room
+		ticket = self.lu.txAccepted
+		while self.lu.txFinished < ticket:
+			await self._waitChange()
+		return True
+
+	async def recv(self):
+		''' wait for the next received packet '''
+		self.start()
+		while True:
+			pkt = self.lu.readPacket()
+			if pkt:
+				return pkt
+			await self._waitChange()
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		return await self.recv()
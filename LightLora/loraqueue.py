@@ -0,0 +1,56 @@
+''' fixed size queues of LoRa frames. All of the frame buffers are allocated
+	up front so filling the queue from an interrupt doesn't touch the heap '''
+from LightLora import sx127x
+
+# what to do with an incoming frame when the queue is full
+DROP_OLDEST = 0
+DROP_NEWEST = 1
+
+class FrameRing:
+	''' a ring of preallocated frame buffers.
+		reserve -> get a slot to fill (or -1 if the frame is dropped)
+		commit -> make a filled slot visible to the reader
+		peek -> get the oldest slot (or -1 if empty)
+		pop -> release the oldest slot
+	'''
+	def __init__(self, depth=4, frameSize=sx127x.MAX_PKT_LENGTH, policy=DROP_OLDEST):
+		self.depth = depth
+		self.policy = policy
+		self.frames = [bytearray(frameSize) for i in range(depth)]
+		self.lengths = [0] * depth
+		self.rssi = [0] * depth
+		self.snr = [0] * depth
+		self.head = 0		# oldest slot
+		self.count = 0		# committed slots
+		self.overflows = 0	# frames lost because the ring was full
+		self.reading = -1	# slot the reader is working on, never overwritten
+
+	def reserve(self):
+		''' return the slot to fill with the next frame. -1 means drop the frame '''
+		if self.count >= self.depth:
+			self.overflows = self.overflows + 1
+			if self.policy == DROP_NEWEST or self.head == self.reading:
+				return -1
+			# drop the oldest to make room
+			self.head = (self.head + 1) % self.depth
+			self.count = self.count - 1
+		return (self.head + self.count) % self.depth
+
+	def commit(self, slot, length):
+		''' the reserved slot now holds length bytes '''
+		self.lengths[slot] = length
+		self.count = self.count + 1
+
+	def peek(self):
+		return self.head if self.count > 0 else -1
+
+	def pop(self):
+		if self.count > 0:
+			self.head = (self.head + 1) % self.depth
+			self.count = self.count - 1
+		self.reading = -1
+
+	def clear(self):
+		self.head = 0
+		self.count = 0
+		self.reading = -1
@@ -0,0 +1,163 @@
+''' counters for watching link health and driver overhead.
+	Updating them doesn't allocate, so they're safe to bump from interrupts '''
+try:
+	from time import ticks_us, ticks_ms, ticks_diff, ticks_add
+except ImportError:
+	# not micropython
+	from time import perf_counter
+	def ticks_us():
+		return int(perf_counter() * 1000000)
+	def ticks_ms():
+		return int(perf_counter() * 1000)
+	def ticks_diff(end, start):
+		return end - start
+	def ticks_add(ticks, delta):
+		return ticks + delta
+
+# events passed to an onEvent hook as hook(sx127x, event, value)
+EVENT_CRC_ERROR = 1			# value is the irq flags
+EVENT_RX_TIMEOUT = 2		# value is the irq flags
+EVENT_NOT_RX_DONE = 3		# receive interrupt without rx done, value is the irq flags
+EVENT_NO_RX_HANDLER = 4		# value is the irq flags
+EVENT_TX_NOT_DONE = 5		# transmit interrupt without tx done, value is the irq flags
+EVENT_NO_TX_HANDLER = 6		# value is the irq flags
+EVENT_SHORT_PACKET = 7		# packet with no payload dropped, value is its length
+EVENT_RX_OVERFLOW = 8		# receive queue full, value is the overflow count
+EVENT_TX_QUEUE_FULL = 9		# sendPacket refused, value is the drop count
+EVENT_TX_ERROR = 10			# loading or starting a send failed, value is the exception
+
+EVENT_NAMES = ('', 'crc error', 'receive timeout error', 'not rx done mask',
+			   'no receive method defined', 'transmit callback but not txdone',
+			   'transmit callback but no callback method', 'short packet',
+			   'receive queue overflow', 'send queue full', 'send error')
+
+def printEvent(sx12, event, value):
+	''' an onEvent hook that prints, like the driver used to '''
+	print(EVENT_NAMES[event] + ": " + str(value))
+
+class RadioStats:
+	''' packet, error and latency counters for one radio '''
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.txPackets = 0
+		self.txBytes = 0
+		self.rxPackets = 0
+		self.rxBytes = 0
+		self.crcErrors = 0
+		self.rxTimeouts = 0
+		self.notRxDone = 0			# receive interrupts without rx done
+		self.unexpectedTx = 0		# transmit interrupts without tx done
+		self.shortPackets = 0		# received packets too short to have a payload
+		self.rxOverflows = 0		# received packets lost to a full queue
+		self.txQueueDrops = 0		# sends refused because the queue was full
+		self.txDeferred = 0			# times a send was held back by the duty cycle limit
+		self.txRejected = 0			# sends refused by the duty cycle limit
+		self.txErrors = 0			# queued sends dropped because loading them failed
+		self.cadChecks = 0			# channel activity detections run
+		self.cadDetected = 0		# ... that found activity
+		self.lbtBackoffs = 0		# sends put off because the channel was busy
+		self.rxFiltered = 0			# received packets for other addresses, dropped unread
+		self.rxFilteredBytes = 0	# ... and their length in bytes
+		self.latencyCount = 0		# irq to callback latency
+		self.latencyTotalUs = 0
+		self.latencyMaxUs = 0
+
+	def addLatency(self, us):
+		self.latencyCount = self.latencyCount + 1
+		self.latencyTotalUs = self.latencyTotalUs + us
+		if us > self.latencyMaxUs:
+			self.latencyMaxUs = us
+
+	def latencyMeanUs(self):
+		return self.latencyTotalUs // self.latencyCount if self.latencyCount else 0
+
+	def asDict(self):
+		return {'txPackets': self.txPackets, 'txBytes': self.txBytes,
+				'rxPackets': self.rxPackets, 'rxBytes': self.rxBytes,
+				'crcErrors': self.crcErrors, 'rxTimeouts': self.rxTimeouts,
+				'notRxDone': self.notRxDone, 'unexpectedTx': self.unexpectedTx,
+				'shortPackets': self.shortPackets, 'rxOverflows': self.rxOverflows,
+				'txQueueDrops': self.txQueueDrops, 'txDeferred': self.txDeferred,
+				'txRejected': self.txRejected, 'txErrors': self.txErrors,
+				'cadChecks': self.cadChecks, 'cadDetected': self.cadDetected,
+				'lbtBackoffs': self.lbtBackoffs,
+				'rxFiltered': self.rxFiltered, 'rxFilteredBytes': self.rxFilteredBytes,
+				'latencyMeanUs': self.latencyMeanUs(),
+				'latencyMaxUs': self.latencyMaxUs}
+
+class LinkStats:
+	''' running rssi/snr statistics per source address in a fixed size table.
+		Values are kept as raw register units (snr in quarter dB, signed) so an
+		update is integer only. When the table is full the least recently heard
+		address is replaced. '''
+	def __init__(self, size=16):
+		self.size = size
+		self.addresses = bytearray(size)
+		self.used = 0
+		self.count = [0] * size
+		self.lastSeen = [0] * size	# update order, for replacement
+		self.rssiSum = [0] * size
+		self.rssiMin = [0] * size
+		self.rssiMax = [0] * size
+		self.snrSum = [0] * size
+		self.snrMin = [0] * size
+		self.snrMax = [0] * size
+		self._clock = 0
+
+	def _find(self, address):
+		for i in range(self.used):
+			if self.addresses[i] == address:
+				return i
+		return -1
+
+	def update(self, address, rssiRaw, snrRaw):
+		''' add a packet from address. snrRaw is the register byte '''
+		if snrRaw > 127:
+			snrRaw = snrRaw - 256
+		i = self._find(address)
+		if i < 0:
+			if self.used < self.size:
+				i = self.used
+				self.used = self.used + 1
+			else:
+				i = 0
+				for j in range(1, self.size):
+					if self.lastSeen[j] < self.lastSeen[i]:
+						i = j
+			self.addresses[i] = address
+			self.count[i] = 0
+			self.rssiSum[i] = 0
+			self.snrSum[i] = 0
+			self.rssiMin[i] = self.rssiMax[i] = rssiRaw
+			self.snrMin[i] = self.snrMax[i] = snrRaw
+		self._clock = self._clock + 1
+		self.lastSeen[i] = self._clock
+		self.count[i] = self.count[i] + 1
+		self.rssiSum[i] = self.rssiSum[i] + rssiRaw
+		self.snrSum[i] = self.snrSum[i] + snrRaw
+		if rssiRaw < self.rssiMin[i]:
+			self.rssiMin[i] = rssiRaw
+		if rssiRaw > self.rssiMax[i]:
+			self.rssiMax[i] = rssiRaw
+		if snrRaw < self.snrMin[i]:
+			self.snrMin[i] = snrRaw
+		if snrRaw > self.snrMax[i]:
+			self.snrMax[i] = snrRaw
+
+	def get(self, address, sx12):
+		''' statistics for address in dBm/dB (or None). sx12 converts the rssi '''
+		i = self._find(address)
+		if i < 0:
+			return None
+		count = self.count[i]
+		return {'count': count,
+				'rssiMean': sx12.rssiFromRaw(self.rssiSum[i] / count),
+				'rssiMin': sx12.rssiFromRaw(self.rssiMin[i]),
+				'rssiMax': sx12.rssiFromRaw(self.rssiMax[i]),
+				'snrMean': self.snrSum[i] / count * 0.25,
+				'snrMin': self.snrMin[i] * 0.25, 'snrMax': self.snrMax[i] * 0.25}
+
+	def addressList(self):
+		return list(self.addresses[:self.used])
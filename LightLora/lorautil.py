@@ -1,35 +1,224 @@
 ''' this adds a little high-level init to an sx1276 and it also
 	packetizes messages with address headers'''
 from time import sleep
-from LightLora import spicontrol, sx127x
+try:
+	from random import getrandbits
+except ImportError:
+	from urandom import getrandbits
+from LightLora import sx127x, loraqueue, lorastats, dutycycle, fragment, capture
+try:
+	from micropython import schedule
+except ImportError:
+	schedule = None		# not micropython, run deferred work directly
+
+# in the payload length byte (a real one is at most 251) it marks a frame holding
+# several messages, each one as line count, length, data
+AGGREGATE = 0xff
+
+BROADCAST = 0xff
 
 class LoraPacket:
-	def __init__(self):
-		self.srcAddress = None
-		self.dstAddress = None
-		self.srcLineCount = None
-		self.payLength = None
-		self.msgTxt = None
-		self.rssi = None
-		self.snr = None
+	''' a received packet. It holds the raw frame (header + payload) and raw
+		rssi/snr register values, everything else is worked out when asked for.
+		payload is a memoryview into the frame, msgTxt decodes it as utf-8.
+		Call release() when done to hand the packet back to its pool.
+		skip is the number of payload bytes used by a protocol layer (like
+		reliable.ReliableLink), they are left out of payload and msgTxt. '''
+	__slots__ = ('buf', 'length', 'rssiRaw', 'snrRaw', 'rssiBase', 'skip', '_pool')
+
+	def __init__(self, size=sx127x.MAX_PKT_LENGTH, pool=None):
+		self.buf = bytearray(size)	# the frame as received
+		self.length = 0				# bytes of buf in use
+		self.rssiRaw = 0
+		self.snrRaw = 0
+		self.rssiBase = 0			# rssi = rssiRaw + rssiBase, it depends on the band
+		self.skip = 0
+		self._pool = pool
+
+	# the header as sendPacket writes it
+	@property
+	def dstAddress(self):
+		return self.buf[0]
+
+	@property
+	def srcAddress(self):
+		return self.buf[1]
+
+	@property
+	def srcLineCount(self):
+		return self.buf[2]
+
+	@property
+	def payLength(self):
+		return self.buf[3]
+
+	@property
+	def payload(self):
+		''' the payload bytes, without copying '''
+		return memoryview(self.buf)[4 + self.skip:min(self.length, 4 + self.buf[3])]
+
+	@property
+	def msgTxt(self):
+		''' the payload decoded as text (None if it can't be) '''
+		try:
+			return bytes(self.payload).decode('utf-8', 'ignore')
+		except Exception:
+			return None
+
+	@property
+	def rssi(self):
+		return self.rssiRaw + self.rssiBase
+
+	@property
+	def snr(self):
+		return (self.snrRaw - 256 if self.snrRaw > 127 else self.snrRaw) * 0.25
+
+	@property
+	def hops(self):
+		''' how many relays sent the packet on (see relay.py) '''
+		at = 4 + self.buf[3]
+		return self.buf[at] if self.buf[3] != AGGREGATE and self.length > at else 0
 
 	def clear(self):
-		self.msgTxt = ''
+		self.length = min(self.length, 4)
+
+	def release(self):
+		''' done with the packet, it may be reused '''
+		if self._pool:
+			self._pool.release(self)
+
+class PacketPool:
+	''' recycles LoraPacket objects so steady receiving doesn't churn the heap.
+		If it runs dry new packets are made (and counted in created) '''
+	def __init__(self, size=4, frameSize=sx127x.MAX_PKT_LENGTH):
+		self.size = size
+		self.frameSize = frameSize
+		self.free = [LoraPacket(frameSize, self) for i in range(size)]
+		self.created = size
+
+	def acquire(self):
+		if self.free:
+			return self.free.pop()
+		self.created = self.created + 1
+		return LoraPacket(self.frameSize, self)
+
+	def release(self, pkt):
+		if len(self.free) < self.size and pkt not in self.free:
+			self.free.append(pkt)
 
 class LoraUtil:
 	''' a LoraUtil object has an sx1276 and it can send and receive LoRa packets
-		sendPacket -> send a string
+		sendPacket -> queue a packet to send, returns False if the send queue is full
+		sendMessage -> send a message of any size as fragments (see fragment.py)
+		setAggregation -> pack small messages to one destination into one frame
+		setCodec, sendRecord, readRecord -> send numbers in a compact binary form (see codec.py)
+		setAdaptive -> send to each peer with settings picked from its snr (see adr.py)
+		setListenBeforeTalk -> check the channel is quiet (cad) before each frame
+		setLowPowerReceive -> sleep between checks for a preamble instead of receiving
+		setHopping -> spread traffic over a channel plan (see hopping.py)
+		setAddressFilter -> only take packets for our address, broadcasts and groups
+		setCapture -> log every frame received and sent to a file (see capture.py)
+		setRelay -> send on frames heard for other nodes (see relay.py)
+		scanChannels, rankChannels -> measure the rssi (noise) on a list of frequencies
+		setQuietChannel -> move to the quietest of a list of frequencies every so often
 		isPacketAvailable -> do we have a packet available?
-		readPacket -> get the latest packet
+		readPacket -> get the oldest received packet, release() it when done
+		readPackets -> get all of the received packets
+		onReceive -> set a function(loraUtil) called when packets arrive
+		onEvent -> set a hook(sx127x, event, value) for errors and drops
+		setWakeFlag -> set a flag whose set() is called from the interrupts
+		stats -> the lorastats.RadioStats counters (shared with the sx127x)
+		links -> per source address rssi/snr statistics (lorastats.LinkStats)
+		rxDepth is the number of received packets held until read, rxPolicy says which
+		to drop (loraqueue.DROP_OLDEST or DROP_NEWEST) when that fills up
+		txDepth is the number of outgoing packets that can wait to be sent. The
+		next one goes out from the transmit done interrupt, back to back.
+		spiControl defaults to a spicontrol.SpiControl for the board pins. Pass
+		another (like the emulator in Tools/sx127xemu.py) to run elsewhere.
+		linkSlots is how many source addresses links keeps statistics for.
+		ticksMs is the millisecond clock (time.ticks_ms, or the emulator's).
+		splitFifo gives transmit and receive their own halves of the radio fifo.
+		Frames up to 128 bytes are then loaded while the radio keeps receiving,
+		so it only stops listening for the switch to transmit.
+		warmStart skips the reset and configuration if the radio still holds it,
+		like after a deep sleep of the mcu with the radio asleep. warm says if it did.
+
+		With setAggregation small messages wait (up to maxLatencyMs) for others to
+		the same destination and go out together in one frame, sharing a preamble
+		and header. readPacket splits them up again so each still arrives as its
+		own packet. A frame with just one message is sent as a normal packet.
+
+		setDutyCycle limits the airtime used in a sliding window. Sends over the
+		limit wait in the queue (call service() from the main loop to send them
+		when the budget allows) or, with reject=True, are refused by sendPacket.
+
+		The receive interrupt only copies the fifo into a preallocated queue slot
+		(after checking the header against setAddressFilter). Link statistics, adr
+		samples, capture, relaying, parsing, decoding, garbage collection and the
+		onReceive callback run later, scheduled with micropython.schedule. The
+		interrupt still makes small allocations (memoryview slices) so DIO0 must
+		be a soft pin interrupt (the default, not hard=True).
 	'''
-	def __init__(self):
+	def __init__(self, rxDepth=4, rxPolicy=loraqueue.DROP_OLDEST, txDepth=4, spiControl=None,
+				 linkSlots=16, ticksMs=None, splitFifo=False, warmStart=False):
 		# just be neat and init variables in the __init__
 		self.linecounter = 0
-		self.packet = None
+		self.rxQueue = loraqueue.FrameRing(rxDepth, policy=rxPolicy)
+		self.txQueue = loraqueue.FrameRing(txDepth, policy=loraqueue.DROP_NEWEST)
 		self.doneTransmit = False
+		self._txBusy = False		# a frame from txQueue is on the air
+		self._loaded = -1			# send queue slot whose frame is in the fifo
+		self.links = lorastats.LinkStats(linkSlots)
+		self.pool = PacketPool(rxDepth)
+		self.ticksMs = ticksMs or lorastats.ticks_ms
+		self.budget = None			# dutycycle.AirtimeBudget when the duty cycle is limited
+		self._rejectOverBudget = False
+		self.txAccepted = 0			# frames sendPacket queued
+		self.txFinished = 0			# frames done sending (or dropped)
+		self._senders = []			# fragment.FragmentSenders with fragments left to queue
+		self._messageId = 0
+		self._txMessages = [1] * txDepth	# messages in each send queue frame
+		self._aggFrames = None		# frames being filled, one per destination, see setAggregation
+		self._split = []			# packets split out of a received aggregate, not read yet
+		self.codec = None			# payload codec for sendRecord and readRecord
+		self.adapter = None			# adr.LinkAdapter picking the settings per destination
+		self._lbtMs = None			# listen before talk backoff, None when off
+		self._lbtMaxMs = 0
+		self._lbtTries = 0			# busy checks in a row
+		self._channelClear = False	# a cad just found the channel quiet
+		self._retryAt = None		# backing off until then (ticks ms)
+		self._budgetAt = None		# over the duty cycle until then (ticks ms)
+		self._sniffMs = None		# low power receive check interval, None when off
+		self._sniffListenMs = 0
+		self._sniffAt = 0			# time of the next preamble check
+		self._sniffCad = False		# the cad running is a preamble check
+		self._rxUntil = None		# receiving until then, in low power receive
+		self.hopping = None			# hopping.ChannelPlan when hopping
+		self._homeChannel = 0		# the plan channel we listen on
+		self._sweep = 0				# index in hopping.channels of the broadcast being sent
+		self._channel = -1			# the plan channel tuned to, -1 if off the plan
+		self._baseFrequency = 0		# to go back to when hopping stops
+		self._accepted = None		# bytearray(256), 1 for destinations we take, see setAddressFilter
+		self.capture = None			# capture.Capture logging the frames
+		self.relay = None			# relay.Relay sending on frames for others
+		self._surveyFrequencies = None	# to pick the quietest of, see setQuietChannel
+		self._surveyMs = 0
+		self._surveyMargin = 0
+		self._surveyAt = 0			# time of the next scan
+		self._onMove = None
+		self._wakeFlag = None		# set() from the interrupts, see setWakeFlag
+		self._rxSlot = -1			# queue slot the receive interrupt is filling
+		self._fresh = 0				# newest queue slots _bookkeep hasn't seen yet
+		self._booking = False		# _bookkeep is running
+		self._onReceive = None		# user callback, run outside the interrupt
+		self._deferredPending = False
+		self._deferredRef = self._deferredReceive # bind once, schedule mustn't allocate
 
 		# init spi
-		self.spic = spicontrol.SpiControl()
+		if spiControl is None:
+			from LightLora import spicontrol # needs machine, so only import it when used
+			spiControl = spicontrol.SpiControl()
+		self.spic = spiControl
 		# init lora
 		params = {'tx_power_level': 5,
 			'frequency' : 915e6,
@@ -37,59 +226,700 @@ class LoraUtil:
 			'spreading_factor': 9,
 			'coding_rate': 8,
 			'power_pin' : 1,		# boost pin is 1, non-boost pin is 0
-			'enable_CRC': True}
+			'enable_CRC': True,
+			'split_fifo': splitFifo,
+			'gc_policy': sx127x.GC_LOW_MEMORY}
 		self.lora = sx127x.SX127x(spiControl=self.spic, parameters=params)
-		self.spic.initLoraPins() # init pins
-		self.lora.init()
-		self.lora.onReceive(self._doReceive)
+		self.stats = self.lora.stats
+		self.warm = warmStart and self.lora.init(warm=True)
+		if not self.warm:
+			self.spic.initLoraPins() # init pins
+			self.lora.init()
+		self.lora.onReceiveInto(self._getRxBuffer, self._doReceive)
 		self.lora.onTransmit(self._doTransmit)
+		self.lora.onCadDone(self._doCad)
 		# put into receive mode and wait for an interrupt
 		self.lora.receive()
 
-	# we received a packet, deal with it
-	def _doReceive(self, sx12, pay):
-		pkt = LoraPacket()
-		self.packet = None
-		if pay and len(pay) > 4:
-			pkt.srcAddress = pay[0]
-			pkt.dstAddress = pay[1]
-			pkt.srcLineCount = pay[2]
-			pkt.payLength = pay[3]
-			pkt.rssi = sx12.packetRssi()
-			pkt.snr = sx12.packetSnr()
-			try:
-				pkt.msgTxt = pay[4:].decode('utf-8', 'ignore')
-			except Exception as ex:
-				print("doReceiver error: ")
-				print(ex)
-			self.packet = pkt
-
-	# the transmit ended
+	# receive interrupt: hand out the queue slot to read the fifo into
+	def _getRxBuffer(self):
+		ring = self.rxQueue
+		overflows = ring.overflows
+		slot = ring.reserve()
+		self._rxSlot = slot
+		if ring.overflows != overflows:
+			self.stats.rxOverflows = self.stats.rxOverflows + 1
+			self.lora._event(lorastats.EVENT_RX_OVERFLOW, ring.overflows)
+		return ring.frames[slot] if slot >= 0 else None
+
+	# receive interrupt: the header has been read, is the packet for us
+	def _acceptHeader(self, header):
+		if self.relay:
+			return self.relay.acceptHeader(header, self.ticksMs())
+		return self._accepted[header[0]]
+
+	# receive interrupt: the packet is in the slot, commit it and defer the rest
+	def _doReceive(self, sx12, length):
+		if length <= 4:
+			self.stats.shortPackets = self.stats.shortPackets + 1
+			sx12._event(lorastats.EVENT_SHORT_PACKET, length)
+			return # no payload, leave the slot unused
+		ring = self.rxQueue
+		slot = self._rxSlot
+		ring.rssi[slot] = sx12.readRegister(sx127x.REG_PKT_RSSI_VALUE)
+		ring.snr[slot] = sx12.readRegister(sx127x.REG_PKT_SNR_VALUE)
+		ring.commit(slot, length)
+		self._fresh = min(self._fresh + 1, ring.count)
+		if self._rxUntil is not None:
+			self._rxUntil = lorastats.ticks_add(self.ticksMs(), self._sniffListenMs) # more may follow
+		if self._wakeFlag:
+			self._wakeFlag.set()
+		if not self._deferredPending:
+			self._deferredPending = True
+			if schedule:
+				try:
+					schedule(self._deferredRef, None)
+				except RuntimeError:
+					self._deferredPending = False # schedule queue full, the next packet retries
+			else:
+				self._deferredRef(None)
+
+	# scheduled after a receive, outside of interrupt context
+	def _deferredReceive(self, arg):
+		self._deferredPending = False
+		self.stats.addLatency(lorastats.ticks_diff(lorastats.ticks_us(), self.lora.irqTicks))
+		self._bookkeep()
+		self.lora.collect_garbage()
+		if self._onReceive:
+			self._onReceive(self)
+
+	# the per packet work the receive interrupt leaves, oldest first: link
+	# statistics, adr samples, capture and the relay. Frames only heard for the
+	# relay are left in the queue with no length, readPacket skips them
+	def _bookkeep(self):
+		if self._booking:
+			return # a receive came in while it runs, the loop picks it up
+		self._booking = True
+		ring = self.rxQueue
+		reading = ring.reading
+		while self._fresh > 0:
+			slot = (ring.head + ring.count - self._fresh) % ring.depth
+			ring.reading = slot # an overflow can't overwrite it meanwhile
+			frame = ring.frames[slot]
+			length = ring.lengths[slot]
+			self.links.update(frame[1], ring.rssi[slot], ring.snr[slot]) # byte 1 is the sender
+			if self.capture:
+				self.capture.add(0, frame, length, ring.rssi[slot], ring.snr[slot], self.lora)
+			if self.adapter:
+				self.adapter.update(frame[1], ring.snr[slot])
+			if self.relay and not self.relay.heard(ring, slot, length, self.ticksMs(), self.lora):
+				ring.lengths[slot] = 0 # not for us
+			self._fresh = self._fresh - 1
+		ring.reading = reading
+		self._booking = False
+
+	# the oldest queue slot ready to read, dropping the ones left for the relay
+	def _nextSlot(self):
+		if self._fresh:
+			self._bookkeep()
+		ring = self.rxQueue
+		while ring.count > self._fresh:
+			slot = ring.peek()
+			if ring.lengths[slot]:
+				return slot
+			ring.pop()
+		return -1
+
+	def onReceive(self, callback):
+		''' set a function(loraUtil) called (outside the interrupt) when packets arrive.
+			It should readPacket or readPackets '''
+		self._onReceive = callback
+
+	# turn a queued frame into a packet
+	def _parsePacket(self, slot):
+		ring = self.rxQueue
+		pkt = self.pool.acquire()
+		# swap buffers with the queue slot rather than copy the frame
+		ring.frames[slot], pkt.buf = pkt.buf, ring.frames[slot]
+		pkt.length = ring.lengths[slot]
+		pkt.rssiRaw = ring.rssi[slot]
+		pkt.snrRaw = ring.snr[slot]
+		pkt.rssiBase = self.lora.rssiFromRaw(0)
+		pkt.skip = 0
+		return pkt
+
+	# the transmit ended, send the next queued frame or go back to receiving
 	def _doTransmit(self):
-		self.doneTransmit = True
-		self.lora.receive() # wait for a packet (?)
+		if self.hopping and self.txQueue.frames[self.txQueue.head][0] == BROADCAST and \
+				self._sweep + 1 < len(self.hopping.channels):
+			# a broadcast goes out on every home channel before it's done
+			self._sweep = self._sweep + 1
+			self._txBusy = False
+			self._startNext()
+			if not self._txBusy:
+				self._listen()
+			return
+		self._sweep = 0
+		self.txFinished = self.txFinished + self._txMessages[self.txQueue.head]
+		self.txQueue.pop()
+		self._txBusy = False
+		if self._wakeFlag:
+			self._wakeFlag.set()
+		if self.txQueue.count > 0:
+			self._startNext()
+			if not self._txBusy:
+				self._listen() # held back by the duty cycle, listen meanwhile
+		else:
+			self.doneTransmit = True
+			self._listen() # wait for a packet (?)
+
+	def _listen(self):
+		if self.hopping:
+			self._tune(self._homeChannel)
+		if self.adapter:
+			self._applyProfile(self.adapter.listen)
+		if self._sniffMs is not None:
+			self._rxUntil = lorastats.ticks_add(self.ticksMs(), self._sniffListenMs)
+		self.lora.receive()
+
+	# cad interrupt, before a send or a low power receive check
+	def _doCad(self, detected):
+		if self._sniffCad:
+			self._sniffCad = False
+			if detected:
+				self._listen() # something's coming, receive it
+				# the preamble can last for a whole interval before the packet
+				self._rxUntil = lorastats.ticks_add(self._rxUntil, self._sniffMs)
+			else:
+				self.lora.sleep()
+				self._sniffAt = lorastats.ticks_add(self._sniffAt, self._sniffMs) # no drift
+			return
+		self._txBusy = False
+		if detected:
+			# busy, wait a random time (longer each time) and look again
+			self.stats.lbtBackoffs = self.stats.lbtBackoffs + 1
+			window = min(self._lbtMs << self._lbtTries, self._lbtMaxMs)
+			self._lbtTries = min(self._lbtTries + 1, 8)
+			self._retryAt = lorastats.ticks_add(self.ticksMs(), 1 + getrandbits(16) % window)
+			self._listen() # hear what's out there meanwhile
+		else:
+			self._lbtTries = 0
+			self._channelClear = True
+			self._startNext()
+			if not self._txBusy:
+				self._listen()
+
+	# change only the settings that differ, the rest costs nothing
+	def _applyProfile(self, profile):
+		lora = self.lora
+		if profile.power != lora.txPower:
+			lora.setTxPower(profile.power, lora.txPowerPin)
+		if profile.codingRate != lora.codingRate:
+			lora.setCodingRate(profile.codingRate)
+		if profile.spreading != lora.spreading:
+			lora.setSpreadingFactor(profile.spreading)
+		if profile.bandwidth != lora.bandwidth:
+			lora.setSignalBandwidth(profile.bandwidth)
+
+	# move to a channel of the hopping plan, out of receive
+	def _tune(self, channel):
+		if channel != self._channel:
+			self.lora.standby()
+			self.lora.setFrequency(self.hopping.frequencies[channel], self.hopping.frf[channel])
+			self._channel = channel
+
+	# put a queued frame in the fifo. With a split fifo a short one goes in
+	# without leaving receive and stays there until it's sent
+	def _load(self, slot):
+		if slot != self._loaded or not self.lora._txLoaded:
+			length = self.txQueue.lengths[slot]
+			self.lora.beginPacket(False, length)
+			self.lora.write(memoryview(self.txQueue.frames[slot])[:length])
+			self._loaded = slot
+
+	# load the oldest queued frame into the fifo and start sending it
+	def _startNext(self):
+		ring = self.txQueue
+		slot = ring.peek()
+		if slot < 0 or self._txBusy or self._sniffCad:
+			return
+		if self.lora.splitFifo and ring.lengths[slot] <= sx127x.FIFO_SIZE - sx127x.FifoTxBaseAddrSplit \
+				and self.lora.isReceiving():
+			self._load(slot) # while still receiving, in case of the waits below
+		if self._retryAt is not None:
+			if lorastats.ticks_diff(self.ticksMs(), self._retryAt) < 0:
+				return # backing off from a busy channel, service() retries
+			self._retryAt = None
+		if self._budgetAt is not None:
+			if lorastats.ticks_diff(self.ticksMs(), self._budgetAt) < 0:
+				return # no airtime until then, don't touch the radio
+			self._budgetAt = None
+		if self.adapter:
+			self.lora.standby() # change settings out of receive
+			self._applyProfile(self.adapter.profileFor(ring.frames[slot][0]))
+		if self.hopping:
+			dst = ring.frames[slot][0]
+			self._tune(self.hopping.channels[self._sweep] if dst == BROADCAST else self.hopping.home[dst])
+		if self.budget:
+			airtime = self.lora.timeOnAir(ring.lengths[slot])
+			now = self.ticksMs()
+			if airtime > self.budget.budgetUs:
+				# it can never fit (the settings changed since it was queued), drop it
+				self.stats.txRejected = self.stats.txRejected + 1
+				self.txFinished = self.txFinished + self._txMessages[slot]
+				self._loaded = -1
+				self._sweep = 0
+				ring.pop()
+				if ring.count == 0:
+					self.doneTransmit = True
+				self._startNext()
+				return
+			if not self.budget.canSend(airtime, now):
+				self.stats.txDeferred = self.stats.txDeferred + 1
+				self._budgetAt = lorastats.ticks_add(now, self.budget.waitMs(airtime, now))
+				self._channelClear = False
+				self._listen()
+				return # leave it queued, service() retries
+		if self._lbtMs is not None and not self._channelClear:
+			self._txBusy = True	# until the cad is done
+			self.lora.startCad()
+			return
+		self._channelClear = False
+		if self.budget:
+			self.budget.record(airtime, now)
+		self._txBusy = True
+		try:
+			self._load(slot)
+			self._loaded = -1
+			if not self.lora.endPacket():
+				# received data ran over it, load it again out of receive
+				self.lora.beginPacket()
+				self.lora.write(memoryview(ring.frames[slot])[:ring.lengths[slot]])
+				self.lora.endPacket()
+			if self.capture:
+				self.capture.add(capture.TX, ring.frames[slot], ring.lengths[slot], 0, 0, self.lora)
+		except Exception as ex:
+			# may be in the transmit interrupt, so count it and leave the rest to the hook
+			self.stats.txErrors = self.stats.txErrors + 1
+			self.lora._event(lorastats.EVENT_TX_ERROR, ex)
+			self._loaded = -1
+			self.txFinished = self.txFinished + self._txMessages[slot]
+			self._sweep = 0
+			ring.pop() # drop it rather than wedge the queue
+			self._txBusy = False
 
 	def writeInt(self, value):
 		self.lora.write(bytearray([value]))
 
-	def sendPacket(self, dstAddress, localAddress, outGoing):
-		'''send a packet of header info and a bytearray to dstAddress
-			asynchronous. Returns immediately. '''
-		try:
+	def sendPacket(self, dstAddress, localAddress, outGoing, lineCount=None):
+		'''queue a packet of header info and a bytearray to dstAddress
+			asynchronous. Returns immediately, False if the send queue is full.
+			lineCount overrides the header counter, to resend a packet as it was '''
+		size = min(len(outGoing), sx127x.MAX_PKT_LENGTH - 4)
+		if self.budget:
+			airtime = self.lora.timeOnAir(4 + size)
+			# longer than the whole budget it would wait forever, holding up the queue
+			if airtime > self.budget.budgetUs or \
+					(self._rejectOverBudget and not self.budget.canSend(airtime, self.ticksMs())):
+				self.stats.txRejected = self.stats.txRejected + 1
+				return False
+		agg = -1
+		if self._aggFrames:
+			agg = self._aggregateFor(dstAddress, localAddress, size)
+			if agg == -2:
+				return False	# couldn't make room
+		if agg < 0:
+			slot = self._reserveTx()
+			if slot < 0:
+				return False
+		if lineCount is None:
 			self.linecounter = self.linecounter + 1
-			self.doneTransmit = False
-			self.lora.beginPacket()
-			self.writeInt(dstAddress)
-			self.writeInt(localAddress)
-			self.writeInt(self.linecounter)
-			self.writeInt(len(outGoing))
-			self.lora.write(outGoing)
-			self.lora.endPacket()
-		except Exception as ex:
-			print(str(ex))
+			lineCount = self.linecounter
+		self.doneTransmit = False
+		self.txAccepted = self.txAccepted + 1
+		if agg >= 0:
+			self._aggregate(agg, lineCount, outGoing, size)
+			return True
+		frame = self.txQueue.frames[slot]
+		frame[0] = dstAddress
+		frame[1] = localAddress
+		frame[2] = lineCount & 0xff
+		frame[3] = size
+		frame[4:4 + size] = memoryview(outGoing)[:size]
+		self._commitTx(slot, 4 + size, 1)
+		return True
+
+	def _reserveTx(self):
+		slot = self.txQueue.reserve()
+		if slot < 0:
+			self.stats.txQueueDrops = self.stats.txQueueDrops + 1
+			self.lora._event(lorastats.EVENT_TX_QUEUE_FULL, self.stats.txQueueDrops)
+		return slot
+
+	def _commitTx(self, slot, length, messages):
+		self._txMessages[slot] = messages
+		self.txQueue.commit(slot, length)
+		self._startNext()
+
+	def setAggregation(self, maxLatencyMs, maxFrameSize=sx127x.MAX_PKT_LENGTH, destinations=2):
+		''' hold messages small enough to share a frame for up to maxLatencyMs and send
+			the ones for the same destination together, in frames of at most
+			maxFrameSize bytes. destinations is how many can be filling at once.
+			maxLatencyMs None turns it off (anything waiting is sent first).
+			Both ends need this version of LoraUtil to read the frames. '''
+		self.flushAggregates()
+		if maxLatencyMs is None:
+			self._aggFrames = None
+			return
+		self.aggLatencyMs = maxLatencyMs
+		self._aggFrames = [bytearray(maxFrameSize) for i in range(destinations)]
+		self._aggFill = [0] * destinations	# bytes used, 0 when the frame is free
+		self._aggCount = [0] * destinations	# messages in the frame
+		self._aggStart = [0] * destinations	# when the first message went in
+
+	# the aggregate frame to add a message to, -1 to send it alone, -2 if the queue is full
+	def _aggregateFor(self, dstAddress, localAddress, size):
+		frames = self._aggFrames
+		agg = -1
+		for i in range(len(frames)):
+			if self._aggFill[i] and frames[i][0] == dstAddress and frames[i][1] == localAddress:
+				agg = i
+				break
+		if 6 + size > len(frames[0]):
+			# too big to share, send what's held for dstAddress first to keep the order
+			if agg >= 0 and not self._flushAggregate(agg):
+				return -2
+			return -1
+		if agg >= 0:
+			if self._aggFill[agg] + 2 + size <= len(frames[agg]):
+				return agg
+		elif 0 in self._aggFill:
+			return self._startAggregate(self._aggFill.index(0), dstAddress, localAddress)
+		else:
+			agg = self._aggCount.index(max(self._aggCount))	# send the fullest to make room
+		if not self._flushAggregate(agg):
+			return -2
+		return self._startAggregate(agg, dstAddress, localAddress)
+
+	def _startAggregate(self, i, dstAddress, localAddress):
+		frame = self._aggFrames[i]
+		frame[0] = dstAddress
+		frame[1] = localAddress
+		frame[3] = AGGREGATE
+		self._aggFill[i] = 4
+		self._aggCount[i] = 0
+		self._aggStart[i] = self.ticksMs()
+		return i
+
+	def _aggregate(self, i, lineCount, outGoing, size):
+		frame = self._aggFrames[i]
+		fill = self._aggFill[i]
+		if self._aggCount[i] == 0:
+			frame[2] = lineCount & 0xff
+		frame[fill] = lineCount & 0xff
+		frame[fill + 1] = size
+		frame[fill + 2:fill + 2 + size] = memoryview(outGoing)[:size]
+		self._aggFill[i] = fill + 2 + size
+		self._aggCount[i] = self._aggCount[i] + 1
+		if self._aggFill[i] + 3 > len(frame):
+			self._flushAggregate(i)		# nothing else fits, don't wait
+
+	# move an aggregate frame to the send queue, False if the queue is full
+	def _flushAggregate(self, i):
+		slot = self._reserveTx()
+		if slot < 0:
+			return False
+		src = self._aggFrames[i]
+		fill = self._aggFill[i]
+		frame = self.txQueue.frames[slot]
+		if self._aggCount[i] == 1:
+			# just the one, send it as a normal packet
+			frame[0:2] = src[0:2]
+			frame[2:fill - 2] = src[4:fill]
+			fill = fill - 2
+		else:
+			frame[0:fill] = src[0:fill]
+		self._commitTx(slot, fill, self._aggCount[i])
+		self._aggFill[i] = 0
+		return True
+
+	def flushAggregates(self, maxLatencyMs=0):
+		''' send the aggregate frames that have waited at least maxLatencyMs '''
+		if not self._aggFrames:
+			return
+		now = self.ticksMs()
+		for i in range(len(self._aggFrames)):
+			if self._aggFill[i] and lorastats.ticks_diff(now, self._aggStart[i]) >= maxLatencyMs:
+				self._flushAggregate(i)
+
+	def _isAggregating(self):
+		return bool(self._aggFrames) and max(self._aggFill) > 0
+
+	def sendMessage(self, dstAddress, localAddress, message):
+		''' send a message bigger than one packet as fragments. message is a
+			bytes-like object or an iterable of bytes chunks. Fragments are queued
+			as the send queue drains, call service() to keep it fed.
+			Returns the fragment.FragmentSender, its done is True once all are queued '''
+		self._messageId = (self._messageId + 1) & 0xff
+		sender = fragment.FragmentSender(self, dstAddress, localAddress, message, self._messageId)
+		if self._senders or not sender.pump():
+			self._senders.append(sender)	# behind the ones already going out
+		return sender
+
+	def setCodec(self, codec):
+		''' set the payload codec (like a codec.RecordCodec) used by sendRecord and readRecord '''
+		self.codec = codec
+		self._codecOut = bytearray(sx127x.MAX_PKT_LENGTH - 4)
+		self._codecValues = [0] * codec.size
+
+	def sendRecord(self, dstAddress, localAddress, values):
+		''' encode values with the codec and queue them like sendPacket '''
+		length = self.codec.encode(values, self._codecOut, dstAddress)
+		if self.sendPacket(dstAddress, localAddress, memoryview(self._codecOut)[:length]):
+			return True
+		self.codec.restart(dstAddress) # the receiver won't see this one, so don't send a delta to it next
+		return False
+
+	def readRecord(self, pkt, out=None):
+		''' decode a received packet with the codec. Returns out (or a list that is
+			reused by the next call) or None if the packet isn't a record it can read '''
+		if out is None:
+			out = self._codecValues
+		return out if self.codec.decode(pkt.srcAddress, pkt.payload, out, pkt.dstAddress) else None
+
+	def setAdaptive(self, adapter):
+		''' send each frame with the settings adapter (an adr.LinkAdapter) picks for
+			its destination, None to always use the current ones '''
+		if self.adapter and not self._txBusy:
+			self.lora.standby()
+			self._listen() # back to the listen settings
+		self.adapter = adapter
+
+	def setListenBeforeTalk(self, backoffMs=None, maxBackoffMs=2000):
+		''' run a cad before each frame. If the channel is busy wait a random time,
+			up to backoffMs and doubling on each busy check to maxBackoffMs, and look
+			again from service(). None turns it off '''
+		if backoffMs is not None:
+			backoffMs = max(backoffMs, 1) # the cad interrupt picks a wait in 0..backoffMs - 1
+		self._lbtMs = backoffMs
+		self._lbtMaxMs = max(maxBackoffMs, backoffMs or 1)
+		self._lbtTries = 0
+		self._retryAt = None
+
+	def setLowPowerReceive(self, intervalMs=None, listenMs=500):
+		''' sleep the radio and check for a preamble (cad) every intervalMs instead of
+			receiving all the time. After activity, a send or a packet it receives for
+			listenMs, which should be longer than a packet takes to send. service()
+			runs the checks so call it more often than intervalMs.
+			Senders need a preamble longer than intervalMs, see setWakePreamble.
+			None goes back to receiving all the time '''
+		self._sniffMs = intervalMs
+		self._sniffListenMs = listenMs
+		self._sniffAt = self.ticksMs()
+		if intervalMs is None:
+			self._rxUntil = None
+			if not self._txBusy:
+				self.lora.receive()
+
+	def setHopping(self, plan, localAddress):
+		''' listen on the home channel of localAddress (our address) in plan (a
+			hopping.ChannelPlan) and send each frame on the home channel of its
+			destination, broadcasts on all of them in turn. None goes back to the
+			frequency in use before '''
+		if plan is None:
+			if self.hopping:
+				self.hopping = None
+				self.setFrequency(self._baseFrequency) # used from the next mode change
+			return
+		if not self.hopping:
+			self._baseFrequency = self.lora._frequency
+		self.hopping = plan
+		self._homeChannel = plan.home[localAddress]
+		self._channel = -1
+		self._sweep = 0
+		if not self._txBusy:
+			self._listen()
+
+	def setCapture(self, capture):
+		''' add every frame received and sent to capture (a capture.Capture),
+			service() writes it out. None stops '''
+		self.capture = capture
+
+	def setRelay(self, relay):
+		''' send on the frames relay (a relay.Relay) says to, service() sends them.
+			It picks the packets to read instead of setAddressFilter. None stops '''
+		self.relay = relay
+		if relay:
+			self.lora.setRxFilter(self._acceptHeader, 4)
+		elif not self._accepted:
+			self.lora.setRxFilter(None)
+
+	# queue the relayed frames that are due, from service() so sendPacket
+	# never has the send queue changed under it
+	def _forward(self):
+		relay = self.relay
+		pending = relay.pending
+		now = self.ticksMs()
+		slot = relay.due(now)
+		while slot >= 0 and self.txQueue.count < self.txQueue.depth:
+			t = self.txQueue.reserve()
+			frames = self.txQueue.frames
+			frames[t], pending.frames[slot] = pending.frames[slot], frames[t]
+			length = pending.lengths[slot]
+			pending.pop()
+			relay.forwarded = relay.forwarded + 1
+			self._commitTx(t, length, 0)
+			slot = relay.due(now)
+
+	def scanChannels(self, frequencies=None, samples=8):
+		''' the rssi on each of frequencies (default the hopping plan's) as a list with
+			a dict of rssiMean, rssiMin and rssiMax (dBm) for each, see
+			SX127x.scanChannels. It takes about half a millisecond a channel, nothing is
+			received meanwhile. None if it's sending or a packet is coming in, try
+			again later '''
+		frfs = None
+		if frequencies is None:
+			if not self.hopping:
+				raise ValueError('no frequencies to scan and no hopping plan')
+			frequencies = self.hopping.frequencies
+			frfs = self.hopping.frf
+		if self._txBusy or self._sniffCad or self.lora.isSignalDetected():
+			return None
+		survey = self.lora.scanChannels(frequencies, samples, frfs=frfs)
+		self._listen()
+		return survey
+
+	def rankChannels(self, frequencies=None, samples=8):
+		''' indexes of frequencies (default the hopping plan's) from the quietest to
+			the noisiest, for hopping.ChannelPlan.useChannels. None if busy '''
+		survey = self.scanChannels(frequencies, samples)
+		if survey is None:
+			return None
+		order = list(range(len(survey)))
+		order.sort(key=lambda i: survey[i]['rssiMean'])
+		return order
+
+	def setQuietChannel(self, frequencies, intervalMs=60000, marginDb=6, onMove=None):
+		''' every intervalMs scan frequencies and move to the quietest if it's marginDb
+			quieter than the one in use (service() does it). The peers have to follow,
+			onMove(loraUtil, frequency) is called after a move so they can be told.
+			Not with hopping, see rankChannels. None stops '''
+		self._surveyFrequencies = frequencies
+		self._surveyMs = intervalMs
+		self._surveyMargin = marginDb
+		self._surveyAt = self.ticksMs()
+		self._onMove = onMove
+
+	# scan for setQuietChannel and move if it's worth it
+	def _survey(self):
+		frequencies = self._surveyFrequencies
+		survey = self.scanChannels(frequencies)
+		if survey is None:
+			return # busy, the next service() tries again
+		self._surveyAt = lorastats.ticks_add(self.ticksMs(), self._surveyMs)
+		best = 0
+		current = -1
+		for i in range(len(survey)):
+			if survey[i]['rssiMean'] < survey[best]['rssiMean']:
+				best = i
+			if abs(frequencies[i] - self.lora._frequency) < sx127x.FSTEP:
+				current = i
+		if best == current or self.hopping:
+			return
+		if current >= 0 and survey[best]['rssiMean'] + self._surveyMargin > survey[current]['rssiMean']:
+			return
+		self.lora.standby()
+		self.setFrequency(frequencies[best])
+		self._listen()
+		if self._onMove:
+			self._onMove(self, frequencies[best])
+
+	def setAddressFilter(self, address, groups=()):
+		''' only take packets sent to address, to BROADCAST or to one of groups.
+			Other packets are dropped after reading just their header in the receive
+			interrupt (counted in stats.rxFiltered). None takes everything '''
+		if address is None:
+			self._accepted = None
+			if not self.relay:
+				self.lora.setRxFilter(None)
+			return
+		accepted = bytearray(256)
+		accepted[address] = 1
+		accepted[BROADCAST] = 1
+		for group in groups:
+			accepted[group] = 1
+		self._accepted = accepted
+		self.lora.setRxFilter(self._acceptHeader, 4)
+
+	def setWakePreamble(self, intervalMs):
+		''' make the preamble long enough for a receiver checking every intervalMs
+			(see setLowPowerReceive) to catch it. Add how late its service() calls can
+			be to intervalMs. Every frame pays for it in airtime '''
+		symbolUs = (1 << self.lora.spreading) * 1000000 // self.lora.bandwidth
+		self.lora.setPreambleLength(max(8, -(-intervalMs * 1000 // symbolUs) + 8))
+
+	# low power receive: back to sleep after listening, or check for a preamble
+	def _sniff(self):
+		if self._txBusy or self._sniffCad:
+			return
+		now = self.ticksMs()
+		if self._rxUntil is not None:
+			if lorastats.ticks_diff(now, self._rxUntil) < 0 or self.lora.isSignalDetected():
+				return # still listening, or a packet is coming in
+			self._rxUntil = None
+			self.lora.sleep()
+			self._sniffAt = lorastats.ticks_add(now, self._sniffMs)
+		if lorastats.ticks_diff(now, self._sniffAt) >= 0:
+			self._sniffCad = True
+			self.lora.startCad()
+
+	def service(self):
+		''' call this regularly from the main loop. It sends packets that were
+			held back by the duty cycle limit once there is airtime for them
+			(waiting until then without touching the radio),
+			queues more fragments of messages from sendMessage and relayed frames,
+			and moves to a quieter channel if setQuietChannel says to '''
+		if self._senders:
+			# one message at a time so the fragments go out in order
+			if self._senders[0].pump():
+				self._senders.pop(0)
+		if self._aggFrames:
+			self.flushAggregates(self.aggLatencyMs)
+		if self.relay and self.relay.pending.count > 0:
+			self._forward()
+		if not self._txBusy and self.txQueue.count > 0:
+			self._startNext()
+		if self._sniffMs is not None:
+			self._sniff()
+		if self._surveyFrequencies and lorastats.ticks_diff(self.ticksMs(), self._surveyAt) >= 0:
+			self._survey()
+		if self.capture:
+			self.capture.service()
+
+	def setDutyCycle(self, dutyCycle, windowMs=3600000, reject=False):
+		''' limit transmit airtime to dutyCycle (0.01 is 1%) of any windowMs window.
+			Over the limit sends wait for service(), or fail if reject. A packet longer
+			than the whole budget always fails (counted in stats.txRejected). None
+			removes the limit '''
+		if dutyCycle is None:
+			self.budget = None
+			self._rejectOverBudget = False
+		else:
+			self.budget = dutycycle.AirtimeBudget(dutyCycle, windowMs, nowMs=self.ticksMs())
+			self._rejectOverBudget = reject
+		self._budgetAt = None
+
+	def airtimeRemaining(self):
+		''' microseconds of airtime left in the duty cycle window (None if unlimited) '''
+		return self.budget.remaining(self.ticksMs()) if self.budget else None
+
+	def timeOnAir(self, payloadLength):
+		''' microseconds on air for a packet with payloadLength bytes after the header '''
+		return self.lora.timeOnAir(4 + payloadLength)
 
 	def setFrequency(self, frequency) :
 		''' set the center frequency of the device. 902-928 for 915 band '''
+		self._channel = -1
 		self.lora.setFrequency(frequency)
 
 	def sleep(self) :
@@ -99,16 +929,74 @@ class LoraUtil:
 	def reset(self) :
 		''' reset the device '''
 		self.spic.initLoraPins() # init pins
+		self.lora.invalidateRegisters() # the reset put every register back to default
 
 	def isPacketSent(self) :
-		return self.doneTransmit
+		''' True once everything queued has been sent '''
+		return self.doneTransmit and not self._isAggregating()
 
 	def isPacketAvailable(self):
-		''' convert to bool result from none, true '''
-		return True if self.packet else False
+		''' is there at least one received packet waiting '''
+		return len(self._split) > 0 or self._nextSlot() >= 0
 
 	def readPacket(self):
-		'''return the current packet (or none) and clear it out'''
-		pkt = self.packet
-		self.packet = None
-		return pkt
+		'''return the oldest received packet (or none) and remove it from the queue'''
+		ring = self.rxQueue
+		while not self._split:
+			slot = self._nextSlot()
+			if slot < 0:
+				return None
+			ring.reading = slot # so an overflow can't overwrite it while we parse
+			pkt = self._parsePacket(slot)
+			ring.pop()
+			if pkt.buf[3] != AGGREGATE:
+				return pkt
+			self._splitAggregate(pkt)
+			pkt.release()
+		return self._split.pop(0)
+
+	# make a packet of each message in an aggregate frame
+	def _splitAggregate(self, agg):
+		buf = agg.buf
+		at = 4
+		while at + 2 <= agg.length:
+			size = buf[at + 1]
+			end = min(at + 2 + size, agg.length)
+			pkt = self.pool.acquire()
+			pkt.buf[0:2] = buf[0:2]
+			pkt.buf[2] = buf[at]
+			pkt.buf[3] = end - at - 2
+			pkt.buf[4:4 + end - at - 2] = buf[at + 2:end]
+			pkt.length = 4 + end - at - 2
+			pkt.rssiRaw = agg.rssiRaw
+			pkt.snrRaw = agg.snrRaw
+			pkt.rssiBase = agg.rssiBase
+			pkt.skip = 0
+			self._split.append(pkt)
+			at = end
+
+	def readPackets(self, maxCount=0):
+		'''drain the receive queue. Returns a list of up to maxCount packets (0 is all)'''
+		packets = []
+		while self.isPacketAvailable() and (maxCount == 0 or len(packets) < maxCount):
+			pkt = self.readPacket()
+			if pkt:
+				packets.append(pkt)
+		return packets
+
+	def rxOverflows(self):
+		''' the number of received packets dropped because the queue was full '''
+		return self.rxQueue.overflows
+
+	def setWakeFlag(self, flag):
+		''' flag.set() gets called from the interrupt when a packet arrives or a
+			send finishes. Use an asyncio.ThreadSafeFlag to wake an event loop '''
+		self._wakeFlag = flag
+
+	def onEvent(self, callback):
+		''' set a hook(sx127x, event, value) for the lorastats.EVENT_ errors and drops '''
+		self.lora.onEvent(callback)
+
+	def linkStats(self, address):
+		''' rssi/snr statistics for packets from address, or None '''
+		return self.links.get(address, self.lora)
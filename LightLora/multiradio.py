@@ -0,0 +1,122 @@
+''' several radios on one host used as one, like a gateway listening on a few
+channels or spreading factors at once.
+
+Each radio is a LoraUtil with its own spicontrol.SpiControl (chip select, reset
+and DIO0 pins), all on one spicontrol.SpiBus:
+
+	bus = spicontrol.SpiBus()
+	radios = [lorautil.LoraUtil(spiControl=spicontrol.SpiControl(bus, cs=27, reset=33, dio0=12)),
+			  lorautil.LoraUtil(spiControl=spicontrol.SpiControl(bus, cs=15, reset=32, dio0=14))]
+	radios[1].setFrequency(916e6)
+	group = multiradio.RadioGroup(radios)
+	group.sendPacket(0x42, 0x01, b'hi')
+	group.service()				# in the main loop
+	pkt = group.readPacket()	# from whichever radio heard something, release() it when done
+
+A packet to an address goes out on the radio that last heard from that address,
+so it's sent with the settings the peer listens on. Other packets go to the radio
+with the least waiting to send. Broadcasts go out on every radio. Received packets
+are read from the radios in turn so a busy one can't starve the others.
+'''
+
+BROADCAST = 0xff
+
+class RadioGroup:
+	''' sends through and receives from a list of LoraUtils. The header line counter is
+		shared so sequence numbers from this host stay in order whichever radio sends.
+		lastRadio is the index of the radio the last packet read came from. '''
+	def __init__(self, radios):
+		self.radios = radios
+		self.linecounter = 0
+		self.lastRadio = -1
+		self.routes = bytearray(256)	# radio index + 1 that last heard each address, 0 unknown
+		self._next = 0					# radio to read from first
+		self._onReceive = None
+
+	# the radio with the fewest frames waiting, counting the one on the air
+	def _leastLoaded(self):
+		best = -1
+		load = 0
+		for i in range(len(self.radios)):
+			radio = self.radios[i]
+			count = radio.txQueue.count + (1 if radio._txBusy else 0)
+			if best < 0 or count < load:
+				best = i
+				load = count
+		return best
+
+	def sendPacket(self, dstAddress, localAddress, outGoing, lineCount=None):
+		''' queue a packet on the radio for dstAddress. Returns False if that radio
+			refused it (see LoraUtil.sendPacket) '''
+		if lineCount is None:
+			self.linecounter = self.linecounter + 1
+			lineCount = self.linecounter
+		if dstAddress == BROADCAST:
+			sent = False
+			for radio in self.radios:
+				if radio.sendPacket(dstAddress, localAddress, outGoing, lineCount):
+					sent = True
+			return sent
+		i = self.routes[dstAddress] - 1
+		if i < 0:
+			i = self._leastLoaded()
+		return self.radios[i].sendPacket(dstAddress, localAddress, outGoing, lineCount)
+
+	def service(self):
+		''' call regularly from the main loop, services every radio '''
+		for radio in self.radios:
+			radio.service()
+
+	def isPacketAvailable(self):
+		for radio in self.radios:
+			if radio.isPacketAvailable():
+				return True
+		return False
+
+	def readPacket(self):
+		''' the next received packet from any radio (or None), taking them in turn '''
+		count = len(self.radios)
+		for k in range(count):
+			i = (self._next + k) % count
+			pkt = self.radios[i].readPacket()
+			if pkt:
+				self._next = (i + 1) % count
+				self.lastRadio = i
+				self.routes[pkt.srcAddress] = i + 1
+				return pkt
+		return None
+
+	def readPackets(self, maxCount=0):
+		''' every received packet (up to maxCount, 0 is all), merged from the radios '''
+		packets = []
+		while maxCount == 0 or len(packets) < maxCount:
+			pkt = self.readPacket()
+			if not pkt:
+				break
+			packets.append(pkt)
+		return packets
+
+	def isPacketSent(self):
+		''' True once every radio has sent everything queued '''
+		for radio in self.radios:
+			if radio.txFinished != radio.txAccepted:
+				return False
+		return True
+
+	def _received(self, loraUtil):
+		self._onReceive(self)
+
+	def onReceive(self, callback):
+		''' set a function(radioGroup) called when any of the radios receives '''
+		self._onReceive = callback
+		for radio in self.radios:
+			radio.onReceive(self._received if callback else None)
+
+	def setWakeFlag(self, flag):
+		''' the flag is set() by any of the radios, see LoraUtil.setWakeFlag '''
+		for radio in self.radios:
+			radio.setWakeFlag(flag)
+
+	def forget(self, address):
+		''' send to address on the least loaded radio until it's heard again '''
+		self.routes[address] = 0
@@ -0,0 +1,145 @@
+''' store and forward: send on the frames heard for other nodes, for coverage past
+the range of one radio.
+
+	rl = relay.Relay(0x41, maxHops=3)
+	lru.setRelay(rl)
+	...
+	lru.service()		# in the main loop, it sends the frames that are due
+
+A frame sent to another address is kept and sent again after a random delay, a
+whole number of its airtimes, so relays that heard the same frame don't all
+answer at once. Broadcasts and frames to one of groups are read and sent on,
+frames to address are only read. Each relay adds one to a hop count in a
+trailer byte after the payload (receivers don't see it in the payload, see
+LoraPacket.hops) and doesn't send on frames that have made maxHops hops.
+Aggregates and frames with no room left for the trailer aren't sent on.
+
+Every node that can hear relayed frames should run a Relay, maxHops=0 just drops
+the copies without sending anything. A frame is known by its sender and line
+count, those heard in the last holdMs are in a small cache with the hop count
+they came with. A copy with more hops is an echo from a relay further on and
+is dropped, so is one that comes while other relays could still be sending on
+the same frame. One with as few hops after that is the sender resending it
+(like reliable.py does when an ack doesn't come), so it's read and sent on again.
+The receive interrupt only reads the frames worth reading (acceptHeader), the
+deferred receive stage hands the frame buffer over without copying it and
+service() moves it to the send queue.
+'''
+try:
+	from random import getrandbits
+except ImportError:
+	from urandom import getrandbits
+from LightLora import sx127x, loraqueue, lorastats
+
+BROADCAST = 0xff
+AGGREGATE = 0xff	# payload length byte of an aggregate frame, see LoraUtil.setAggregation
+WAYS = 4			# cache entries a frame can go in
+
+DELIVER = 1			# mine[] values: read it
+FORWARD = 2			# send it on
+
+class Relay:
+	''' sends on frames for other addresses, up to depth waiting at once. cacheSize
+		(a multiple of WAYS) frames are remembered for holdMs. The delay is minDelayMs
+		and 0 to slots - 1 slots, a slot is the airtime of the frame and minDelayMs.
+		minDelayMs should cover how late service() can be. forwarded, duplicates,
+		expired (out of hops) and dropped (no room) count frames. '''
+	def __init__(self, address, groups=(), maxHops=3, depth=4, cacheSize=32, holdMs=3000,
+				 minDelayMs=20, slots=4):
+		self.address = address
+		self.maxHops = maxHops
+		self.holdMs = holdMs
+		self.minDelayMs = minDelayMs
+		self.slots = max(slots, 1)
+		self.mine = bytearray(256)
+		self.mine[address] = DELIVER
+		self.mine[BROADCAST] = DELIVER | FORWARD
+		for group in groups:
+			self.mine[group] = DELIVER | FORWARD
+		self.pending = loraqueue.FrameRing(depth, policy=loraqueue.DROP_NEWEST)
+		self._due = [0] * depth			# when each pending frame goes (ticks ms)
+		self._sets = max(cacheSize // WAYS, 1)
+		self._keys = [-1] * (self._sets * WAYS)	# sender << 8 | line count, -1 unused
+		self._times = [0] * (self._sets * WAYS)
+		self._hops = bytearray(self._sets * WAYS)	# hops of the copy taken
+		self.forwarded = 0
+		self.duplicates = 0
+		self.expired = 0
+		self.dropped = 0
+
+	# is the frame a copy of one heard in the last holdMs: with fewer hops (an echo),
+	# or within spreadMs a hop of it (another relay's)? If not remember it, in place
+	# of the oldest entry of its set
+	def _echo(self, key, now, hops, spreadMs):
+		keys = self._keys
+		times = self._times
+		start = ((key >> 8) * 7 + key) % self._sets * WAYS
+		oldest = start
+		for i in range(start, start + WAYS):
+			if keys[i] < 0:
+				oldest = i
+				break
+			if keys[i] == key:
+				age = lorastats.ticks_diff(now, times[i])
+				if age < self.holdMs and (hops > self._hops[i] or age < hops * spreadMs):
+					return True
+				oldest = i
+				break
+			if lorastats.ticks_diff(times[i], times[oldest]) < 0:
+				oldest = i
+		keys[oldest] = key
+		times[oldest] = now
+		self._hops[oldest] = hops
+		return False
+
+	def acceptHeader(self, header, now):
+		''' receive interrupt: is the frame worth reading? Duplicates are read,
+			heard() drops them outside the interrupt '''
+		if header[1] == self.address:
+			return False		# our own, sent on by a relay
+		return self.mine[header[0]] != 0 or self.maxHops > 0
+
+	def heard(self, ring, slot, length, now, sx12):
+		''' after a receive, outside the interrupt: length bytes are in slot of ring
+			(a loraqueue.FrameRing). Keep it to send on if it should be, sx12 times it.
+			Returns True if it should be read too '''
+		frame = ring.frames[slot]
+		if frame[1] == self.address:
+			return False
+		action = self.mine[frame[0]]
+		size = frame[3]
+		at = 4 + size
+		hops = frame[at] if size != AGGREGATE and length > at else 0
+		# relays send on within this of hearing a frame, copies come that much apart a hop
+		slotMs = sx12.timeOnAir(length + 1) // 1000 + self.minDelayMs
+		spreadMs = self.minDelayMs + (self.slots - 1) * slotMs
+		if self._echo(frame[1] << 8 | frame[2], now, hops, spreadMs):
+			self.duplicates = self.duplicates + 1
+			return False
+		if action == DELIVER or self.maxHops == 0:
+			return action != 0
+		if hops >= self.maxHops or size == AGGREGATE or at >= sx127x.MAX_PKT_LENGTH:
+			self.expired = self.expired + 1
+			return action != 0
+		pending = self.pending
+		p = pending.reserve()
+		if p < 0:
+			self.dropped = self.dropped + 1
+			return action != 0
+		if action:
+			pending.frames[p][0:at] = memoryview(frame)[0:at] # it's read as well
+		else:
+			# hand the buffer over rather than copy the frame
+			pending.frames[p], ring.frames[slot] = frame, pending.frames[p]
+		pending.frames[p][at] = hops + 1
+		slotMs = sx12.timeOnAir(at + 1) // 1000 + self.minDelayMs
+		self._due[p] = lorastats.ticks_add(now, self.minDelayMs + getrandbits(8) % self.slots * slotMs)
+		pending.commit(p, at + 1)
+		return action != 0
+
+	def due(self, now):
+		''' the pending slot to send now, or -1 '''
+		slot = self.pending.peek()
+		if slot >= 0 and lorastats.ticks_diff(now, self._due[slot]) >= 0:
+			return slot
+		return -1
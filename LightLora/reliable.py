@@ -0,0 +1,265 @@
+''' reliable delivery on top of LoraUtil: acks, retries and a sliding window.
+
+The LoraUtil header line count is the sequence number. Reliable frames start
+their payload with one kind byte:
+	KIND_DATA, data...			wants an ack from the destination (none for broadcast)
+	KIND_ACK, sequence, bits	acks sequence, and sequence-1-i for each bit i set
+Several frames can be waiting for acks at once (window). They go out back to
+back, so the receiver holds its ack for about a frame time and acks the whole
+burst at once instead of talking over the sender. Retransmit timeouts come
+from the time on air of the frames and the ack, doubling on each retry. Every
+copy received is acked but each sequence number is handed up once. With
+LoraUtil.setAdaptive a timeout is reported to the adapter (noteLoss), so the
+resend goes out with the listen settings instead of a profile that stopped
+working. Both ends have to use a ReliableLink.
+
+	link = reliable.ReliableLink(lorautil.LoraUtil(), 0x41)
+	link.send(0x42, b'important')	# None if the window is full
+	...
+	link.service()					# in the main loop: acks, retries, receiving
+	pkt = link.readPacket()
+'''
+from LightLora import lorastats, sx127x
+
+KIND_DATA = 0x01
+KIND_ACK = 0x02
+
+BROADCAST = 0xff
+
+# how far back duplicate detection remembers, in sequence numbers
+HISTORY = 24
+
+class DuplicateFilter:
+	''' remembers the recent sequence numbers from each source in fixed memory '''
+	def __init__(self, sources=8):
+		self.addresses = bytearray(sources)
+		self.last = bytearray(sources)	# newest sequence from each source
+		self.seen = [0] * sources		# bit i set: last - 1 - i was received
+		self.lastUsed = [0] * sources
+		self.used = 0
+		self._clock = 0
+
+	def isDuplicate(self, address, seq):
+		''' True if seq from address was already seen. Records it if not '''
+		self._clock = self._clock + 1
+		i = -1
+		for j in range(self.used):
+			if self.addresses[j] == address:
+				i = j
+				break
+		if i < 0:
+			if self.used < len(self.addresses):
+				i = self.used
+				self.used = self.used + 1
+			else:
+				i = self.lastUsed.index(min(self.lastUsed)) # replace the quietest source
+			self.addresses[i] = address
+			self.last[i] = seq
+			self.seen[i] = 0
+			self.lastUsed[i] = self._clock
+			return False
+		self.lastUsed[i] = self._clock
+		back = (self.last[i] - seq) & 0xff
+		if back == 0:
+			return True
+		if back < 128:
+			# older than the newest
+			if back > HISTORY:
+				return True		# too old to be anything but a late copy
+			bit = 1 << (back - 1)
+			if self.seen[i] & bit:
+				return True
+			self.seen[i] = self.seen[i] | bit
+			return False
+		# newer, slide the history along
+		ahead = 256 - back
+		seen = (self.seen[i] << ahead) | (1 << (ahead - 1)) if ahead <= HISTORY else 0
+		self.seen[i] = seen & ((1 << HISTORY) - 1)
+		self.last[i] = seq
+		return False
+
+	def history(self, address):
+		''' (newest sequence, bits for the 8 before it) seen from address '''
+		for i in range(self.used):
+			if self.addresses[i] == address:
+				return self.last[i], self.seen[i] & 0xff
+		return 0, 0
+
+class ReliableLink:
+	''' acked delivery for a LoraUtil. window is how many frames can wait for an ack,
+		retries how many times one is resent before giving up. onResult(dst, seq, ok)
+		is called when a frame is acked or given up on. ackDrops counts acks not sent
+		because the held ones filled the table and the send queue was full, the
+		sender resends then and gets its ack for that. '''
+	def __init__(self, loraUtil, localAddress, window=4, retries=3, marginMs=50, inboxSize=4,
+				 onResult=None):
+		self.lu = loraUtil
+		self.localAddress = localAddress
+		self.retries = retries
+		self.marginMs = marginMs	# turnaround allowance on top of the airtimes
+		self.onResult = onResult
+		size = sx127x.MAX_PKT_LENGTH - 4
+		self._frames = [bytearray(size) for i in range(window)]
+		self._lengths = [0] * window		# 0 when the slot is free
+		self._dst = bytearray(window)
+		self._seq = bytearray(window)
+		self._deadline = [0] * window
+		self._tries = bytearray(window)
+		self._ack = bytearray(3)
+		self._ack[0] = KIND_ACK
+		# acks being held back, one per source
+		self._ackAddress = bytearray(window)
+		self._ackDue = [0] * window
+		self._ackPending = bytearray(window)
+		self._inbox = []
+		self.inboxSize = inboxSize
+		self.duplicates = DuplicateFilter()
+		self.acked = 0
+		self.failed = 0
+		self.retransmits = 0
+		self.duplicateCount = 0
+		self.ackDrops = 0
+
+	def inFlight(self):
+		''' the number of frames waiting for an ack '''
+		return len(self._lengths) - self._lengths.count(0)
+
+	def _timeoutMs(self, length, waiting, tries):
+		# our frame and the ones queued ahead of it, the ack hold back (a frame
+		# time), the ack itself and some turnaround, backing off on each retry
+		frameMs = self.lu.timeOnAir(length) // 1000
+		ackMs = self.lu.timeOnAir(3) // 1000
+		return (frameMs * (waiting + 2) + ackMs + 2 * self.marginMs) << tries
+
+	def send(self, dstAddress, payload):
+		''' send payload to dstAddress, resending until it's acked. Broadcasts are
+			sent once. Returns the sequence number or None if the window is full '''
+		size = min(len(payload), sx127x.MAX_PKT_LENGTH - 5)
+		if dstAddress == BROADCAST:
+			frame = bytearray(1 + size)
+			frame[0] = KIND_DATA
+			frame[1:] = memoryview(payload)[:size]
+			return self.lu.linecounter & 0xff if self.lu.sendPacket(dstAddress, self.localAddress, frame) else None
+		if 0 not in self._lengths:
+			return None
+		i = self._lengths.index(0)
+		frame = self._frames[i]
+		frame[0] = KIND_DATA
+		frame[1:1 + size] = memoryview(payload)[:size]
+		seq = (self.lu.linecounter + 1) & 0xff
+		if not self.lu.sendPacket(dstAddress, self.localAddress, memoryview(frame)[:1 + size], seq):
+			return None
+		self.lu.linecounter = self.lu.linecounter + 1
+		self._lengths[i] = 1 + size
+		self._dst[i] = dstAddress
+		self._seq[i] = seq
+		self._tries[i] = 0
+		deadline = lorastats.ticks_add(self.lu.ticksMs(), self._timeoutMs(1 + size, self.lu.txQueue.count, 0))
+		self._deadline[i] = deadline
+		# this one holds back the ack for the earlier frames to dstAddress too
+		for j in range(len(self._lengths)):
+			if self._lengths[j] and self._dst[j] == dstAddress and lorastats.ticks_diff(deadline, self._deadline[j]) > 0:
+				self._deadline[j] = deadline
+		return seq
+
+	def _finish(self, i, ok):
+		self._lengths[i] = 0
+		if ok:
+			self.acked = self.acked + 1
+		else:
+			self.failed = self.failed + 1
+		if self.onResult:
+			self.onResult(self._dst[i], self._seq[i], ok)
+
+	def _handle(self, pkt):
+		''' process a received packet, returns True if it goes to the inbox '''
+		payload = pkt.payload
+		dst = pkt.dstAddress
+		if len(payload) == 0 or (dst != self.localAddress and dst != BROADCAST):
+			return False
+		kind = payload[0]
+		if kind == KIND_ACK:
+			if len(payload) >= 3:
+				seq = payload[1]
+				bits = payload[2]
+				for i in range(len(self._lengths)):
+					if self._lengths[i] and self._dst[i] == pkt.srcAddress:
+						back = (seq - self._seq[i]) & 0xff
+						if back == 0 or (back <= 8 and bits & (1 << (back - 1))):
+							self._finish(i, True)
+			return False
+		if kind != KIND_DATA:
+			return True		# not ours, pass it along untouched
+		pkt.skip = 1
+		duplicate = self.duplicates.isDuplicate(pkt.srcAddress, pkt.srcLineCount)
+		if dst != BROADCAST:
+			# wait about a frame time in case more of a burst is coming
+			self._holdAck(pkt.srcAddress, self.lu.timeOnAir(pkt.length - 4) // 1000 + self.marginMs)
+		if duplicate:
+			self.duplicateCount = self.duplicateCount + 1
+			return False
+		return True
+
+	def _holdAck(self, address, delayMs):
+		due = lorastats.ticks_add(self.lu.ticksMs(), delayMs)
+		free = -1
+		for i in range(len(self._ackPending)):
+			if self._ackPending[i] and self._ackAddress[i] == address:
+				self._ackDue[i] = due	# more arrived, push it back
+				return
+			if free < 0 and not self._ackPending[i]:
+				free = i
+		if free < 0:
+			# table full, send the one due first early
+			free = 0
+			for i in range(1, len(self._ackDue)):
+				if lorastats.ticks_diff(self._ackDue[i], self._ackDue[free]) < 0:
+					free = i
+			self._sendAck(free)
+			if self._ackPending[free]:
+				self.ackDrops = self.ackDrops + 1 # the send queue is full, keep the one held
+				return
+		self._ackAddress[free] = address
+		self._ackDue[free] = due
+		self._ackPending[free] = 1
+
+	def _sendAck(self, i):
+		address = self._ackAddress[i]
+		self._ack[1], self._ack[2] = self.duplicates.history(address)
+		if self.lu.sendPacket(address, self.localAddress, self._ack):
+			self._ackPending[i] = 0
+
+	def service(self):
+		''' call regularly. Handles received packets and acks and resends overdue frames '''
+		self.lu.service()
+		while self.lu.isPacketAvailable():
+			pkt = self.lu.readPacket()
+			if self._handle(pkt):
+				if len(self._inbox) >= self.inboxSize:
+					self._inbox.pop(0).release()
+				self._inbox.append(pkt)
+			else:
+				pkt.release()
+		now = self.lu.ticksMs()
+		for i in range(len(self._ackPending)):
+			if self._ackPending[i] and lorastats.ticks_diff(now, self._ackDue[i]) >= 0:
+				self._sendAck(i)
+		for i in range(len(self._lengths)):
+			if self._lengths[i] and lorastats.ticks_diff(now, self._deadline[i]) >= 0:
+				if self.lu.adapter:
+					self.lu.adapter.noteLoss(self._dst[i]) # resend with the listen settings
+				if self._tries[i] >= self.retries:
+					self._finish(i, False)
+				elif self.lu.sendPacket(self._dst[i], self.localAddress,
+										memoryview(self._frames[i])[:self._lengths[i]], self._seq[i]):
+					self._tries[i] = self._tries[i] + 1
+					self.retransmits = self.retransmits + 1
+					self._deadline[i] = lorastats.ticks_add(now, self._timeoutMs(self._lengths[i],
+															self.lu.txQueue.count, self._tries[i]))
+
+	def isPacketAvailable(self):
+		return len(self._inbox) > 0
+
+	def readPacket(self):
+		''' the oldest new data packet (or None). release() it when done '''
+		return self._inbox.pop(0) if self._inbox else None
@@ -1,5 +1,8 @@
 from time import sleep
-from machine import Pin, SPI
+try:
+	from machine import Pin, SPI
+except ImportError:
+	Pin = SPI = None	# not micropython, pass SpiBus an spi and SpiControl pin objects
 
 ''' Pin assignments for SPI and LoRa board
 	This refers to a Feather ESP32 Wroom board using
@@ -17,37 +20,144 @@ PIN_ID_LORA_DIO0 = 12
 #PIN_ID_MOSI = 27
 #PIN_ID_MISO = 19
 #PIN_ID_LORA_DIO0 = 26
+SPI_BUS_ID = 1
+SPI_BAUDRATE = 5000000
 
 # loraconfig is the project definition for pins <-> hardware
 
+class IrqGuard:
+	''' stands in for a DIO0 handler. If the pin interrupt comes in the middle of
+		a transfer on the bus the handler is held and the bus runs it when the
+		transfer is done, so it can't start one of its own over it '''
+	__slots__ = ('bus', 'handler', 'pending', 'source')
+
+	def __init__(self, bus, handler):
+		self.bus = bus
+		self.handler = handler
+		self.pending = False
+		self.source = None
+
+	def __call__(self, source):
+		if self.bus.busy:
+			self.source = source
+			self.pending = True
+			self.bus.held = True
+		else:
+			self.handler(source)
+
+class SpiBus:
+	''' an spi bus that any number of radios can share, each with its own chip select.
+		busy is set during a transfer. The DIO0 handlers are wrapped in IrqGuards
+		(see guard) so one that comes in during a transfer waits for its end
+		rather than talking over it. That needs soft pin interrupts, the default.
+		spi is an already made machine.SPI (or stand in) to use instead of the pins '''
+	def __init__(self, busId=SPI_BUS_ID, sck=PIN_ID_SCK, mosi=PIN_ID_MOSI, miso=PIN_ID_MISO,
+				 baudrate=SPI_BAUDRATE, spi=None):
+		if spi is None:
+			spi = SPI(busId, baudrate=baudrate, polarity=0, phase=0, bits=8,
+					 firstbit=SPI.MSB,
+					 sck=Pin(sck, Pin.OUT),
+					 mosi=Pin(mosi, Pin.OUT),
+					 miso=Pin(miso, Pin.IN))
+		self.spi = spi
+		self.busy = False
+		self.held = False		# a guarded handler is waiting for the transfer to end
+		self._guards = []
+
+	def guard(self, handler):
+		''' an IrqGuard for handler, to attach to a DIO0 pin in its place '''
+		guard = IrqGuard(self, handler)
+		self._guards.append(guard)
+		return guard
+
+	def begin(self, pinss):
+		''' select a radio for a transfer '''
+		self.busy = True
+		pinss.value(0)
+
+	def end(self, pinss):
+		''' deselect it and run any handler held meanwhile '''
+		pinss.value(1)
+		self.busy = False
+		if self.held:
+			self.held = False
+			for guard in self._guards:
+				if guard.pending:
+					guard.pending = False
+					guard.handler(guard.source)
+
+_defaultBus = None
+
+def defaultBus():
+	''' the bus on the PIN_ID_ pins, made the first time it's asked for '''
+	global _defaultBus
+	if _defaultBus is None:
+		_defaultBus = SpiBus()
+	return _defaultBus
+
 class SpiControl:
-	''' simple higher level spi stuff '''
-	def __init__(self):
-		self.spi = SPI(1, baudrate=5000000, polarity=0, phase=0, bits=8,
-				 firstbit=SPI.MSB,
-				 sck=Pin(PIN_ID_SCK, Pin.OUT),
-				 mosi=Pin(PIN_ID_MOSI, Pin.OUT),
-				 miso=Pin(PIN_ID_MISO, Pin.IN))
-		self.pinss = Pin(PIN_ID_LORA_SS, Pin.OUT)
-		self.pinrst = Pin(PIN_ID_LORA_RESET, Pin.OUT)
+	''' simple higher level spi stuff for one radio. bus is the SpiBus it shares
+		(defaultBus() if None), cs, reset and dio0 are its pin numbers (or pin objects).
+		Make one per radio. '''
+	def __init__(self, bus=None, cs=PIN_ID_LORA_SS, reset=PIN_ID_LORA_RESET, dio0=PIN_ID_LORA_DIO0):
+		self.bus = bus or defaultBus()
+		self.spi = self.bus.spi
+		self.pinss = Pin(cs, Pin.OUT) if isinstance(cs, int) else cs
+		self.pinss.value(1)		# deselected, the other radios on the bus may be talking
+		self.pinrst = Pin(reset, Pin.OUT) if isinstance(reset, int) else reset
+		self.dio0 = dio0
+		self._address = bytearray(1)	# preallocated so transfers don't allocate
+		self._value = bytearray(1)
+		self._response = bytearray(1)
 
 	# sx127x transfer is always write two bytes while reading the second byte
 	# a read doesn't write the second byte. a write returns the prior value.
 	# write register # = 0x80 | read register #
+	# the returned response buffer is reused by the next transfer. This doesn't
+	# allocate so it can run in an interrupt handler
 	def transfer(self, address, value=0x00):
-		response = bytearray(1)
-		self.pinss.value(0)					 # hold chip select low
-		self.spi.write(bytearray([address])) # write register address
-		self.spi.write_readinto(bytearray([value]), response) # write or read register walue
-		self.pinss.value(1)
+		response = self._response
+		self._address[0] = address
+		self._value[0] = value & 0xff
+		self.bus.begin(self.pinss)			 # hold chip select low
+		self.spi.write(self._address)		 # write register address
+		self.spi.write_readinto(self._value, response) # write or read register walue
+		value = response[0]
+		self.bus.end(self.pinss)			 # may run a held handler, which reuses response
+		response[0] = value
 		return response
 
+	# the sx127x auto-increments the register address during a burst, except for
+	# the fifo (register 0) where it moves the fifo pointer instead. So one chip
+	# select transaction can move an entire payload.
+	def burstWrite(self, address, buffer):
+		''' write all of buffer (bytearray or memoryview) starting at address.
+			address is the raw register # (0x80 | register for a write) '''
+		self._address[0] = address
+		self.bus.begin(self.pinss)
+		self.spi.write(self._address)
+		self.spi.write(buffer)
+		self.bus.end(self.pinss)
+
+	def burstRead(self, address, buffer):
+		''' fill buffer (bytearray or memoryview) reading from address in one transaction '''
+		self._address[0] = address
+		self.bus.begin(self.pinss)
+		self.spi.write(self._address)
+		self.spi.readinto(buffer, 0)
+		self.bus.end(self.pinss)
+		return buffer
+
 	# this doesn't belong here but it doesn't really belong anywhere, so put
 	# it with the other loraconfig-ed stuff
 	def getIrqPin(self):
-		irqPin = Pin(PIN_ID_LORA_DIO0, Pin.IN)
+		irqPin = Pin(self.dio0, Pin.IN) if isinstance(self.dio0, int) else self.dio0
 		return irqPin
 
+	def guard(self, handler):
+		''' handler wrapped so it doesn't run in the middle of a transfer on the bus '''
+		return self.bus.guard(handler)
+
 	# this doesn't belong here but it doesn't really belong anywhere, so put
 	# it with the other loraconfig-ed stuff
 	def initLoraPins(self):
@@ -8,11 +8,26 @@ Call onReceive and onTransmit to define the interrupt handlers.
 
 Communications is handled by an SpiControl object wrapping SPI
 
+To receive without a new buffer per packet call onReceiveInto with a function
+that hands out a preallocated buffer. The handler reads the payload straight
+into it and the callback just gets the length. The handlers still make small
+allocations (memoryview slices and the like), so DIO0 must be a soft pin
+interrupt, the MicroPython default. Don't attach them with hard=True.
+
+Errors seen in the interrupt handlers are counted in self.stats (a
+lorastats.RadioStats) and passed to an optional onEvent hook instead of
+being printed. lorastats.printEvent prints them like before.
+
+Garbage collection is a policy set by the gc_policy parameter:
+	GC_NEVER - the application collects
+	GC_ALWAYS - collect after every packet read and transmit done (the old default)
+	GC_LOW_MEMORY - collect only when free memory drops below gc_threshold
+
 
 '''
 import gc
 import _thread
-from machine import Pin
+from LightLora import lorastats
 
 PA_OUTPUT_RFO_PIN = 0
 PA_OUTPUT_PA_BOOST_PIN = 1
@@ -24,13 +39,15 @@ REG_FRF_MSB = 0x06
 REG_FRF_MID = 0x07
 REG_FRF_LSB = 0x08
 REG_PA_CONFIG = 0x09
+REG_PA_RAMP = 0x0a
 REG_OCP = 0x0b # overcurrent protection
 REG_LNA = 0x0c
 REG_FIFO_ADDR_PTR = 0x0d
 
 REG_FIFO_TX_BASE_ADDR = 0x0e
 FifoTxBaseAddr = 0x00
-# FifoTxBaseAddr = 0x80
+FifoTxBaseAddrSplit = 0x80	# with split_fifo the top half is for transmit
+FIFO_SIZE = 256
 
 REG_FIFO_RX_BASE_ADDR = 0x0f
 FifoRxBaseAddr = 0x00
@@ -38,13 +55,18 @@ REG_FIFO_RX_CURRENT_ADDR = 0x10
 REG_IRQ_FLAGS_MASK = 0x11
 REG_IRQ_FLAGS = 0x12
 REG_RX_NB_BYTES = 0x13
+REG_MODEM_STAT = 0x18
+REG_PKT_SNR_VALUE = 0x19
 REG_PKT_RSSI_VALUE = 0x1a
-REG_PKT_SNR_VALUE = 0x1b
+REG_RSSI_VALUE = 0x1b
 REG_MODEM_CONFIG_1 = 0x1d
 REG_MODEM_CONFIG_2 = 0x1e
 REG_PREAMBLE_MSB = 0x20
 REG_PREAMBLE_LSB = 0x21
+REG_SYMB_TIMEOUT_LSB = 0x1f
 REG_PAYLOAD_LENGTH = 0x22
+REG_MAX_PAYLOAD_LENGTH = 0x23
+REG_HOP_PERIOD = 0x24
 REG_FIFO_RX_BYTE_ADDR = 0x25
 REG_MODEM_CONFIG_3 = 0x26
 REG_RSSI_WIDEBAND = 0x2c
@@ -65,6 +87,7 @@ MODE_RX_CONTINUOUS = 0x05
 # MODE_RX_SINGLE = 0x06
 # 6 is not supported on the 1276
 MODE_RX_SINGLE = 0x05
+MODE_CAD = 0x07
 
 # PA config
 PA_BOOST = 0x80
@@ -77,18 +100,136 @@ IRQ_TX_DONE_MASK = 0x08
 IRQ_PAYLOAD_CRC_ERROR_MASK = 0x20
 IRQ_RX_DONE_MASK = 0x40
 IRQ_RX_TIME_OUT_MASK = 0x80
+IRQ_CAD_DONE_MASK = 0x04
+IRQ_CAD_DETECTED_MASK = 0x01
+
+# modem status bits
+MODEM_STAT_SIGNAL_DETECTED = 0x01
 
 # Buffer size
 MAX_PKT_LENGTH = 255
 
+# garbage collection policies
+GC_NEVER = 0
+GC_ALWAYS = 1
+GC_LOW_MEMORY = 2
+
+# configuration registers only the driver changes, so they can be shadowed in ram.
+# OP_MODE is included for reads, the chip leaves TX on its own so mode writes always go out.
+# FIFO, IRQ_FLAGS, RX_NB_BYTES and the RSSI/SNR values are volatile and never shadowed.
+SHADOWED_REGISTERS = (REG_OP_MODE, REG_PA_CONFIG, REG_OCP, REG_LNA, REG_MODEM_CONFIG_1,
+					  REG_MODEM_CONFIG_2, REG_MODEM_CONFIG_3, REG_DIO_MAPPING_1, REG_PA_DAC,
+					  REG_DETECTION_OPTIMIZE, REG_DETECTION_THRESHOLD)
+
 # pass in non-default parameters for any/all options in the constructor parameters argument
 DEFAULT_PARAMETERS = {'frequency': 915E6, 'tx_power_level': 2, 'signal_bandwidth': 125000,
 					  'spreading_factor': 7, 'coding_rate': 5, 'preamble_length': 8,
 					  'power_pin' : PA_OUTPUT_PA_BOOST_PIN,
-					  'implicitHeader': False, 'sync_word': 0x12, 'enable_CRC': False}
+					  'implicitHeader': False, 'sync_word': 0x12, 'enable_CRC': False,
+					  'register_cache': True, 'gc_policy': GC_ALWAYS, 'gc_threshold': 8192,
+					  'split_fifo': False}
 
 REQUIRED_VERSION = 0x12
 
+# register values after a reset (LoRa page), for working out a configuration
+# without the chip. The ones init doesn't set are written with these values to
+# join up bursts (the rx byte address is read only, writing it does nothing)
+RESET_VALUES = {REG_FRF_MSB: 0x6c, REG_FRF_MID: 0x80, REG_PA_CONFIG: 0x4f, REG_PA_RAMP: 0x09,
+				REG_OCP: 0x2b, REG_LNA: 0x20, REG_FIFO_TX_BASE_ADDR: 0x80,
+				REG_MODEM_CONFIG_1: 0x72, REG_MODEM_CONFIG_2: 0x70, REG_SYMB_TIMEOUT_LSB: 0x64,
+				REG_PREAMBLE_LSB: 0x08, REG_PAYLOAD_LENGTH: 0x01, REG_MAX_PAYLOAD_LENGTH: 0xff,
+				REG_DETECTION_OPTIMIZE: 0xc3, REG_DETECTION_THRESHOLD: 0x0a,
+				REG_SYNC_WORD: 0x12, REG_VERSION: REQUIRED_VERSION, REG_PA_DAC: 0x84}
+FILLER_REGISTERS = (REG_PA_RAMP, REG_FIFO_ADDR_PTR, REG_SYMB_TIMEOUT_LSB, REG_PAYLOAD_LENGTH,
+					REG_MAX_PAYLOAD_LENGTH, REG_HOP_PERIOD, REG_FIFO_RX_BYTE_ADDR)
+
+# Frf register setting = Freq / FSTEP where
+# FSTEP = FXOSC/2**19 where FXOSC=32MHz. So FSTEP==61.03515625
+FSTEP = 61.03515625
+
+# time for the pll to lock and the rssi to follow after a channel change in receive
+SCAN_SETTLE_US = 500
+
+def frfBytes(frequency):
+	''' the REG_FRF_MSB, MID, LSB values for frequency (Hz), see setFrequency '''
+	frfs = int(frequency / FSTEP)
+	return bytes(((frfs >> 16) & 0xff, (frfs >> 8) & 0xff, frfs & 0xff))
+
+class RegisterImage:
+	''' stands in for the spi control while the configuration runs, starting from the
+		reset values and keeping the registers it reads or writes. compile() groups
+		them into bursts of consecutive registers for write(), matches() checks a
+		chip against them '''
+	def __init__(self):
+		self.values = bytearray(128)
+		for register, value in RESET_VALUES.items():
+			self.values[register] = value
+		self.used = bytearray(128)	# 1 for the registers the configuration covers
+		self.runs = []			# (first register, values) for each burst
+		self.mode = 0			# REG_OP_MODE as matches() found it
+		self._response = bytearray(1)
+
+	def transfer(self, address, value=0x00):
+		register = address & 0x7f
+		if address & 0x80:
+			self._response[0] = 0
+			if register != REG_OP_MODE:		# write() handles the mode
+				self.values[register] = value & 0xff
+				self.used[register] = 1
+		else:
+			self._response[0] = self.values[register]
+			if register != REG_OP_MODE:
+				self.used[register] = 1		# left as it was, that's part of it too
+		return self._response
+
+	def burstWrite(self, address, buffer):
+		for i in range(len(buffer)):
+			self.transfer(address + i, buffer[i])
+		return buffer
+
+	def burstRead(self, address, buffer):
+		for i in range(len(buffer)):
+			buffer[i] = self.values[(address & 0x7f) + i]
+		return buffer
+
+	def compile(self):
+		''' work out the bursts, bridging short gaps with FILLER_REGISTERS '''
+		self.runs = []
+		register = 1
+		while register < 128:
+			if not self.used[register]:
+				register = register + 1
+				continue
+			start = register
+			end = register + 1
+			register = end
+			while register < 128 and (self.used[register] or register in FILLER_REGISTERS):
+				register = register + 1
+				if self.used[register - 1]:
+					end = register
+			self.runs.append((start, bytes(self.values[start:end])))
+			register = end
+
+	def write(self, spiControl):
+		''' configure the chip: LoRa sleep, the bursts, then standby '''
+		spiControl.transfer(REG_OP_MODE | 0x80, MODE_LONG_RANGE_MODE | MODE_SLEEP)
+		for register, values in self.runs:
+			spiControl.burstWrite(register | 0x80, values)
+		spiControl.transfer(REG_OP_MODE | 0x80, MODE_LONG_RANGE_MODE | MODE_STDBY)
+
+	def matches(self, spiControl):
+		''' True if the chip is in LoRa mode and holds the image, from one burst read
+			from REG_OP_MODE to the last register '''
+		last = self.runs[-1][0] + len(self.runs[-1][1])
+		chip = spiControl.burstRead(REG_OP_MODE, bytearray(last - REG_OP_MODE))
+		self.mode = chip[0]
+		if not self.mode & MODE_LONG_RANGE_MODE:
+			return False
+		for register in range(REG_OP_MODE + 1, last):
+			if self.used[register] and chip[register - REG_OP_MODE] != self.values[register]:
+				return False
+		return True
+
 class SX127x:
 	''' Standard SX127x library. Requires an spicontrol.SpiControl instance for spiControl '''
 	def __init__(self,
@@ -101,9 +242,41 @@ class SX127x:
 		self.name = name
 		self.parameters = parameters
 		self.bandwidth = 125000	# default bandwidth
+		self._bwIndex = 7		# its register value
+		self._frequency = 0
+		self._frf = None		# the frf bytes last written, None if unknown
+		self._payloadLength = 0	# bytes written to the fifo since beginPacket
+		self.splitFifo = self._useParam('split_fifo')
+		self._txBase = FifoTxBaseAddrSplit if self.splitFifo else FifoTxBaseAddr
+		self._txLoaded = False	# the fifo holds what was written since beginPacket
+		self._rxMark = None		# receiver fifo position when loading started while receiving
+		self._shadow = {} if self._useParam('register_cache') else None	# register -> last value
 		self.spreading = 6	# default spreading factor
+		self.codingRate = 5	# denominator of the coding rate 4/x
+		self.preambleLength = 8
+		self.txPower = 2		# dBm, as last set by setTxPower
+		self.txPowerPin = PA_OUTPUT_PA_BOOST_PIN
+		self._crcOn = False
+		self._implicitHeaderMode = None
+		self._airtimeTables = {}	# modem configuration -> {payload length: time on air}
+		self._airtimeTable = None	# the table for the current configuration
 		self._onReceive = onReceive	 # the onreceive function
 		self._onTransmit = onTransmit   # the ontransmit function
+		self._onCad = None		# callback(detected) when a cad finishes
+		self._rxBuffer = None	# if set, returns the buffer to read a packet into
+		self._rxAccept = None	# if set, decides from the header whether to read the rest
+		self._rxHeader = None
+		self._onEvent = None	# hook(sx127x, event, value) for errors, see lorastats
+		self.stats = lorastats.RadioStats()
+		self.irqTicks = 0		# ticks_us at the start of the last receive interrupt
+		# bind the irq handlers once, a bound method allocates every time it's made.
+		# A spi control with a shared bus guards them from breaking into a transfer
+		guard = getattr(spiControl, 'guard', None)
+		self._rxHandler = guard(self._handleOnReceive) if guard else self._handleOnReceive
+		self._txHandler = guard(self._handleOnTransmit) if guard else self._handleOnTransmit
+		self._cadHandler = guard(self._handleOnCad) if guard else self._handleOnCad
+		self._gcPolicy = self._useParam('gc_policy')
+		self._gcThreshold = self._useParam('gc_threshold')
 		self.doAcquire = hasattr(_thread, 'allocate_lock') # micropython vs loboris
 		if self.doAcquire :
 			self._lock = _thread.allocate_lock()
@@ -117,13 +290,43 @@ class SX127x:
 	def _useParam(self, who):
 		return DEFAULT_PARAMETERS[who] if not who in self.parameters.keys() else self.parameters[who]
 
-	def init(self):
+	def init(self, warm=False):
+		''' configure the chip from the parameters. The configuration is worked out
+			into a RegisterImage and written in a few bursts. With warm nothing is
+			written, it returns True if the chip already holds the configuration (the
+			radio kept it through a deep sleep of the mcu) and False if it doesn't,
+			then reset the chip and call init() '''
+		image = self.compileImage()
+		if warm:
+			if not image.matches(self._spiControl):
+				self.invalidateRegisters()
+				return False
+			self._modeChanged(image.mode & 0x07)
+			return True
 		# check version
 		version = self.readRegister(REG_VERSION)
 		if version != REQUIRED_VERSION:
 			print("Detected version:", version)
 			raise Exception('Invalid version.')
+		image.write(self._spiControl)
+		return True
 
+	def compileImage(self):
+		''' run the configuration against a RegisterImage instead of the chip and
+			return it. The driver settings (spreading factor, power...) are set as
+			if it had gone to the chip, and the register shadow matches the image '''
+		image = RegisterImage()
+		spiControl = self._spiControl
+		self._spiControl = image
+		self.invalidateRegisters()
+		try:
+			self._configure()
+		finally:
+			self._spiControl = spiControl
+		image.compile()
+		return image
+
+	def _configure(self):
 		# put in LoRa and sleep mode
 		self.sleep()
 
@@ -141,6 +344,7 @@ class SX127x:
 		powerpin = self._useParam('power_pin')
 		self.setTxPower(self._useParam('tx_power_level'), powerpin)
 		self._implicitHeaderMode = None
+		self._airtimeTable = None
 		self.implicitHeaderMode(self._useParam('implicitHeader'))
 		self.setSpreadingFactor(self._useParam('spreading_factor'))
 		self.setCodingRate(self._useParam('coding_rate'))
@@ -149,31 +353,50 @@ class SX127x:
 		self.enableCRC(self._useParam('enable_CRC'))
 
 		# set base addresses
-		self.writeRegister(REG_FIFO_TX_BASE_ADDR, FifoTxBaseAddr)
+		self.writeRegister(REG_FIFO_TX_BASE_ADDR, self._txBase)
 		self.writeRegister(REG_FIFO_RX_BASE_ADDR, FifoRxBaseAddr)
 
 		self.standby()
 
 	# start sending a packet (reset the fifo address, go into standby)
-	def beginPacket(self, implicitHeaderMode=False):
-		self.standby()
+	# with split_fifo a packet of up to length bytes that fits in the transmit half
+	# is loaded without leaving receive, so the radio keeps listening meanwhile
+	def beginPacket(self, implicitHeaderMode=False, length=MAX_PKT_LENGTH):
+		if self.splitFifo and length <= FIFO_SIZE - self._txBase and self.isReceiving():
+			self._rxMark = self.readRegister(REG_FIFO_RX_BYTE_ADDR)
+		else:
+			self.standby()
+			self._rxMark = None
 		self.implicitHeaderMode(implicitHeaderMode)
 		# reset FIFO address and paload length
-		self.writeRegister(REG_FIFO_ADDR_PTR, FifoTxBaseAddr)
-		self.writeRegister(REG_PAYLOAD_LENGTH, 0)
+		# the length register is written once in endPacket
+		self.writeRegister(REG_FIFO_ADDR_PTR, self._txBase)
+		self._payloadLength = 0
+		self._txLoaded = True
 
 	# finished putting packet into fifo, send it
 	# non-blocking so don't immediately receive...
 	def endPacket(self):
-		''' non-blocking end packet '''
+		''' non-blocking end packet. Returns False, without sending, if the packet was
+			loaded while receiving and a received one may have run over it, or
+			the radio slept since. Load it again then '''
+		if not self._txLoaded:
+			return False
+		if self._rxMark is not None:
+			self.standby()	# the receiver stops writing the fifo
+			if self.readRegister(REG_FIFO_RX_BYTE_ADDR) != self._rxMark:
+				self._txLoaded = False
+				return False
 		if self._onTransmit:
 		   # enable tx to raise DIO0
-			self._prepIrqHandler(self._handleOnTransmit)		   # attach handler
+			self._prepIrqHandler(self._txHandler)		   # attach handler
 			self.writeRegister(REG_DIO_MAPPING_1, 0x40)		   # enable transmit dio0
 		else:
 			self._prepIrqHandler(None)							# no handler
+		self.writeRegister(REG_PAYLOAD_LENGTH, self._payloadLength)
 		# put in TX mode
 		self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_TX)
+		return True
 
 	def isTxDone(self):
 		''' if Tx is done return true, and clear irq register - so it only returns true once '''
@@ -183,20 +406,24 @@ class SX127x:
 		irqFlags = self.getIrqFlags()
 		if (irqFlags & IRQ_TX_DONE_MASK) == 0:
 			return False
+		self._modeChanged(MODE_STDBY)	# the chip drops to standby after tx
 		# clear IRQ's
 		self.collect_garbage()
 		return True
 
 	def write(self, buffer):
-		currentLength = self.readRegister(REG_PAYLOAD_LENGTH)
+		''' append buffer (bytes, bytearray or memoryview) to the packet in one spi burst '''
+		currentLength = self._payloadLength
 		size = len(buffer)
 		# check size
-		size = min(size, (MAX_PKT_LENGTH - FifoTxBaseAddr - currentLength))
+		size = min(size, (MAX_PKT_LENGTH - currentLength))
 		# write data
-		for i in range(size):
-			self.writeRegister(REG_FIFO, buffer[i])
+		if size > 0:
+			if size < len(buffer):
+				buffer = memoryview(buffer)[:size]
+			self._spiControl.burstWrite(REG_FIFO | 0x80, buffer)
 		# update length
-		self.writeRegister(REG_PAYLOAD_LENGTH, currentLength + size)
+		self._payloadLength = currentLength + size
 		return size
 
 	def acquire_lock(self, lock=False):
@@ -228,18 +455,32 @@ class SX127x:
 		return irqFlags
 
 	def packetRssi(self):
-		return self.readRegister(REG_PKT_RSSI_VALUE) - (164 if self._frequency < 868E6 else 157)
+		return self.rssiFromRaw(self.readRegister(REG_PKT_RSSI_VALUE))
 
 	def packetSnr(self):
-		return self.readRegister(REG_PKT_SNR_VALUE) * 0.25
+		return self.snrFromRaw(self.readRegister(REG_PKT_SNR_VALUE))
+
+	def rssiFromRaw(self, raw):
+		''' convert a raw rssi register value to dBm '''
+		return raw - (164 if self._frequency < 868E6 else 157)
+
+	def snrFromRaw(self, raw):
+		''' convert a raw snr register value (signed, quarter dB) to dB '''
+		return (raw - 256 if raw > 127 else raw) * 0.25
 
 	def standby(self):
 		self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_STDBY)
 
+	def isReceiving(self):
+		return self.readRegister(REG_OP_MODE) & 0x07 == MODE_RX_CONTINUOUS
+
 	def sleep(self):
+		self._txLoaded = False		# the fifo is cleared in sleep
 		self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_SLEEP)
 
 	def setTxPower(self, level, outputPin=PA_OUTPUT_PA_BOOST_PIN):
+		self.txPower = level
+		self.txPowerPin = outputPin
 		if outputPin == PA_OUTPUT_RFO_PIN:
 			# RFO
 			level = min(max(level, 0), 14)
@@ -262,18 +503,22 @@ class SX127x:
 			self.writeRegister(REG_OCP, ocpValue)
 
 	# set the frequency band. passed in Hz
-	# Frf register setting = Freq / FSTEP where
-	# FSTEP = FXOSC/2**19 where FXOSC=32MHz. So FSTEP==61.03515625
-	def setFrequency(self, frequency):
+	# the three frf registers are consecutive so they go in one burst
+	def setFrequency(self, frequency, frf=None):
+		''' frf is frfBytes(frequency) if it's been worked out already, so a
+			channel change is just the burst (or nothing if it's the same) '''
+		if frf is None:
+			frf = frfBytes(frequency)
 		self._frequency = frequency
-		frfs = (int)(frequency / 61.03515625)
-		self.writeRegister(REG_FRF_MSB, frfs >> 16)
-		self.writeRegister(REG_FRF_MID, frfs >> 8)
-		self.writeRegister(REG_FRF_LSB, frfs)
+		if self._shadow is not None and frf == self._frf:
+			return
+		self._frf = frf
+		self._spiControl.burstWrite(REG_FRF_MSB | 0x80, frf)
 
 	def setSpreadingFactor(self, sf):
 		sf = min(max(sf, 6), 12)
 		self.spreading = sf
+		self._airtimeTable = None
 		self.writeRegister(REG_DETECTION_OPTIMIZE, 0xc5 if sf == 6 else 0xc3)
 		self.writeRegister(REG_DETECTION_THRESHOLD, 0x0c if sf == 6 else 0x0a)
 		self.writeRegister(REG_MODEM_CONFIG_2, (self.readRegister(REG_MODEM_CONFIG_2) & 0x0f) | ((sf << 4) & 0xf0))
@@ -287,6 +532,8 @@ class SX127x:
 				bw = i
 				break
 		self.bandwidth = bins[bw]
+		self._bwIndex = bw
+		self._airtimeTable = None
 		self.writeRegister(REG_MODEM_CONFIG_1, (self.readRegister(REG_MODEM_CONFIG_1) & 0x0f) | (bw << 4))
 		self.setLdoFlag()
 
@@ -302,13 +549,19 @@ class SX127x:
 		''' this takes a value of 5..8 as the denominator of 4/5, 4/6, 4/7, 5/8 '''
 		denominator = min(max(denominator, 5), 8)
 		cr = denominator - 4
+		self.codingRate = denominator
+		self._airtimeTable = None
 		self.writeRegister(REG_MODEM_CONFIG_1, (self.readRegister(REG_MODEM_CONFIG_1) & 0xf1) | (cr << 1))
 
 	def setPreambleLength(self, length):
+		self.preambleLength = length & 0xffff
+		self._airtimeTable = None
 		self.writeRegister(REG_PREAMBLE_MSB, (length >> 8) & 0xff)
 		self.writeRegister(REG_PREAMBLE_LSB, (length >> 0) & 0xff)
 
 	def enableCRC(self, enable_CRC=False):
+		self._crcOn = True if enable_CRC else False
+		self._airtimeTable = None
 		modem_config_2 = self.readRegister(REG_MODEM_CONFIG_2)
 		config = modem_config_2 | 0x04 if enable_CRC else modem_config_2 & 0xfb
 		self.writeRegister(REG_MODEM_CONFIG_2, config)
@@ -318,11 +571,38 @@ class SX127x:
 
 	def dumpRegisters(self):
 		for i in range(128):
-			print("0x{0:02x}: {1:02x}".format(i, self.readRegister(i)))
+			print("0x{0:02x}: {1:02x}".format(i, self._spiControl.transfer(i)[0])) # bypass the shadow
+
+	def timeOnAir(self, payloadLength):
+		''' time on air in microseconds for a packet of payloadLength bytes with the
+			current modem settings. Results are cached per configuration '''
+		table = self._airtimeTable
+		if table is None:
+			# pack the settings into one small int to key the table
+			key = self.spreading | (self._bwIndex << 4) | ((self.codingRate - 4) << 8) | \
+				  (self._crcOn << 11) | ((1 if self._implicitHeaderMode else 0) << 12) | \
+				  (self.preambleLength << 13)
+			table = self._airtimeTables.get(key)
+			if table is None:
+				table = {}
+				self._airtimeTables[key] = table
+			self._airtimeTable = table
+		us = table.get(payloadLength)
+		if us is None:
+			sf = self.spreading
+			symbolUs = (1 << sf) * 1000000 / self.bandwidth
+			ldo = 1 if symbolUs > 16000 else 0	# as setLdoFlag
+			bits = 8 * payloadLength - 4 * sf + 28 + (16 if self._crcOn else 0) - \
+				   (20 if self._implicitHeaderMode else 0)
+			symbols = 8 + max(-(-bits // (4 * (sf - 2 * ldo))) * self.codingRate, 0)
+			us = int((self.preambleLength + 4.25 + symbols) * symbolUs)
+			table[payloadLength] = us
+		return us
 
 	def implicitHeaderMode(self, implicitHeaderMode=False):
 		if self._implicitHeaderMode != implicitHeaderMode:  # set value only if different.
 			self._implicitHeaderMode = implicitHeaderMode
+			self._airtimeTable = None
 			modem_config_1 = self.readRegister(REG_MODEM_CONFIG_1)
 			config = modem_config_1 | 0x01 if implicitHeaderMode else modem_config_1 & 0xfe
 			self.writeRegister(REG_MODEM_CONFIG_1, config)
@@ -332,9 +612,9 @@ class SX127x:
 		if self.irqPin:
 			if handlefn:
 				if self.isLoboris:
-					self.irqPin.init(handler=handlefn, trigger=Pin.IRQ_RISING)
+					self.irqPin.init(handler=handlefn, trigger=self.irqPin.IRQ_RISING)
 				else:
-					self.irqPin.irq(handler=handlefn, trigger=Pin.IRQ_RISING)
+					self.irqPin.irq(handler=handlefn, trigger=self.irqPin.IRQ_RISING)
 			else:
 				if self.isLoboris:
 					self.irqPin.init(handler=None, trigger=0)
@@ -345,12 +625,120 @@ class SX127x:
 	def onReceive(self, callback):
 		''' establish a callback function for receive interrupts'''
 		self._onReceive = callback
+		self._rxBuffer = None
 		self._prepIrqHandler(None) # in case we have one and we're receiving. stop.
 
+	def onReceiveInto(self, getBuffer, callback):
+		''' establish a receive interrupt that reads into preallocated buffers.
+			getBuffer() returns a buffer to read the packet into (or None to drop it)
+			then the callback gets (sx127x, length). It isn't allocation free, keep
+			DIO0 a soft interrupt '''
+		self.onReceive(callback)
+		self._rxBuffer = getBuffer
+
+	def setRxFilter(self, accept, headerLength=4):
+		''' with onReceiveInto, read the first headerLength bytes of a received packet
+			and only read the rest if accept(header) is true. Rejected packets are
+			counted in stats.rxFiltered and rxFilteredBytes and go no further.
+			None reads every packet '''
+		self._rxAccept = accept
+		self._rxHeader = bytearray(headerLength) if accept else None
+
 	def onTransmit(self, callback):
 		''' establish a callback function for transmit interrupts'''
 		self._onTransmit = callback
 
+	def onCadDone(self, callback):
+		''' establish a callback(detected) for channel activity detection interrupts.
+			None means cadResult() has to be polled '''
+		self._onCad = callback
+
+	def startCad(self):
+		''' look for a LoRa preamble on the channel for about two symbols. The
+			onCadDone callback gets the result, or poll cadResult(). The chip goes
+			back to standby when it's done '''
+		self.standby()
+		if self._onCad:
+			self._prepIrqHandler(self._cadHandler)		# attach handler
+			self.writeRegister(REG_DIO_MAPPING_1, 0x80)	# enable cad done dio0
+		else:
+			self._prepIrqHandler(None)
+		self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_CAD)
+
+	def cadResult(self):
+		''' for a polled cad: None while it's still looking, else True if there was activity '''
+		irqFlags = self.readRegister(REG_IRQ_FLAGS)
+		if not irqFlags & IRQ_CAD_DONE_MASK:
+			return None
+		self.writeRegister(REG_IRQ_FLAGS, IRQ_CAD_DONE_MASK | IRQ_CAD_DETECTED_MASK)
+		return self._cadFinished(irqFlags)
+
+	def _cadFinished(self, irqFlags):
+		self._modeChanged(MODE_STDBY)	# the chip drops to standby after cad
+		detected = (irqFlags & IRQ_CAD_DETECTED_MASK) != 0
+		self.stats.cadChecks = self.stats.cadChecks + 1
+		if detected:
+			self.stats.cadDetected = self.stats.cadDetected + 1
+		return detected
+
+	def isSignalDetected(self):
+		''' while receiving, True if a packet is coming in '''
+		return (self.readRegister(REG_MODEM_STAT) & MODEM_STAT_SIGNAL_DETECTED) != 0
+
+	def currentRssi(self):
+		''' while receiving, the rssi of the channel right now in dBm. (REG_RSSI_WIDEBAND
+			isn't a channel measurement, it's the noise used for random numbers) '''
+		return self.rssiFromRaw(self.readRegister(REG_RSSI_VALUE))
+
+	def scanChannels(self, frequencies, samples=8, settleUs=SCAN_SETTLE_US, ticksUs=None, frfs=None):
+		''' measure the rssi on each of frequencies (Hz): receive there for settleUs,
+			then read it samples times. frfs are their frfBytes if worked out already,
+			ticksUs the microsecond clock. Returns a list with a dict of rssiMean,
+			rssiMin and rssiMax (dBm) for each. The receive interrupt is off, it ends
+			in standby on the frequency it started on, call receive() to listen again '''
+		ticksUs = ticksUs or lorastats.ticks_us
+		frequency = self._frequency
+		self._prepIrqHandler(None)
+		survey = []
+		for i in range(len(frequencies)):
+			self.standby()
+			self.setFrequency(frequencies[i], frfs[i] if frfs else None)
+			self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_RX_CONTINUOUS)
+			start = ticksUs()
+			while lorastats.ticks_diff(ticksUs(), start) < settleUs:
+				self.readRegister(REG_RSSI_VALUE)	# following the new channel
+			total = 0
+			low = 255
+			high = 0
+			for k in range(samples):
+				raw = self.readRegister(REG_RSSI_VALUE)
+				total = total + raw
+				low = min(low, raw)
+				high = max(high, raw)
+			survey.append({'rssiMean': self.rssiFromRaw(total / max(samples, 1)),
+						   'rssiMin': self.rssiFromRaw(low), 'rssiMax': self.rssiFromRaw(high)})
+		self.standby()
+		self.setFrequency(frequency)
+		return survey
+
+	def _handleOnCad(self, event_source):
+		self.acquire_lock(True)			  # lock until flags cleared
+		irqFlags = self.getIrqFlags()
+		self._prepIrqHandler(None)	   # disable handler since we're done
+		self.acquire_lock(False)			 # unlock
+		if irqFlags & IRQ_CAD_DONE_MASK:
+			detected = self._cadFinished(irqFlags)
+			if self._onCad:
+				self._onCad(detected)
+
+	def onEvent(self, callback):
+		''' establish a hook(sx127x, event, value) for the lorastats.EVENT_ errors '''
+		self._onEvent = callback
+
+	def _event(self, event, value):
+		if self._onEvent:
+			self._onEvent(self, event, value)
+
 	def receive(self, size=0):
 		''' enable reception - call this when you want to receive stuff '''
 		self.implicitHeaderMode(size > 0)
@@ -358,16 +746,19 @@ class SX127x:
 			self.writeRegister(REG_PAYLOAD_LENGTH, size & 0xff)
 		# enable rx to raise DIO0
 		if self._onReceive:
-			self._prepIrqHandler(self._handleOnReceive)			# attach handler
+			self._prepIrqHandler(self._rxHandler)			# attach handler
 			self.writeRegister(REG_DIO_MAPPING_1, 0x00)
 		else:
 			self._prepIrqHandler(None)							# no handler
 		# The last packet always starts at FIFO_RX_CURRENT_ADDR
 		# no need to reset FIFO_ADDR_PTR
+		if self._txLoaded and self._rxMark is None:
+			self._txLoaded = False	# loaded out of receive, nothing would show a packet running over it
 		self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_RX_CONTINUOUS)
 
 	# got a receive interrupt, handle it
 	def _handleOnReceive(self, event_source):
+		self.irqTicks = lorastats.ticks_us()
 		self.acquire_lock(True)			  # lock until TX_Done
 		irqFlags = self.getIrqFlags()
 		irqBad = IRQ_PAYLOAD_CRC_ERROR_MASK | IRQ_RX_TIME_OUT_MASK
@@ -375,19 +766,53 @@ class SX127x:
 		   ((irqFlags & irqBad) == 0) and \
 			self._onReceive:
 			# it's a receive data ready interrupt
-			payload = self.read_payload()
-			self.acquire_lock(False)	 # unlock when done reading
-			self._onReceive(self, payload)
+			if self._rxBuffer:
+				length = self._rxPacketLength()
+				header = self._rxHeader
+				start = 0
+				if header is not None and length >= len(header):
+					# the header first, the rest only if it's wanted
+					self._spiControl.burstRead(REG_FIFO, header)
+					if not self._rxAccept(header):
+						self.acquire_lock(False)
+						self.stats.rxFiltered = self.stats.rxFiltered + 1
+						self.stats.rxFilteredBytes = self.stats.rxFilteredBytes + length
+						return
+					start = len(header)
+				buffer = self._rxBuffer()
+				if buffer is not None:
+					length = min(length, len(buffer))
+					if start:
+						buffer[0:start] = header
+					if length > start:
+						self._spiControl.burstRead(REG_FIFO, memoryview(buffer)[start:length])
+				else:
+					length = 0
+				self.acquire_lock(False)	 # unlock when done reading
+				self.stats.rxPackets = self.stats.rxPackets + 1
+				self.stats.rxBytes = self.stats.rxBytes + length
+				if buffer is not None:
+					self._onReceive(self, length)
+			else:
+				payload = self.read_payload()
+				self.acquire_lock(False)	 # unlock when done reading
+				self.stats.rxPackets = self.stats.rxPackets + 1
+				self.stats.rxBytes = self.stats.rxBytes + len(payload)
+				self._onReceive(self, payload)
 		else:
 			self.acquire_lock(False)			 # unlock in any case.
+			stats = self.stats
 			if not irqFlags & IRQ_RX_DONE_MASK:
-				print("not rx done mask")
+				stats.notRxDone = stats.notRxDone + 1
+				self._event(lorastats.EVENT_NOT_RX_DONE, irqFlags)
 			elif (irqFlags & IRQ_PAYLOAD_CRC_ERROR_MASK) != 0:
-				print("crc error")
+				stats.crcErrors = stats.crcErrors + 1
+				self._event(lorastats.EVENT_CRC_ERROR, irqFlags)
 			elif (irqFlags & IRQ_RX_TIME_OUT_MASK) != 0:
-				print("receive timeout error")
+				stats.rxTimeouts = stats.rxTimeouts + 1
+				self._event(lorastats.EVENT_RX_TIMEOUT, irqFlags)
 			else:
-				print("no receive method defined")
+				self._event(lorastats.EVENT_NO_RX_HANDLER, irqFlags)
 
 	# Got a transmit interrupt, handle it
 	def _handleOnTransmit(self, event_source):
@@ -395,15 +820,19 @@ class SX127x:
 		irqFlags = self.getIrqFlags()
 		if irqFlags & IRQ_TX_DONE_MASK:
 			# it's a transmit finish interrupt
+			self._modeChanged(MODE_STDBY)	# the chip drops to standby after tx
 			self._prepIrqHandler(None)	   # disable handler since we're done
 			self.acquire_lock(False)			 # unlock
+			self.stats.txPackets = self.stats.txPackets + 1
+			self.stats.txBytes = self.stats.txBytes + self._payloadLength
 			if self._onTransmit:
 				self._onTransmit()
 			else:
-				print("transmit callback but no callback method")
+				self._event(lorastats.EVENT_NO_TX_HANDLER, irqFlags)
 		else:
 			self.acquire_lock(False)			 # unlock
-			print("transmit callback but not txdone: " + str(irqFlags))
+			self.stats.unexpectedTx = self.stats.unexpectedTx + 1
+			self._event(lorastats.EVENT_TX_NOT_DONE, irqFlags)
 
 	def receivedPacket(self, size=0):
 		''' when no receive handler, this tells if packet ready. Preps for receive'''
@@ -427,26 +856,76 @@ class SX127x:
 			self.writeRegister(REG_OP_MODE, MODE_LONG_RANGE_MODE | MODE_RX_SINGLE)
 		return False
 
-	def read_payload(self):
-		# set FIFO address to current RX address
-		# fifo_rx_current_addr = self.readRegister(REG_FIFO_RX_CURRENT_ADDR)
+	def _rxPacketLength(self):
+		''' point the fifo at the last packet received and return its length '''
 		self.writeRegister(REG_FIFO_ADDR_PTR, self.readRegister(REG_FIFO_RX_CURRENT_ADDR))
-		# read packet length
-		packetLength = self.readRegister(REG_PAYLOAD_LENGTH) if self._implicitHeaderMode else \
-					   self.readRegister(REG_RX_NB_BYTES)
-		payload = bytearray()
-		for i in range(packetLength):
-			payload.append(self.readRegister(REG_FIFO))
+		return self.readRegister(REG_PAYLOAD_LENGTH) if self._implicitHeaderMode else \
+			   self.readRegister(REG_RX_NB_BYTES)
+
+	def readPayloadInto(self, buffer):
+		''' read the last packet into buffer in one spi burst. Returns the length read '''
+		packetLength = min(self._rxPacketLength(), len(buffer))
+		if packetLength > 0:
+			if packetLength < len(buffer):
+				buffer = memoryview(buffer)[:packetLength]
+			self._spiControl.burstRead(REG_FIFO, buffer)
+		return packetLength
+
+	def read_payload(self):
+		# set FIFO address to current RX address and read packet length
+		payload = bytearray(self._rxPacketLength())
+		if len(payload) > 0:
+			self._spiControl.burstRead(REG_FIFO, payload)
 		self.collect_garbage()
 		return bytes(payload)
 
 	def readRegister(self, address, byteorder='big', signed=False):
+		shadow = self._shadow
+		if shadow is not None and address in shadow:
+			return shadow[address]
 		response = self._spiControl.transfer(address & 0x7f)
-		return int.from_bytes(response, byteorder)
+		value = int.from_bytes(response, byteorder)
+		if shadow is not None and address in SHADOWED_REGISTERS:
+			shadow[address] = value
+		return value
 
 	def writeRegister(self, address, value):
+		shadow = self._shadow
+		if shadow is not None and address in SHADOWED_REGISTERS:
+			value = value & 0xff
+			if address != REG_OP_MODE and shadow.get(address) == value:
+				return # already set, skip the spi transaction
+			shadow[address] = value
 		self._spiControl.transfer(address | 0x80, value)
 
-	def collect_garbage(self):
-		gc.collect()
+	def _modeChanged(self, mode):
+		''' the chip changed operating mode by itself, keep the shadow honest '''
+		if self._shadow is not None:
+			self._shadow[REG_OP_MODE] = MODE_LONG_RANGE_MODE | mode
+
+	def invalidateRegisters(self):
+		''' forget the shadowed register values, call after a chip reset '''
+		if self._shadow is not None:
+			self._shadow = {}
+		self._frf = None
+		self._txLoaded = False
+		self._implicitHeaderMode = None
+
+	def resyncRegisters(self):
+		''' reload the register shadow from the chip '''
+		self.invalidateRegisters()
+		if self._shadow is not None:
+			for address in SHADOWED_REGISTERS:
+				self.readRegister(address)
+		self._implicitHeaderMode = (self.readRegister(REG_MODEM_CONFIG_1) & 0x01) != 0
+
+	def collect_garbage(self, force=False):
+		''' collect garbage as allowed by the gc_policy parameter (or always if force) '''
+		policy = self._gcPolicy
+		if force or policy == GC_ALWAYS:
+			gc.collect()
+		elif policy == GC_LOW_MEMORY:
+			memFree = getattr(gc, 'mem_free', None) # micropython only
+			if memFree and memFree() < self._gcThreshold:
+				gc.collect()
 		#print('[Memory - free: {}   allocated: {}]'.format(gc.mem_free(), gc.mem_alloc()))
@@ -0,0 +1,230 @@
+''' Benchmarks for the per packet cost of the LightLora driver.
+
+For each operation this measures, per call: spi transactions, bytes on the spi
+bus, wall clock time, heap allocation and peak memory. Results are printed as
+json lines (one per operation) so runs can be saved and compared between versions.
+
+Under CPython it runs against the emulator in Tools/sx127xemu.py and also
+reports simulated microseconds:
+	python -m Tools.benchmark --calls 50 --out bench.jsonl
+On a MicroPython board copy this file over and, with the radio attached:
+	import benchmark
+	benchmark.run('device')
+The device run can't make incoming traffic so it skips the receive interrupt.
+Allocation numbers come from tracemalloc under CPython and gc.mem_alloc with the
+collector disabled on MicroPython, so compare them within a backend only.
+'''
+import gc
+import json
+import sys
+import time
+from LightLora import lorautil, sx127x
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None	# micropython
+
+if hasattr(time, 'ticks_us'):
+	def ticksUs():
+		return time.ticks_us()
+	def ticksDiff(end, start):
+		return time.ticks_diff(end, start)
+else:
+	def ticksUs():
+		return int(time.perf_counter() * 1000000)
+	def ticksDiff(end, start):
+		return end - start
+
+PAYLOAD_SIZES = (8, 32, 128, 251)
+
+class CountingSpiControl:
+	''' wraps an SpiControl (real or emulated) and counts the spi traffic '''
+	def __init__(self, inner):
+		self.inner = inner
+		self.transactions = 0
+		self.busBytes = 0
+
+	def transfer(self, address, value=0x00):
+		self.transactions = self.transactions + 1
+		self.busBytes = self.busBytes + 2
+		return self.inner.transfer(address, value)
+
+	def burstWrite(self, address, buffer):
+		self.transactions = self.transactions + 1
+		self.busBytes = self.busBytes + 1 + len(buffer)
+		self.inner.burstWrite(address, buffer)
+
+	def burstRead(self, address, buffer):
+		self.transactions = self.transactions + 1
+		self.busBytes = self.busBytes + 1 + len(buffer)
+		return self.inner.burstRead(address, buffer)
+
+	def getIrqPin(self):
+		return self.inner.getIrqPin()
+
+	def initLoraPins(self):
+		self.inner.initLoraPins()
+
+class Meter:
+	''' runs an operation and measures it. setup (not measured) runs before each call '''
+	def __init__(self, spi, backend, channel=None, calls=20):
+		self.spi = spi
+		self.backend = backend
+		self.channel = channel
+		self.calls = calls
+		self.results = []
+
+	def _memoryStart(self):
+		gc.collect()
+		if tracemalloc:
+			tracemalloc.start()
+			return tracemalloc.get_traced_memory()[0]
+		gc.disable()
+		return gc.mem_alloc()
+
+	def _memoryEnd(self, start):
+		''' returns allocated bytes and peak bytes above start '''
+		if tracemalloc:
+			current, peak = tracemalloc.get_traced_memory()
+			tracemalloc.stop()
+			return max(current - start, 0), max(peak - start, 0)
+		allocated = gc.mem_alloc() - start
+		gc.enable()
+		return allocated, allocated
+
+	def measure(self, name, fn, setup=None, **tags):
+		transactions = busBytes = elapsed = simulated = allocated = peak = 0
+		for i in range(self.calls):
+			if setup:
+				setup()
+			transactions0 = self.spi.transactions
+			bytes0 = self.spi.busBytes
+			sim0 = self.channel.now if self.channel else 0
+			memory0 = self._memoryStart()
+			start = ticksUs()
+			fn()
+			elapsed = elapsed + ticksDiff(ticksUs(), start)
+			memory = self._memoryEnd(memory0)
+			allocated = allocated + memory[0]
+			peak = max(peak, memory[1])
+			transactions = transactions + self.spi.transactions - transactions0
+			busBytes = busBytes + self.spi.busBytes - bytes0
+			if self.channel:
+				simulated = simulated + self.channel.now - sim0
+		result = {'op': name, 'backend': self.backend, 'calls': self.calls,
+				  'spiTransactions': transactions / self.calls, 'spiBytes': busBytes / self.calls,
+				  'timeUs': elapsed / self.calls, 'allocBytes': allocated / self.calls,
+				  'peakBytes': peak}
+		if self.channel:
+			result['simUs'] = simulated / self.calls
+		result.update(tags)
+		self.results.append(result)
+		return result
+
+def _waitSent(lu, channel):
+	if channel:
+		channel.runUntil(lu.isPacketSent, 10000000)
+	else:
+		for i in range(100):
+			if lu.isPacketSent():
+				break
+			time.sleep(.05)
+
+def benchInit(meter, lu):
+	def cold():
+		lu.lora.invalidateRegisters()	# what a power up sees
+	meter.measure('init', lu.lora.init, setup=cold)
+	meter.measure('initWarm', lambda: lu.lora.init(warm=True))	# the radio kept its configuration
+	lu.lora.receive()
+
+def benchSend(meter, lu, channel):
+	for size in PAYLOAD_SIZES:
+		payload = bytes(range(size))
+		def idle():
+			_waitSent(lu, channel)
+		def send():
+			lu.sendPacket(0xff, 0x41, payload)
+		meter.measure('sendPacket', send, setup=idle, size=size)
+	_waitSent(lu, channel)
+
+def benchReceive(meter, lu, peer, channel):
+	for size in PAYLOAD_SIZES:
+		payload = bytes(range(size - 4))
+		def arrive():
+			lu.readPackets()	# keep the queue empty
+			lu.lora.receive()
+			lu.lora._prepIrqHandler(None)	# we call the handler ourselves
+			peer.sendPacket(0x41, 0x42, payload)
+			channel.runUntil(peer.isPacketSent, 10000000)
+		def handle():
+			lu.lora._handleOnReceive(None)
+		meter.measure('_handleOnReceive', handle, setup=arrive, size=size)
+		meter.measure('read_payload', lu.lora.read_payload, size=size)
+	lu.readPackets()
+	lu.lora.receive()
+
+def benchReconfigure(meter, lu):
+	lora = lu.lora
+	state = {'sf': 7, 'bw': 0}
+	def spreading():
+		state['sf'] = 7 if state['sf'] >= 12 else state['sf'] + 1
+		lora.setSpreadingFactor(state['sf'])
+	def bandwidth():
+		state['bw'] = (state['bw'] + 1) % 3
+		lora.setSignalBandwidth((62500, 125000, 250000)[state['bw']])
+	meter.measure('setSpreadingFactor', spreading)
+	meter.measure('setSignalBandwidth', bandwidth)
+	meter.measure('setCodingRate', lambda: lora.setCodingRate(5))
+	meter.measure('setTxPower', lambda: lora.setTxPower(5, sx127x.PA_OUTPUT_PA_BOOST_PIN))
+	meter.measure('setFrequency', lambda: lora.setFrequency(915e6))
+	lora.init()	# back to the LoraUtil settings
+	lora.receive()
+
+def run(backend='emulator', calls=20, out=None):
+	''' run the suite, write json lines to out (a file) or stdout. Returns the results '''
+	channel = peer = None
+	if backend == 'emulator':
+		from Tools.sx127xemu import VirtualChannel
+		channel = VirtualChannel(seed=1)
+		spi = CountingSpiControl(channel.addRadio('dut'))
+		peer = lorautil.LoraUtil(spiControl=channel.addRadio('peer'))
+	else:
+		from LightLora import spicontrol
+		spi = CountingSpiControl(spicontrol.SpiControl())
+	lu = lorautil.LoraUtil(spiControl=spi)
+	meter = Meter(spi, backend, channel, calls)
+	benchInit(meter, lu)
+	benchSend(meter, lu, channel)
+	if peer:
+		benchReceive(meter, lu, peer, channel)
+	benchReconfigure(meter, lu)
+	stream = out or sys.stdout
+	for result in meter.results:
+		result['version'] = version()
+		stream.write(json.dumps(result) + '\n')
+	return meter.results
+
+def version():
+	''' the library version from package.json, if we can find it '''
+	try:
+		with open('package.json') as f:
+			return json.load(f)['version']
+	except Exception:
+		return 'unknown'
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(description='LightLora driver benchmarks')
+	parser.add_argument('--backend', default='emulator', choices=('emulator', 'device'))
+	parser.add_argument('--calls', type=int, default=20, help='calls per operation')
+	parser.add_argument('--out', help='append json lines to this file')
+	args = parser.parse_args()
+	if args.out:
+		with open(args.out, 'a') as out:
+			run(args.backend, args.calls, out)
+	else:
+		run(args.backend, args.calls)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,165 @@
+''' Reads packet captures written by LightLora/capture.py, under CPython.
+
+records() streams a capture of any size a chunk at a time, summarize() works out
+packet counts, signal statistics and the busiest senders, and replay() plays the
+received frames back into an emulated radio (Tools/sx127xemu.py), through the
+real receive path, at the recorded pace or faster for load testing.
+
+	python -m Tools.capturetool lora.cap					# summary as json
+	python -m Tools.capturetool lora.cap --replay --speed 10	# replay into a LoraUtil, 10x
+'''
+import json
+import sys
+from LightLora import capture, sx127x
+
+BANDWIDTHS = (7800, 10400, 15600, 20800, 31250, 41700, 62500, 125000, 250000, 500000)
+
+class Record:
+	''' one captured frame. timeMs counts from the start of the capture (each
+		START record carries on from the one before). rssi is dBm, snr dB, frequency
+		Hz (0 if the driver didn't know it) '''
+	__slots__ = ('timeMs', 'tx', 'start', 'rssiRaw', 'snrRaw', 'frequency', 'spreading',
+				 'bandwidth', 'frame')
+
+	@property
+	def rssi(self):
+		return self.rssiRaw - (164 if self.frequency < 868E6 else 157)
+
+	@property
+	def snr(self):
+		return (self.snrRaw - 256 if self.snrRaw > 127 else self.snrRaw) * 0.25
+
+def records(path, chunkSize=1 << 16):
+	''' a generator of the Records in the capture at path '''
+	with open(path, 'rb') as f:
+		data = f.read(len(capture.MAGIC) + 1)
+		if data[:len(capture.MAGIC)] != capture.MAGIC:
+			raise ValueError('not a capture file: ' + path)
+		if data[len(capture.MAGIC)] != capture.VERSION:
+			raise ValueError('unknown capture version %d' % data[len(capture.MAGIC)])
+		buffer = b''
+		at = 0
+		timeMs = 0
+		while True:
+			if len(buffer) - at < capture.RECORD_HEADER + 255:
+				chunk = f.read(chunkSize)
+				buffer = buffer[at:] + chunk
+				at = 0
+				if not chunk and len(buffer) < capture.RECORD_HEADER:
+					return
+			header = buffer[at:at + capture.RECORD_HEADER]
+			if len(header) < capture.RECORD_HEADER:
+				return
+			length = header[1]
+			end = at + capture.RECORD_HEADER + length
+			if end > len(buffer):
+				return		# cut short, the capture wasn't closed
+			record = Record()
+			timeMs = timeMs + int.from_bytes(header[2:6], 'little')
+			record.timeMs = timeMs
+			record.tx = bool(header[0] & capture.TX)
+			record.start = bool(header[0] & capture.START)
+			record.rssiRaw = header[6]
+			record.snrRaw = header[7]
+			record.frequency = int.from_bytes(header[8:11], 'big') * sx127x.FSTEP
+			record.spreading = header[11] & 0x0f
+			record.bandwidth = BANDWIDTHS[min(header[11] >> 4, len(BANDWIDTHS) - 1)]
+			record.frame = buffer[at + capture.RECORD_HEADER:end]
+			at = end
+			yield record
+
+def summarize(path):
+	''' counts and signal statistics for a capture, as a dict '''
+	result = {'records': 0, 'received': 0, 'sent': 0, 'bytes': 0, 'sessions': 0, 'durationS': 0}
+	rssi = []
+	snr = []
+	senders = {}
+	settings = {}
+	first = last = None
+	for record in records(path):
+		result['records'] = result['records'] + 1
+		result['bytes'] = result['bytes'] + len(record.frame)
+		if record.start:
+			result['sessions'] = result['sessions'] + 1
+		if first is None:
+			first = record.timeMs
+		last = record.timeMs
+		frequency = '%.3fMHz' % (record.frequency / 1e6) if record.frequency else 'unknown'
+		key = '%s sf%d bw%d' % (frequency, record.spreading, record.bandwidth)
+		settings[key] = settings.get(key, 0) + 1
+		if record.tx:
+			result['sent'] = result['sent'] + 1
+			continue
+		result['received'] = result['received'] + 1
+		rssi.append(record.rssi)
+		snr.append(record.snr)
+		if len(record.frame) > 1:
+			source = record.frame[1]
+			senders[source] = senders.get(source, 0) + 1
+	if first is not None:
+		result['durationS'] = (last - first) / 1000
+	for name, values in (('rssi', rssi), ('snr', snr)):
+		if values:
+			result[name] = {'mean': sum(values) / len(values), 'min': min(values), 'max': max(values)}
+	result['settings'] = settings
+	result['senders'] = dict(('0x%02x' % address, count) for address, count in
+							 sorted(senders.items(), key=lambda item: -item[1]))
+	return result
+
+def replay(path, radio, speed=1.0, onDeliver=None):
+	''' deliver the received frames in the capture to radio (an EmuSpiControl or
+		EmuRadio) with their recorded rssi and snr, speed times as fast as they
+		were captured. onDeliver() is called after each so the receiver can keep up.
+		Frames that come while the radio isn't receiving are missed.
+		Returns (delivered, missed) '''
+	radio = getattr(radio, 'radio', radio)
+	channel = radio.channel
+	start = channel.now
+	delivered = missed = 0
+	first = None
+	for record in records(path):
+		if record.tx:
+			continue
+		if first is None:
+			first = record.timeMs
+		at = start + int((record.timeMs - first) * 1000 / speed)
+		if at > channel.now:
+			channel.advance(at - channel.now)
+		if not radio.isListening():
+			missed = missed + 1
+			continue
+		radio.deliver(record.frame, False, record.snr, record.rssi)
+		delivered = delivered + 1
+		if onDeliver:
+			onDeliver()
+	return delivered, missed
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser(description='LightLora capture reader')
+	parser.add_argument('path')
+	parser.add_argument('--replay', action='store_true', help='replay into an emulated LoraUtil')
+	parser.add_argument('--speed', type=float, default=1.0, help='replay speed up')
+	args = parser.parse_args()
+	if not args.replay:
+		json.dump(summarize(args.path), sys.stdout, indent=1)
+		sys.stdout.write('\n')
+		return
+	from LightLora import lorautil
+	from Tools.sx127xemu import VirtualChannel
+	channel = VirtualChannel()
+	spi = channel.addRadio('replay')
+	lu = lorautil.LoraUtil(spiControl=spi, ticksMs=channel.ticks_ms)
+	read = [0]
+	def drain():
+		for pkt in lu.readPackets():
+			read[0] = read[0] + 1
+			pkt.release()
+	delivered, missed = replay(args.path, spi, args.speed, drain)
+	result = {'delivered': delivered, 'missed': missed, 'read': read[0]}
+	result.update(lu.stats.asDict())
+	json.dump(result, sys.stdout)
+	sys.stdout.write('\n')
+
+if __name__ == '__main__':
+	main()
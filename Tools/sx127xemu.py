@@ -0,0 +1,578 @@
+''' A register level software model of the SX127x for running LightLora under CPython.
+
+EmuSpiControl is a drop in replacement for spicontrol.SpiControl and EmuPin for
+the DIO0 machine.Pin, so sx127x.SX127x and lorautil.LoraUtil run unchanged.
+Any number of radios share a VirtualChannel which owns the simulated clock,
+works out airtime from each radio's registers and decides losses and collisions.
+
+	channel = VirtualChannel(lossRate=0.1, seed=1)
+	nodeA = lorautil.LoraUtil(spiControl=channel.addRadio('A'))
+	nodeB = lorautil.LoraUtil(spiControl=channel.addRadio('B'))
+	nodeA.sendPacket(0xff, 0x41, b'hello')
+	channel.advance(500000)		# half a second of simulated time
+	print(nodeB.readPacket().msgTxt, channel.now)
+
+Each EmuSpiControl counts its spi transactions and bytes on the bus and the
+spi time is charged to the simulated clock at the configured baud rate.
+
+EmuSpi goes a level lower, standing in for machine.SPI, so the real
+spicontrol.SpiBus and SpiControl (and the guards on their DIO0 handlers) can
+drive emulated radios sharing one bus:
+
+	spi = EmuSpi()
+	bus = spicontrol.SpiBus(spi=spi)
+	radio = channel.addRadio('A').radio
+	spic = spicontrol.SpiControl(bus, cs=spi.select(radio), reset=EmuPin(), dio0=radio.dio0)
+'''
+import heapq
+import math
+import random
+from LightLora import sx127x
+
+# register defaults after reset, from the datasheet (LoRa page)
+RESET_REGISTERS = {sx127x.REG_OP_MODE: 0x09, sx127x.REG_FRF_MSB: 0x6c, sx127x.REG_FRF_MID: 0x80,
+				   sx127x.REG_PA_CONFIG: 0x4f, sx127x.REG_OCP: 0x2b, sx127x.REG_LNA: 0x20,
+				   sx127x.REG_FIFO_TX_BASE_ADDR: 0x80, sx127x.REG_MODEM_CONFIG_1: 0x72,
+				   sx127x.REG_MODEM_CONFIG_2: 0x70, sx127x.REG_PREAMBLE_LSB: 0x08,
+				   sx127x.REG_PAYLOAD_LENGTH: 0x01, sx127x.REG_DETECTION_OPTIMIZE: 0xc3,
+				   sx127x.REG_DETECTION_THRESHOLD: 0x0a, sx127x.REG_SYNC_WORD: 0x12,
+				   sx127x.REG_VERSION: sx127x.REQUIRED_VERSION, sx127x.REG_PA_DAC: 0x84}
+
+# the chip changes these itself, writes are ignored
+READ_ONLY_REGISTERS = (sx127x.REG_FIFO_RX_CURRENT_ADDR, sx127x.REG_RX_NB_BYTES, sx127x.REG_MODEM_STAT,
+					   sx127x.REG_PKT_RSSI_VALUE, sx127x.REG_PKT_SNR_VALUE, sx127x.REG_RSSI_VALUE,
+					   sx127x.REG_FIFO_RX_BYTE_ADDR, sx127x.REG_VERSION)
+
+BANDWIDTHS = (7800, 10400, 15600, 20800, 31250, 41700, 62500, 125000, 250000, 500000)
+
+MODE_MASK = 0x07
+
+# lowest snr (dB) each spreading factor demodulates at, from the datasheet
+SNR_FLOOR = {6: -5.0, 7: -7.5, 8: -10.0, 9: -12.5, 10: -15.0, 11: -17.5, 12: -20.0}
+
+def timeOnAirUs(regs, length):
+	''' the Semtech time on air formula (in microseconds) for the registers in regs '''
+	config1 = regs[sx127x.REG_MODEM_CONFIG_1]
+	config2 = regs[sx127x.REG_MODEM_CONFIG_2]
+	bw = BANDWIDTHS[min(config1 >> 4, len(BANDWIDTHS) - 1)]
+	cr = (config1 >> 1) & 0x07
+	implicitHeader = config1 & 0x01
+	sf = config2 >> 4
+	crc = 1 if config2 & 0x04 else 0
+	lowDataRate = 1 if regs[sx127x.REG_MODEM_CONFIG_3] & sx127x.LDO_FLAG else 0
+	preamble = (regs[sx127x.REG_PREAMBLE_MSB] << 8) | regs[sx127x.REG_PREAMBLE_LSB]
+	symbolUs = (1 << sf) * 1e6 / bw
+	payloadSymbols = 8 + max(math.ceil((8 * length - 4 * sf + 28 + 16 * crc - 20 * implicitHeader) /
+									   (4 * (sf - 2 * lowDataRate))) * (cr + 4), 0)
+	return int((preamble + 4.25 + payloadSymbols) * symbolUs)
+
+class EmuPin:
+	''' stands in for the DIO0 machine.Pin. The radio drives the level '''
+	IN = 0
+	OUT = 1
+	IRQ_RISING = 1
+	IRQ_FALLING = 2
+
+	def __init__(self):
+		self._value = 0
+		self.handler = None
+		self.trigger = 0
+		self.interrupts = 0		# handler calls
+
+	def value(self, v=None):
+		if v is None:
+			return self._value
+		self._value = 1 if v else 0
+
+	def irq(self, handler=None, trigger=0):
+		self.handler = handler
+		self.trigger = trigger
+
+	def drive(self, level):
+		''' called by the radio. A rising edge runs the handler like a soft irq '''
+		rising = level and not self._value
+		self._value = 1 if level else 0
+		if rising and self.handler and (self.trigger & self.IRQ_RISING):
+			self.interrupts = self.interrupts + 1
+			self.handler(self)
+
+class EmuRadio:
+	''' the register file, fifo and modem state machine of one SX127x '''
+	def __init__(self, channel, name):
+		self.channel = channel
+		self.name = name
+		self.dio0 = EmuPin()
+		self.regs = bytearray(128)
+		self.fifo = bytearray(256)
+		self.rssi = -80			# dBm and dB reported for packets received by this radio
+		self.snr = 7.0
+		self.txCount = 0
+		self.rxCount = 0
+		self.cadCount = 0
+		self.modeUs = [0] * 8	# simulated time spent in each mode, for current estimates
+		self._modeSince = channel.now
+		self.reset()
+
+	def reset(self):
+		self.regs[:] = bytes(128)
+		for reg, value in RESET_REGISTERS.items():
+			self.regs[reg] = value
+		self.fifo[:] = bytes(256)
+		self.rxAddress = 0		# where the next received packet lands
+		self.listenSince = None	# when it last went into receive
+		self._cadStart = None
+		self.transmission = None
+		self.dio0.drive(0)
+
+	def mode(self):
+		return self.regs[sx127x.REG_OP_MODE] & MODE_MASK
+
+	def isListening(self):
+		return self.mode() in (sx127x.MODE_RX_CONTINUOUS, 0x06)
+
+	def frequency(self):
+		frf = (self.regs[sx127x.REG_FRF_MSB] << 16) | (self.regs[sx127x.REG_FRF_MID] << 8) | \
+			  self.regs[sx127x.REG_FRF_LSB]
+		return frf * 61.03515625
+
+	def txPower(self):
+		''' the output power (dBm) the pa registers give '''
+		config = self.regs[sx127x.REG_PA_CONFIG]
+		if not config & sx127x.PA_BOOST:
+			return config & 0x0f
+		return 5 + (config & 0x0f) if self.regs[sx127x.REG_PA_DAC] & 0x07 == 0x07 else 2 + (config & 0x0f)
+
+	def modulation(self):
+		''' what a receiver has to match to hear this radio: frequency, bandwidth, sf '''
+		return (self.frequency(), self.regs[sx127x.REG_MODEM_CONFIG_1] >> 4,
+				self.regs[sx127x.REG_MODEM_CONFIG_2] >> 4, self.regs[sx127x.REG_SYNC_WORD])
+
+	def readRegister(self, address):
+		if address == sx127x.REG_FIFO:
+			pointer = self.regs[sx127x.REG_FIFO_ADDR_PTR]
+			self.regs[sx127x.REG_FIFO_ADDR_PTR] = (pointer + 1) & 0xff
+			return self.fifo[pointer]
+		if address == sx127x.REG_MODEM_STAT:
+			return sx127x.MODEM_STAT_SIGNAL_DETECTED if self.channel.incoming(self) else 0
+		if address == sx127x.REG_RSSI_VALUE:
+			offset = 164 if self.frequency() < 868E6 else 157
+			return min(max(int(self.channel.channelRssi(self)) + offset, 0), 255)
+		return self.regs[address]
+
+	def writeRegister(self, address, value):
+		value = value & 0xff
+		if address == sx127x.REG_FIFO:
+			pointer = self.regs[sx127x.REG_FIFO_ADDR_PTR]
+			self.fifo[pointer] = value
+			self.regs[sx127x.REG_FIFO_ADDR_PTR] = (pointer + 1) & 0xff
+		elif address == sx127x.REG_IRQ_FLAGS:
+			self.regs[address] = self.regs[address] & ~value	# write 1 to clear
+			self._updateDio0()
+		elif address == sx127x.REG_OP_MODE:
+			oldMode = self.mode()
+			self._setMode(value)
+			if self.mode() != oldMode:
+				self._enterMode(self.mode())
+		elif address == sx127x.REG_DIO_MAPPING_1:
+			self.regs[address] = value
+			self._updateDio0()
+		elif address not in READ_ONLY_REGISTERS:
+			self.regs[address] = value
+
+	def setIrq(self, mask):
+		self.regs[sx127x.REG_IRQ_FLAGS] = self.regs[sx127x.REG_IRQ_FLAGS] | mask
+		self._updateDio0()
+
+	def _dio0Source(self):
+		mapping = self.regs[sx127x.REG_DIO_MAPPING_1] >> 6
+		if mapping == 0:
+			return sx127x.IRQ_RX_DONE_MASK
+		if mapping == 1:
+			return sx127x.IRQ_TX_DONE_MASK
+		if mapping == 2:
+			return sx127x.IRQ_CAD_DONE_MASK
+		return 0
+
+	def _updateDio0(self):
+		self.dio0.drive(self.regs[sx127x.REG_IRQ_FLAGS] & self._dio0Source())
+
+	def _setMode(self, value):
+		''' write OP_MODE, keeping count of the time spent in the mode it leaves '''
+		now = self.channel.now
+		self.modeUs[self.mode()] = self.modeUs[self.mode()] + now - self._modeSince
+		self._modeSince = now
+		self.regs[sx127x.REG_OP_MODE] = value
+
+	def _standby(self):
+		self._setMode((self.regs[sx127x.REG_OP_MODE] & ~MODE_MASK) | sx127x.MODE_STDBY)
+
+	def _enterMode(self, mode):
+		if mode == sx127x.MODE_CAD:
+			self._cadStart = self.channel.now
+			self.channel.schedule(cadTimeUs(self.regs), self._cadDone, self._cadStart)
+		elif mode == sx127x.MODE_TX:
+			base = self.regs[sx127x.REG_FIFO_TX_BASE_ADDR]
+			length = self.regs[sx127x.REG_PAYLOAD_LENGTH]
+			payload = bytes(self.fifo[(base + i) & 0xff] for i in range(length))
+			self.channel.transmit(self, payload)
+		if mode == sx127x.MODE_RX_CONTINUOUS or mode == 0x06:
+			self.rxAddress = self.regs[sx127x.REG_FIFO_RX_BASE_ADDR]
+			self.listenSince = self.channel.now
+		else:
+			self.listenSince = None
+		if mode != sx127x.MODE_TX and self.transmission:
+			self.channel.abort(self)	# left tx before it finished
+
+	def txDone(self):
+		''' the channel finished sending our packet '''
+		self.transmission = None
+		self.txCount = self.txCount + 1
+		self._standby()
+		self.setIrq(sx127x.IRQ_TX_DONE_MASK)
+
+	def _cadDone(self, start):
+		if self.mode() != sx127x.MODE_CAD or start != self._cadStart:
+			return		# left cad before it finished
+		self.cadCount = self.cadCount + 1
+		self._standby()
+		flags = sx127x.IRQ_CAD_DONE_MASK
+		if self.channel.activity(self, start):
+			flags = flags | sx127x.IRQ_CAD_DETECTED_MASK
+		self.setIrq(flags)
+
+	def deliver(self, payload, corrupt, snr=None, rssi=None):
+		''' a packet arrived while listening. The fifo gets it at the rx address.
+			snr and rssi default to the radio's fixed values '''
+		crcOn = self.regs[sx127x.REG_MODEM_CONFIG_2] & 0x04
+		if corrupt and not crcOn:
+			payload = bytes(b ^ 0x5a for b in payload)	# garbage gets through without a crc
+		address = self.rxAddress
+		for i in range(len(payload)):
+			self.fifo[(address + i) & 0xff] = payload[i]
+		self.rxAddress = (address + len(payload)) & 0xff
+		self.regs[sx127x.REG_FIFO_RX_CURRENT_ADDR] = address
+		self.regs[sx127x.REG_FIFO_RX_BYTE_ADDR] = self.rxAddress
+		self.regs[sx127x.REG_RX_NB_BYTES] = len(payload)
+		offset = 164 if self.frequency() < 868E6 else 157
+		self.regs[sx127x.REG_PKT_RSSI_VALUE] = min(max(int(self.rssi if rssi is None else rssi) + offset, 0), 255)
+		self.regs[sx127x.REG_PKT_SNR_VALUE] = int((self.snr if snr is None else snr) * 4) & 0xff
+		self.rxCount = self.rxCount + 1
+		flags = sx127x.IRQ_RX_DONE_MASK
+		if corrupt and crcOn:
+			flags = flags | sx127x.IRQ_PAYLOAD_CRC_ERROR_MASK
+		if self.mode() == 0x06:
+			self._standby()
+			self.listenSince = None
+		self.setIrq(flags)
+
+def cadTimeUs(regs):
+	''' a cad looks at about two symbols '''
+	bw = BANDWIDTHS[min(regs[sx127x.REG_MODEM_CONFIG_1] >> 4, len(BANDWIDTHS) - 1)]
+	return int(2 * (1 << (regs[sx127x.REG_MODEM_CONFIG_2] >> 4)) * 1e6 / bw)
+
+def preambleUs(regs):
+	''' how long the preamble and sync word take, a receiver has to start before they end '''
+	bw = BANDWIDTHS[min(regs[sx127x.REG_MODEM_CONFIG_1] >> 4, len(BANDWIDTHS) - 1)]
+	preamble = (regs[sx127x.REG_PREAMBLE_MSB] << 8) | regs[sx127x.REG_PREAMBLE_LSB]
+	return int((preamble + 4.25) * (1 << (regs[sx127x.REG_MODEM_CONFIG_2] >> 4)) * 1e6 / bw)
+
+class EmuSpiControl:
+	''' drop in replacement for spicontrol.SpiControl talking to an EmuRadio.
+		transactions and busBytes count the spi traffic '''
+	def __init__(self, radio, baudrate=5000000):
+		self.radio = radio
+		self.baudrate = baudrate
+		self._response = bytearray(1)
+		self.resetCounters()
+
+	def resetCounters(self):
+		self.transactions = 0
+		self.busBytes = 0
+
+	def _charge(self, count):
+		self.transactions = self.transactions + 1
+		self.busBytes = self.busBytes + count
+		if self.baudrate:
+			self.radio.channel.spend(count * 8 * 1000000 // self.baudrate)
+
+	def transfer(self, address, value=0x00):
+		self._charge(2)
+		if address & 0x80:
+			self._response[0] = self.radio.regs[address & 0x7f] if address != 0x80 else 0
+			self.radio.writeRegister(address & 0x7f, value)
+		else:
+			self._response[0] = self.radio.readRegister(address)
+		return self._response
+
+	# the address auto increments during a burst, except for the fifo
+	def burstWrite(self, address, buffer):
+		self._charge(1 + len(buffer))
+		register = address & 0x7f
+		for value in buffer:
+			self.radio.writeRegister(register, value)
+			if register != sx127x.REG_FIFO:
+				register = register + 1
+
+	def burstRead(self, address, buffer):
+		self._charge(1 + len(buffer))
+		register = address & 0x7f
+		for i in range(len(buffer)):
+			buffer[i] = self.radio.readRegister(register)
+			if register != sx127x.REG_FIFO:
+				register = register + 1
+		return buffer
+
+	def getIrqPin(self):
+		return self.radio.dio0
+
+	def initLoraPins(self):
+		self.radio.reset()
+
+class EmuChipSelect:
+	''' stands in for the chip select machine.Pin of a radio on an EmuSpi '''
+	def __init__(self, spi, radio):
+		self.spi = spi
+		self.radio = radio
+		self._value = 1
+
+	def value(self, v=None):
+		if v is None:
+			return self._value
+		v = 1 if v else 0
+		if v != self._value:
+			self._value = v
+			if v:
+				self.spi._deselect(self.radio)
+			else:
+				self.spi._select(self.radio)
+
+class EmuSpi:
+	''' stands in for the machine.SPI of a bus, to run the real spicontrol.SpiBus and
+		SpiControl against emulated radios. select(radio) makes the chip select pin
+		for a radio (an EmuSpiControl or EmuRadio) on the bus.
+		A transaction is the register address, then data bytes each way, moving to the
+		next register after each one except for the fifo. transactions and busBytes
+		count the traffic '''
+	def __init__(self, baudrate=5000000):
+		self.baudrate = baudrate
+		self.radio = None		# the selected radio
+		self._address = None	# None until the address byte of a transaction
+		self.transactions = 0
+		self.busBytes = 0
+
+	def select(self, radio):
+		return EmuChipSelect(self, getattr(radio, 'radio', radio))
+
+	def _select(self, radio):
+		self.radio = radio
+		self._address = None
+		self.transactions = self.transactions + 1
+
+	def _deselect(self, radio):
+		if self.radio is radio:
+			self.radio = None
+
+	def _byte(self, out):
+		''' clock one byte out, returns the one clocked in '''
+		self.busBytes = self.busBytes + 1
+		radio = self.radio
+		if radio is None:
+			return 0xff		# nobody selected, miso floats high
+		if self.baudrate:
+			radio.channel.spend(8 * 1000000 // self.baudrate)
+		if self._address is None:
+			self._address = out
+			return 0
+		register = self._address & 0x7f
+		if self._address & 0x80:
+			back = radio.regs[register] if register != sx127x.REG_FIFO else 0
+			radio.writeRegister(register, out)
+		else:
+			back = radio.readRegister(register)
+		if register != sx127x.REG_FIFO:
+			self._address = self._address + 1
+		return back
+
+	def write(self, buffer):
+		for value in buffer:
+			self._byte(value)
+
+	def write_readinto(self, outBuffer, inBuffer):
+		for i in range(len(outBuffer)):
+			inBuffer[i] = self._byte(outBuffer[i])
+
+	def readinto(self, buffer, write=0):
+		for i in range(len(buffer)):
+			buffer[i] = self._byte(write)
+
+class VirtualChannel:
+	''' the air shared by a set of emulated radios, and the simulated clock (in us).
+		lossRate is the chance a packet silently doesn't arrive at a receiver.
+		setLink gives a pair of radios a path snr, then what arrives depends on the
+		transmit power, bandwidth and spreading factor (see faded).
+		With collisions, packets overlapping on the same modulation are corrupted.
+		setNoise raises the noise on a frequency over noiseFloor (dBm), it takes that
+		much off the snr of setLink paths there and shows in the rssi register.
+		airtime(radio, length) can override the time on air in microseconds. '''
+	def __init__(self, lossRate=0.0, collisions=True, seed=None, airtime=None):
+		self.now = 0
+		self.lossRate = lossRate
+		self.collisions = collisions
+		self.airtime = airtime
+		self.random = random.Random(seed)
+		self.radios = []
+		self.busyUs = 0			# total airtime used
+		self.lost = 0
+		self.collided = 0
+		self.faded = 0			# packets below the demodulation floor of a setLink path
+		self.noiseFloor = -120
+		self._links = {}
+		self._noise = {}		# frequency: dBm
+		self._events = []
+		self._sequence = 0
+		self._active = []		# transmissions on the air
+
+	def addRadio(self, name=None, baudrate=5000000):
+		''' make a new radio on this channel, returns its EmuSpiControl '''
+		radio = EmuRadio(self, name or 'radio%d' % len(self.radios))
+		self.radios.append(radio)
+		return EmuSpiControl(radio, baudrate)
+
+	def setLink(self, a, b, snr):
+		''' the snr (dB) between radios a and b (EmuSpiControls or EmuRadios) for a 17 dBm
+			transmitter at 125kHz, both ways. It goes up and down dB for dB with the
+			transmit power and down 3dB for each doubling of the bandwidth '''
+		a = getattr(a, 'radio', a)
+		b = getattr(b, 'radio', b)
+		self._links[(a, b)] = snr
+		self._links[(b, a)] = snr
+
+	def setNoise(self, frequency, dBm):
+		''' interference on frequency (Hz), None takes it away '''
+		if dBm is None:
+			self._noise.pop(frequency, None)
+		else:
+			self._noise[frequency] = dBm
+
+	def noise(self, frequency):
+		''' the noise (dBm) on frequency, within a frequency step of it '''
+		for at, dBm in self._noise.items():
+			if abs(at - frequency) < 100:
+				return max(dBm, self.noiseFloor)
+		return self.noiseFloor
+
+	def _linkSnr(self, tx, receiver):
+		path = self._links.get((tx['radio'], receiver))
+		if path is None:
+			return None
+		bw = BANDWIDTHS[min(tx['modulation'][1], len(BANDWIDTHS) - 1)]
+		interference = self.noise(tx['modulation'][0]) - self.noiseFloor
+		return path + tx['power'] - 17 - 10 * math.log10(bw / 125000) - interference
+
+	def channelRssi(self, radio):
+		''' what the rssi register of radio says (dBm): the noise on its frequency, or
+			a packet being sent there if it's louder '''
+		frequency = radio.frequency()
+		rssi = self.noise(frequency)
+		for tx in self._active:
+			if tx['radio'] is not radio and abs(tx['modulation'][0] - frequency) < 100:
+				snr = self._linkSnr(tx, radio)
+				rssi = max(rssi, radio.rssi + tx['power'] - 17 if snr is None else self.noiseFloor + snr)
+		return rssi + self.random.random() * 2 - 1
+
+	# simulated time
+	def ticks_us(self):
+		return self.now
+
+	def ticks_ms(self):
+		return self.now // 1000
+
+	def spend(self, us):
+		''' move the clock for work done by the host (spi traffic) '''
+		self.now = self.now + us
+
+	def schedule(self, delayUs, fn, *args):
+		self._sequence = self._sequence + 1
+		heapq.heappush(self._events, (self.now + delayUs, self._sequence, fn, args))
+
+	def advance(self, us):
+		''' run the simulation for us microseconds '''
+		self.runUntil(None, us)
+
+	def runUntil(self, done, limitUs):
+		''' run events until done() is true or limitUs passes. Returns done() '''
+		end = self.now + limitUs
+		while self._events and self._events[0][0] <= end:
+			if done and done():
+				return True
+			when, seq, fn, args = heapq.heappop(self._events)
+			self.now = max(self.now, when)
+			fn(*args)
+		if done and done():
+			return True
+		self.now = max(self.now, end)
+		return done() if done else False
+
+	# the air
+	def transmit(self, radio, payload):
+		airtime = self.airtime(radio, len(payload)) if self.airtime else timeOnAirUs(radio.regs, len(payload))
+		modulation = radio.modulation()
+		tx = {'radio': radio, 'payload': payload, 'start': self.now, 'end': self.now + airtime,
+			  'preambleEnd': self.now + preambleUs(radio.regs), 'modulation': modulation,
+			  'corrupt': False, 'power': radio.txPower()}
+		for other in self._active:
+			if other['modulation'] == modulation and self.collisions:
+				other['corrupt'] = True
+				tx['corrupt'] = True
+				self.collided = self.collided + 1
+		radio.transmission = tx
+		self._active.append(tx)
+		self.busyUs = self.busyUs + airtime
+		self.schedule(airtime, self._endTransmission, tx)
+
+	def activity(self, radio, since):
+		''' was anything radio could hear being sent since the time since. Cad finds
+			chirps, so packets part way through count as well as preambles '''
+		modulation = radio.modulation()
+		for tx in self._active:
+			if tx['radio'] is not radio and tx['modulation'] == modulation and tx['end'] >= since:
+				return True
+		return False
+
+	def incoming(self, radio):
+		''' is radio in the middle of receiving a packet '''
+		if not radio.isListening():
+			return False
+		modulation = radio.modulation()
+		for tx in self._active:
+			if tx['radio'] is not radio and tx['modulation'] == modulation and radio.listenSince <= tx['preambleEnd']:
+				return True
+		return False
+
+	def abort(self, radio):
+		tx = radio.transmission
+		if tx in self._active:
+			self._active.remove(tx)
+		tx['aborted'] = True
+		radio.transmission = None
+
+	def _endTransmission(self, tx):
+		if tx.get('aborted'):
+			return
+		self._active.remove(tx)
+		tx['radio'].txDone()
+		for receiver in self.radios:
+			# it had to be listening, on the same settings, from before the preamble ended
+			if receiver is tx['radio'] or not receiver.isListening() or receiver.modulation() != tx['modulation'] \
+					or receiver.listenSince > tx['preambleEnd']:
+				continue
+			if self.lossRate and self.random.random() < self.lossRate:
+				self.lost = self.lost + 1
+				continue
+			snr = self._linkSnr(tx, receiver)
+			if snr is None:
+				receiver.deliver(tx['payload'], tx['corrupt'])
+			elif snr < SNR_FLOOR.get(tx['modulation'][2], -20.0):
+				self.faded = self.faded + 1
+			else:
+				receiver.deliver(tx['payload'], tx['corrupt'], min(snr, 10.0), receiver.rssi + tx['power'] - 17)
@@ -0,0 +1,1074 @@
+''' Regression tests for LightLora run against the emulated radio (Tools/sx127xemu.py).
+
+	python -m unittest Tools.test_emulator		# or python -m pytest Tools
+
+Every channel is seeded, and so is random (relay delays), so runs repeat.
+'''
+import asyncio
+import os
+import random
+import tempfile
+import unittest
+from LightLora import sx127x, loraqueue, lorautil, lorastats, loraasync, reliable, fragment
+from LightLora import relay, adr, codec, spicontrol, multiradio, hopping, capture
+from Tools import capturetool
+from Tools.sx127xemu import VirtualChannel, EmuSpi, EmuPin
+
+def node(channel, name=None, **kwargs):
+	return lorautil.LoraUtil(spiControl=channel.addRadio(name), ticksMs=channel.ticks_ms, **kwargs)
+
+def run(channel, nodes, seconds, stepUs=10000, done=None):
+	''' advance the channel, servicing nodes, for seconds or until done() '''
+	end = channel.now + seconds * 1000000
+	while channel.now < end and not (done and done()):
+		channel.advance(stepUs)
+		for lu in nodes:
+			lu.service()
+
+def payloads(lu):
+	got = []
+	for pkt in lu.readPackets():
+		got.append(bytes(pkt.payload))
+		pkt.release()
+	return got
+
+class SplitFifoTest(unittest.TestCase):
+	def traffic(self, split):
+		channel = VirtualChannel(seed=4)
+		rnd = random.Random(7)
+		a = node(channel, splitFifo=split)
+		b = node(channel, splitFifo=split)
+		heard = 0
+		for i in range(60):
+			b.sendPacket(0x41, 0x42, b'.' * 20)
+			if i % 3 == 0:
+				a.sendPacket(0x43, 0x41, b'a' * 100)
+			run(channel, (a, b), rnd.randint(30, 60) / 100)
+			heard = heard + len(payloads(a))
+		radio = a.spic.radio
+		radio._setMode(radio.regs[1])	# close off the time in the current mode
+		return heard, b.stats.txPackets, radio.modeUs[1]
+
+	def test_less_standby(self):
+		''' loading the next frame while receiving cuts the time out of receive '''
+		heard, sent, standby = self.traffic(False)
+		splitHeard, splitSent, splitStandby = self.traffic(True)
+		self.assertEqual((splitHeard, splitSent), (heard, sent))
+		self.assertLess(splitStandby, standby / 2)
+
+	def test_preload_survives_receive(self):
+		''' a frame loaded while receiving, then held back, is sent intact after
+			bigger frames are received over it '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel, splitFifo=True)
+		b = node(channel, splitFifo=True)
+		a.setDutyCycle(0.01, 200000)
+		a.budget.record(a.budget.budgetUs, channel.ticks_ms())
+		a.sleep()
+		frame = b'GOOD-FRAME' * 10
+		self.assertTrue(a.sendPacket(0x42, 0x41, frame))
+		for i in range(3):
+			b.sendPacket(0x41, 0x42, b'z' * 120)
+			channel.runUntil(b.isPacketSent, 5000000)
+		self.assertEqual(len(payloads(a)), 3)
+		run(channel, (a, b), 220, stepUs=1000000)
+		self.assertEqual(payloads(b), [frame])
+
+class ReliableTest(unittest.TestCase):
+	def deliver(self, loss, window, retries=3, count=30):
+		''' returns the link, the messages received and {message: acked} '''
+		channel = VirtualChannel(seed=5, lossRate=loss)
+		sent = {}
+		results = {}
+		def onResult(dst, seq, ok):
+			results[sent[seq]] = ok
+		la = reliable.ReliableLink(node(channel), 0x41, window=window, retries=retries, onResult=onResult)
+		lb = reliable.ReliableLink(node(channel), 0x42, retries=retries)
+		got = []
+		i = 0
+		while channel.now < 300000000 and (i < count or la.inFlight()):
+			seq = la.send(0x42, b'msg%d' % i) if i < count else None
+			if seq is not None:
+				sent[seq] = 'msg%d' % i
+				i = i + 1
+			channel.advance(20000)
+			la.service()
+			lb.service()
+			while lb.isPacketAvailable():
+				pkt = lb.readPacket()
+				got.append(pkt.msgTxt)
+				pkt.release()
+		return la, got, results
+
+	def test_lossless(self):
+		la, got, results = self.deliver(0, 4)
+		self.assertEqual(got, ['msg%d' % i for i in range(30)])
+		self.assertEqual((la.acked, la.retransmits), (30, 0))
+
+	def test_under_loss(self):
+		''' with 30% of frames lost and enough retries everything arrives once
+			(in any order, a window resends around gaps). A frame can still be
+			given up on after it arrived, when all its acks were lost '''
+		messages = sorted('msg%d' % i for i in range(30))
+		for window in (1, 4):
+			la, got, results = self.deliver(0.3, window, retries=6)
+			self.assertEqual(sorted(got), messages)
+			self.assertEqual(la.acked + la.failed, 30)
+			self.assertGreater(la.retransmits, 0)
+		self.assertEqual(self.deliver(0.3, 1, retries=6)[0].failed, 0)
+
+	def test_give_up(self):
+		''' with few retries some are given up on, but none is read twice and
+			every one acked was read '''
+		for window in (1, 4):
+			la, got, results = self.deliver(0.3, window)
+			self.assertEqual(len(got), len(set(got)))
+			self.assertEqual(len(results), 30)
+			for message, ok in results.items():
+				if ok:
+					self.assertIn(message, got)
+
+class FragmentTest(unittest.TestCase):
+	def transfer(self, size, loss=0.0):
+		channel = VirtualChannel(seed=3, lossRate=loss)
+		a = node(channel)
+		b = node(channel, rxDepth=8)
+		data = bytes((i * 7) & 0xff for i in range(size))
+		def pieces():
+			for i in range(0, size, 100):
+				yield data[i:i + 100]
+		whole = a.sendMessage(0x42, 0x41, data)
+		streamed = a.sendMessage(0x42, 0x41, pieces())
+		reassembler = fragment.Reassembler(maxMessages=2, maxSize=4096, ticksMs=channel.ticks_ms)
+		stream = fragment.FragmentStream(ticksMs=channel.ticks_ms)
+		messages = []
+		parts = {}
+		end = channel.now + 120000000
+		while channel.now < end and not (streamed.done and a.isPacketSent() and b.rxQueue.count == 0):
+			channel.advance(20000)
+			a.service()
+			b.service()
+			for pkt in b.readPackets():
+				message = reassembler.add(pkt)
+				if message:
+					messages.append(bytes(message[2]))
+				for source, messageId, index, piece, last in stream.add(pkt):
+					parts.setdefault(messageId, bytearray()).extend(piece)
+		self.assertTrue(whole.done and streamed.done)
+		return data, messages, [bytes(part) for part in parts.values()]
+
+	def test_sizes(self):
+		for size in (1, 247, 248, 1000, 3000):
+			data, messages, parts = self.transfer(size)
+			self.assertEqual(messages, [data, data])
+			self.assertEqual(parts, [data, data])
+
+	def test_one_slot_queue(self):
+		channel = VirtualChannel(seed=3)
+		a = node(channel, txDepth=1)
+		b = node(channel, rxDepth=8)
+		data = bytes(range(256)) * 2
+		sender = a.sendMessage(0x42, 0x41, data)
+		reassembler = fragment.Reassembler(ticksMs=channel.ticks_ms)
+		messages = []
+		def done():
+			for pkt in b.readPackets():
+				message = reassembler.add(pkt)
+				if message:
+					messages.append(bytes(message[2]))
+			return sender.done and a.isPacketSent() and messages
+		run(channel, (a, b), 30, done=done)
+		self.assertEqual(messages, [data])
+
+class RelayTest(unittest.TestCase):
+	def setUp(self):
+		random.seed(11)
+
+	def chain(self, relays, maxHops=3, count=10):
+		''' A, relays and B in a line, each only in range of its neighbours '''
+		channel = VirtualChannel(seed=3)
+		spis = [channel.addRadio(name) for name in ['A'] + ['R%d' % i for i in range(relays)] + ['B']]
+		for i in range(len(spis)):
+			for j in range(i + 1, len(spis)):
+				channel.setLink(spis[i], spis[j], 10 if j == i + 1 else -40)
+		nodes = [lorautil.LoraUtil(spiControl=spi, ticksMs=channel.ticks_ms) for spi in spis]
+		addresses = [0x01] + [0x20 + i for i in range(relays)] + [0x02]
+		relays = []
+		for lu, address in zip(nodes, addresses):
+			rl = relay.Relay(address, maxHops=maxHops if address >= 0x20 else 0)
+			lu.setRelay(rl)
+			relays.append(rl)
+		a = nodes[0]
+		b = nodes[-1]
+		got = []
+		for i in range(count):
+			a.sendPacket(0x02, 0x01, b'hello %d' % i)
+			run(channel, nodes, 3)
+			for pkt in b.readPackets():
+				got.append((bytes(pkt.payload), pkt.hops))
+				pkt.release()
+		return got, relays
+
+	def test_direct(self):
+		got, relays = self.chain(0)
+		self.assertEqual(got, [(b'hello %d' % i, 0) for i in range(10)])
+
+	def test_hops(self):
+		''' each hop adds one to the count, nothing comes twice '''
+		for hops in (1, 2):
+			got, relays = self.chain(hops)
+			self.assertEqual(got, [(b'hello %d' % i, hops) for i in range(10)])
+			for rl in relays[1:-1]:
+				self.assertEqual(rl.forwarded, 10)
+
+	def test_out_of_hops(self):
+		got, relays = self.chain(3, maxHops=2)
+		self.assertEqual(got, [])
+		self.assertEqual(relays[3].expired, 10)
+
+	def test_reliable_resends(self):
+		''' resends of a reliable frame are sent on again, echoes still aren't '''
+		channel = VirtualChannel(seed=3, lossRate=0.2)
+		spis = [channel.addRadio(name) for name in ('A', 'R', 'B')]
+		channel.setLink(spis[0], spis[1], 10)
+		channel.setLink(spis[1], spis[2], 10)
+		channel.setLink(spis[0], spis[2], -40)
+		nodes = [lorautil.LoraUtil(spiControl=spi, ticksMs=channel.ticks_ms) for spi in spis]
+		relays = [relay.Relay(address, maxHops=3 if address == 0x20 else 0) for address in (0x01, 0x20, 0x02)]
+		for lu, rl in zip(nodes, relays):
+			lu.setRelay(rl)
+		la = reliable.ReliableLink(nodes[0], 0x01, window=1, retries=6)
+		lb = reliable.ReliableLink(nodes[2], 0x02)
+		got = []
+		for i in range(15):
+			la.send(0x02, b'm%d' % i)
+			end = channel.now + 30000000
+			while channel.now < end and la.inFlight():
+				channel.advance(10000)
+				la.service()
+				lb.service()
+				nodes[1].service()
+				while lb.isPacketAvailable():
+					pkt = lb.readPacket()
+					got.append(bytes(pkt.payload))
+					pkt.release()
+		self.assertEqual((la.acked, la.failed), (15, 0))
+		self.assertEqual(got, [b'm%d' % i for i in range(15)])
+		self.assertGreater(relays[1].forwarded, 30) # each frame and ack, and resends
+
+class DutyCycleTest(unittest.TestCase):
+	def test_never_fits(self):
+		''' a frame longer than the whole budget is refused, not queued forever '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		b = node(channel)
+		a.setDutyCycle(0.01, 60000)
+		self.assertGreater(a.timeOnAir(103), a.budget.budgetUs)
+		self.assertFalse(a.sendPacket(0x42, 0x41, b'x' * 103))
+		self.assertEqual(a.stats.txRejected, 1)
+		self.assertTrue(a.sendPacket(0x42, 0x41, b'ok'))
+		channel.runUntil(a.isPacketSent, 5000000)
+		self.assertEqual(payloads(b), [b'ok'])
+
+	def test_stops_fitting(self):
+		''' queued frames that no longer fit after a settings change are dropped '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		b = node(channel)
+		a.setDutyCycle(0.01, 60000)
+		a.budget.record(a.budget.budgetUs, channel.ticks_ms())
+		self.assertTrue(a.sendPacket(0x42, 0x41, b'y' * 60))
+		self.assertTrue(a.sendPacket(0x42, 0x41, b'z'))
+		self.assertEqual(a.stats.txPackets, 0)
+		a.lora.setSpreadingFactor(12)
+		b.lora.setSpreadingFactor(12)
+		run(channel, (a, b), 70, stepUs=1000000)
+		self.assertTrue(a.isPacketSent())
+		self.assertEqual(a.stats.txPackets, 0)
+		self.assertEqual(a.stats.txRejected, 2)
+		self.assertEqual(payloads(b), [])
+
+	def test_deferred(self):
+		''' sends over the budget wait for it and all go in the end '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel, txDepth=8)
+		b = node(channel, rxDepth=8)
+		a.setDutyCycle(0.01, 60000)
+		for i in range(6):
+			self.assertTrue(a.sendPacket(0x42, 0x41, b'frame %d' % i + b'.' * 30))
+		run(channel, (a, b), 1)
+		early = len(payloads(b))
+		self.assertLess(early, 6)
+		self.assertGreater(a.stats.txDeferred, 0)
+		got = []
+		def done():
+			got.extend(payloads(b))
+			return len(got) + early == 6
+		run(channel, (a, b), 300, stepUs=100000, done=done)
+		self.assertEqual(len(got) + early, 6)
+		self.assertLessEqual(a.budget.used(channel.ticks_ms()), a.budget.budgetUs)
+
+	def test_waits_quietly(self):
+		''' a deferred send sleeps until the budget frees up rather than checking
+			the radio on every service() '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		b = node(channel)
+		a.setDutyCycle(0.01, 60000)
+		a.budget.record(a.budget.budgetUs, channel.ticks_ms())
+		self.assertTrue(a.sendPacket(0x42, 0x41, b'later'))
+		self.assertEqual(a.stats.txDeferred, 1)
+		wait = a.budget.waitMs(a.timeOnAir(5), channel.ticks_ms())
+		self.assertGreater(wait, 50000)
+		a.spic.resetCounters()
+		run(channel, (a, b), (wait - 1000) / 1000, stepUs=100000)
+		self.assertEqual(a.spic.transactions, 0)
+		self.assertEqual(a.stats.txDeferred, 1)
+		self.assertEqual(payloads(b), [])
+		run(channel, (a, b), 2, stepUs=100000, done=a.isPacketSent)
+		self.assertEqual(payloads(b), [b'later'])
+
+class ShadowTest(unittest.TestCase):
+	def test_skips_unchanged(self):
+		''' setting what's already set costs no spi traffic, changes still go out '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		lora = a.lora
+		spi = a.spic
+		spi.resetCounters()
+		lora.setSpreadingFactor(lora.spreading)
+		lora.setCodingRate(lora.codingRate)
+		lora.setTxPower(lora.txPower, lora.txPowerPin)
+		lora.readRegister(sx127x.REG_MODEM_CONFIG_1)
+		self.assertEqual(spi.transactions, 0)
+		lora.setSpreadingFactor(10)
+		self.assertGreater(spi.transactions, 0)
+		self.assertEqual(spi.radio.regs[sx127x.REG_MODEM_CONFIG_2] >> 4, 10)
+
+	def test_matches_chip(self):
+		''' after reconfiguring and sending, the shadow holds what the chip does '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		b = node(channel)
+		for sf in (7, 12, 9):
+			for lu in (a, b):
+				lu.lora.setSpreadingFactor(sf)
+			a.lora.setTxPower(sf + 5)
+			a.sendPacket(0x42, 0x41, b'sf%d' % sf)
+			channel.runUntil(a.isPacketSent, 10000000)
+			self.assertEqual(payloads(b), [b'sf%d' % sf])
+		regs = a.spic.radio.regs
+		for register, value in a.lora._shadow.items():
+			self.assertEqual(regs[register], value, hex(register))
+
+	def test_resync(self):
+		''' a chip reset behind the driver's back is picked up by resyncRegisters '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		radio = a.spic.radio
+		radio.regs[sx127x.REG_MODEM_CONFIG_1] = 0x72
+		self.assertNotEqual(a.lora.readRegister(sx127x.REG_MODEM_CONFIG_1), 0x72)
+		a.lora.resyncRegisters()
+		self.assertEqual(a.lora.readRegister(sx127x.REG_MODEM_CONFIG_1), 0x72)
+
+class RingTest(unittest.TestCase):
+	def burst(self, policy):
+		''' five frames into a receive queue of two, nothing read meanwhile '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel, txDepth=5)
+		b = node(channel, rxDepth=2, rxPolicy=policy)
+		for i in range(5):
+			self.assertTrue(a.sendPacket(0x42, 0x41, b'frame %d' % i))
+		channel.runUntil(a.isPacketSent, 10000000)
+		self.assertEqual(b.rxOverflows(), 3)
+		self.assertEqual(b.stats.rxOverflows, 3)
+		return payloads(b)
+
+	def test_drop_oldest(self):
+		self.assertEqual(self.burst(loraqueue.DROP_OLDEST), [b'frame 3', b'frame 4'])
+
+	def test_drop_newest(self):
+		self.assertEqual(self.burst(loraqueue.DROP_NEWEST), [b'frame 0', b'frame 1'])
+
+	def test_reading_slot_kept(self):
+		''' the slot being read isn't dropped to make room '''
+		ring = loraqueue.FrameRing(2)
+		for i in range(2):
+			slot = ring.reserve()
+			ring.frames[slot][0] = i
+			ring.commit(slot, 1)
+		ring.reading = ring.peek()
+		self.assertEqual(ring.reserve(), -1)
+		self.assertEqual(ring.frames[ring.peek()][0], 0)
+		ring.pop()
+		slot = ring.reserve()
+		self.assertGreaterEqual(slot, 0)
+		ring.commit(slot, 1)
+		self.assertEqual(ring.count, 2)
+
+class DeferredReceiveTest(unittest.TestCase):
+	def setUp(self):
+		self.scheduled = []
+		self.schedule = lorautil.schedule
+		lorautil.schedule = lambda fn, arg: self.scheduled.append((fn, arg)) # like micropython.schedule
+
+	def tearDown(self):
+		lorautil.schedule = self.schedule
+
+	def test_interrupt_only_queues(self):
+		''' the receive interrupt leaves links, adr, capture and the relay to the
+			scheduled stage '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		b = node(channel)
+		b.setAdaptive(adr.LinkAdapter(b.lora))
+		b.setRelay(relay.Relay(0x42))
+		a.sendPacket(0x42, 0x41, b'mine')
+		a.sendPacket(0x43, 0x41, b'for 0x43')
+		channel.runUntil(a.isPacketSent, 5000000)
+		self.assertEqual(b.rxQueue.count, 2)
+		self.assertEqual(len(self.scheduled), 1)
+		self.assertEqual((b.links.used, b.adapter.used, b.relay.pending.count), (0, 0, 0))
+		for fn, arg in self.scheduled:
+			fn(arg)
+		self.assertEqual((b.links.used, b.adapter.used, b.relay.pending.count), (1, 1, 1))
+		self.assertEqual(payloads(b), [b'mine'])
+		self.assertEqual(b.rxQueue.count, 0)
+
+	def test_read_before_scheduled(self):
+		''' reading before the scheduled stage ran does its work first '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		b = node(channel)
+		b.setRelay(relay.Relay(0x42))
+		a.sendPacket(0x43, 0x41, b'for 0x43')
+		a.sendPacket(0x42, 0x41, b'mine')
+		channel.runUntil(a.isPacketSent, 5000000)
+		self.assertTrue(b.isPacketAvailable())
+		self.assertEqual(payloads(b), [b'mine'])
+		self.assertEqual(b.relay.pending.count, 1)
+		self.assertFalse(b.isPacketAvailable())
+
+class SendErrorTest(unittest.TestCase):
+	def test_counted_and_reported(self):
+		''' a send that fails to load is dropped, counted and passed to the hook '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		b = node(channel)
+		events = []
+		a.onEvent(lambda sx12, event, value: events.append((event, value)))
+		endPacket = a.lora.endPacket
+		def failOnce():
+			a.lora.endPacket = endPacket
+			raise OSError(5)
+		a.lora.endPacket = failOnce
+		a.sendPacket(0xff, 0x41, b'lost')
+		a.sendPacket(0xff, 0x41, b'sent')
+		run(channel, [a, b], 5, done=a.isPacketSent)
+		self.assertEqual(a.stats.txErrors, 1)
+		self.assertEqual(len(events), 1)
+		self.assertEqual(events[0][0], lorastats.EVENT_TX_ERROR)
+		self.assertIsInstance(events[0][1], OSError)
+		self.assertEqual(payloads(b), [b'sent'])
+
+class PoolTest(unittest.TestCase):
+	def exchange(self, release, count=12):
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		b = node(channel)
+		seen = []
+		for i in range(count):
+			a.sendPacket(0xff, 0x41, b'n%d' % i)
+			run(channel, [a, b], 1, done=a.isPacketSent)
+			pkt = b.readPacket()
+			self.assertEqual(bytes(pkt.payload), b'n%d' % i)
+			if pkt not in seen:
+				seen.append(pkt)
+			if release:
+				pkt.release()
+		return b.pool, seen
+
+	def test_released_packets_reused(self):
+		pool, seen = self.exchange(True)
+		self.assertEqual(pool.created, pool.size)
+		self.assertEqual(len(seen), 1)
+
+	def test_unreleased_packets_created(self):
+		''' running dry still works, it just allocates '''
+		pool, seen = self.exchange(False)
+		self.assertEqual(pool.created, 12) # the pool's own, then one per packet
+		self.assertEqual(len(seen), 12)
+
+	def test_double_release(self):
+		pool = lorautil.PacketPool(2)
+		pkt = pool.acquire()
+		pkt.release()
+		pkt.release()
+		self.assertEqual(len(pool.free), 2)
+		self.assertIsNot(pool.acquire(), pool.acquire())
+
+class AsyncTest(unittest.TestCase):
+	def play(self, channel, coro):
+		''' run coro while a task moves simulated time along '''
+		async def drive():
+			while True:
+				channel.advance(10000)
+				await asyncio.sleep(0)
+		async def main():
+			driver = asyncio.create_task(drive())
+			try:
+				return await asyncio.wait_for(coro, 10)
+			finally:
+				driver.cancel()
+		return asyncio.run(main())
+
+	def pair(self, channel, **kwargs):
+		a = loraasync.AsyncLora(node(channel, **kwargs), 0x41, serviceMs=0)
+		b = loraasync.AsyncLora(node(channel), 0x42, serviceMs=0)
+		return a, b
+
+	def test_send_recv(self):
+		channel = VirtualChannel(seed=1)
+		a, b = self.pair(channel)
+		async def talk():
+			receiving = asyncio.create_task(b.recv())
+			sent = await a.send(0x42, b'hello')
+			pkt = await receiving
+			a.stop()
+			b.stop()
+			return sent, pkt.srcAddress, bytes(pkt.payload)
+		self.assertEqual(self.play(channel, talk()), (True, 0x41, b'hello'))
+
+	def test_send_waits_for_room(self):
+		''' with a one frame send queue the sends take turns '''
+		channel = VirtualChannel(seed=1)
+		a, b = self.pair(channel, txDepth=1)
+		async def talk():
+			sent = await asyncio.gather(*[a.send(0x42, b'm%d' % i) for i in range(3)])
+			got = []
+			while len(got) < 3:
+				pkt = await b.recv()
+				got.append(bytes(pkt.payload))
+				pkt.release()
+			a.stop()
+			b.stop()
+			return sent, sorted(got)
+		self.assertEqual(self.play(channel, talk()), ([True] * 3, [b'm0', b'm1', b'm2']))
+
+	def test_over_budget(self):
+		''' a send refused by the duty cycle limit returns False, not hang '''
+		channel = VirtualChannel(seed=1)
+		a, b = self.pair(channel)
+		a.lu.setDutyCycle(0.01, 60000, reject=True)
+		a.lu.budget.record(a.lu.budget.budgetUs, channel.ticks_ms())
+		async def talk():
+			sent = await a.send(0x42, b'no room')
+			a.stop()
+			b.stop()
+			return sent
+		self.assertFalse(self.play(channel, talk()))
+
+class AggregationTest(unittest.TestCase):
+	def setUp(self):
+		self.channel = VirtualChannel(seed=1)
+		self.a = node(self.channel)
+		self.b = node(self.channel, rxDepth=8)
+		self.a.setAggregation(500, maxFrameSize=64)
+
+	def received(self):
+		got = []
+		for pkt in self.b.readPackets():
+			got.append((pkt.dstAddress, pkt.srcAddress, pkt.srcLineCount, bytes(pkt.payload)))
+			pkt.release()
+		return got
+
+	def test_shared_frame(self):
+		''' small messages to one destination go in one frame and arrive one by one '''
+		a = self.a
+		for i in range(4):
+			self.assertTrue(a.sendPacket(0x42, 0x41, b'm%d' % i, lineCount=i))
+		self.assertEqual(a.stats.txPackets, 0) # waiting for more
+		run(self.channel, (a, self.b), 5, done=a.isPacketSent)
+		self.assertEqual(a.stats.txPackets, 1)
+		self.assertEqual(a.txFinished, 4)
+		self.assertEqual(self.received(), [(0x42, 0x41, i, b'm%d' % i) for i in range(4)])
+
+	def test_latency(self):
+		''' a lone message waits maxLatencyMs then goes as a normal packet '''
+		a = self.a
+		a.sendPacket(0x42, 0x41, b'alone', lineCount=7)
+		run(self.channel, (a, self.b), 0.4)
+		self.assertEqual(a.stats.txPackets, 0)
+		run(self.channel, (a, self.b), 0.5)
+		self.assertEqual(a.stats.txPackets, 1)
+		self.assertEqual(a.stats.txBytes, 4 + 5)
+		self.assertEqual(self.received(), [(0x42, 0x41, 7, b'alone')])
+
+	def test_destinations(self):
+		''' each destination gets its own frame '''
+		a = self.a
+		for i in range(4):
+			a.sendPacket(0x42 + i % 2, 0x41, b'd%d' % i)
+		run(self.channel, (a, self.b), 5, done=a.isPacketSent)
+		self.assertEqual(a.stats.txPackets, 2)
+		self.assertEqual(self.received(), [(0x42, 0x41, 1, b'd0'), (0x42, 0x41, 3, b'd2'),
+			(0x43, 0x41, 2, b'd1'), (0x43, 0x41, 4, b'd3')])
+
+	def test_order(self):
+		''' a message too big to share goes after the ones held for its destination,
+			and a full frame goes without waiting '''
+		a = self.a
+		a.sendPacket(0x42, 0x41, b'small')
+		a.sendPacket(0x42, 0x41, b'x' * 70)
+		a.sendPacket(0x42, 0x41, b'y' * 28)
+		a.sendPacket(0x42, 0x41, b'z' * 28)	# fills the 64 byte frame
+		self.assertEqual(a.txQueue.count + a.stats.txPackets, 3)
+		run(self.channel, (a, self.b), 5, done=a.isPacketSent)
+		self.assertEqual([p for d, s, c, p in self.received()],
+			[b'small', b'x' * 70, b'y' * 28, b'z' * 28])
+
+class CodecTest(unittest.TestCase):
+	def setUp(self):
+		self.sender = codec.RecordCodec((100, 1), keyEvery=4)
+		self.out = bytearray(self.sender.maxLength)
+
+	def send(self, values, dst):
+		return bytes(self.out[:self.sender.encode(values, self.out, dst)])
+
+	def test_destinations(self):
+		''' records alternating between two destinations decode at each of them
+			and at a node hearing both '''
+		rx = {0x42: codec.RecordCodec((100, 1)), 0x43: codec.RecordCodec((100, 1))}
+		everyone = codec.RecordCodec((100, 1))
+		for i in range(12):
+			dst = 0x42 + i % 2
+			values = [20 + i * 0.25, 1000 + i]
+			payload = self.send(values, dst)
+			out = [0, 0]
+			self.assertTrue(rx[dst].decode(0x41, payload, out, dst))
+			self.assertEqual(out, values)
+			out = [0, 0]
+			self.assertTrue(everyone.decode(0x41, payload, out, dst))
+			self.assertEqual(out, values)
+		self.assertEqual(rx[0x42].outOfSync + rx[0x43].outOfSync + everyone.outOfSync, 0)
+
+	def test_duplicates(self):
+		''' a resent record is ignored and the ones after it still decode '''
+		rx = codec.RecordCodec((100, 1))
+		out = [0, 0]
+		for i in range(6):
+			payload = self.send([i, i], 0x42)
+			self.assertTrue(rx.decode(0x41, payload, out, 0x42))
+			self.assertFalse(rx.decode(0x41, payload, out, 0x42))
+			self.assertEqual(out, [i, i])
+		self.assertEqual((rx.duplicates, rx.outOfSync), (6, 0))
+
+	def test_restart(self):
+		''' a record that wasn't sent makes the next one to that destination whole '''
+		rx = codec.RecordCodec((100, 1))
+		out = [0, 0]
+		self.assertTrue(rx.decode(0x41, self.send([1, 1], 0x42), out, 0x42))
+		self.send([2, 2], 0x42) # lost
+		self.sender.restart(0x42)
+		payload = self.send([3, 3], 0x42)
+		self.assertEqual(payload[0], codec.KIND_RECORD)
+		self.assertTrue(rx.decode(0x41, payload, out, 0x42))
+		self.assertEqual(out, [3, 3])
+
+	def test_over_the_air(self):
+		''' sendRecord and readRecord to two destinations with a node hearing both '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		b = node(channel)
+		c = node(channel)
+		for lu in (a, b, c):
+			lu.setCodec(codec.RecordCodec((10, 1)))
+		c.setAddressFilter(0x43)
+		got = {b: [], c: []}
+		for i in range(10):
+			self.assertTrue(a.sendRecord(0x42 + i % 2, 0x41, (i * 1.5, i)))
+			run(channel, (a, b, c), 2, done=a.isPacketSent)
+			for lu in (b, c):
+				for pkt in lu.readPackets():
+					values = lu.readRecord(pkt)
+					if values:
+						got[lu].append((pkt.dstAddress, list(values)))
+					pkt.release()
+		self.assertEqual(got[b], [(0x42 + i % 2, [i * 1.5, i]) for i in range(10)])
+		self.assertEqual(got[c], [(0x43, [i * 1.5, i]) for i in range(1, 10, 2)])
+
+class AdaptiveTest(unittest.TestCase):
+	def setUp(self):
+		self.channel = VirtualChannel(seed=1)
+		self.a = node(self.channel)
+		self.b = node(self.channel)
+		for lu in (self.a, self.b):
+			lu.lora.setTxPower(17)
+		self.channel.setLink(self.a.spic, self.b.spic, 8)
+		self.a.setAdaptive(adr.LinkAdapter(self.a.lora))
+		self.la = reliable.ReliableLink(self.a, 0x41)
+		self.lb = reliable.ReliableLink(self.b, 0x42)
+		for i in range(3):
+			self.b.sendPacket(0x41, 0x42, b'hi')
+			self.serve(1)
+
+	def serve(self, seconds, done=None):
+		end = self.channel.now + seconds * 1000000
+		while self.channel.now < end and not (done and done()):
+			self.channel.advance(10000)
+			self.la.service()
+			self.lb.service()
+
+	def test_strong_link(self):
+		''' a good snr lowers the power and coding rate used to send to the peer '''
+		profile = self.a.adapter.profileFor(0x42)
+		self.assertLess(profile.power, 17)
+		self.assertEqual(profile.codingRate, 5)
+		self.la.send(0x42, b'quiet')
+		self.serve(5, done=lambda: self.la.inFlight() == 0)
+		self.assertEqual(self.la.acked, 1)
+		self.assertEqual(self.la.retransmits, 0)
+
+	def test_loss_raises_power(self):
+		''' when the link fades the unacked frame is resent at full power '''
+		self.assertLess(self.a.adapter.profileFor(0x42).power, 17)
+		self.channel.setLink(self.a.spic, self.b.spic, -5) # only full power gets through
+		self.la.send(0x42, b'data')
+		self.serve(10, done=lambda: self.la.inFlight() == 0)
+		self.assertEqual((self.la.acked, self.la.failed), (1, 0))
+		self.assertGreater(self.la.retransmits, 0)
+		self.assertEqual(self.a.adapter.profileFor(0x42).power, 17)
+		pkt = self.lb.readPacket()
+		self.assertEqual(bytes(pkt.payload), b'data')
+
+class ChannelActivityTest(unittest.TestCase):
+	def test_quiet(self):
+		''' listen before talk on a quiet channel checks once and sends '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		b = node(channel)
+		a.setListenBeforeTalk(100)
+		a.sendPacket(0x42, 0x41, b'clear')
+		run(channel, (a, b), 2, done=a.isPacketSent)
+		self.assertEqual((a.stats.cadChecks, a.stats.cadDetected, a.stats.lbtBackoffs), (1, 0, 0))
+		self.assertEqual(payloads(b), [b'clear'])
+
+	def test_busy(self):
+		''' a send that finds the channel in use waits for it instead of colliding '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		b = node(channel)
+		c = node(channel)
+		a.setListenBeforeTalk(50)
+		c.sendPacket(0x42, 0x43, b'long' * 20)
+		channel.advance(20000) # c is on the air
+		a.sendPacket(0x42, 0x41, b'polite')
+		run(channel, (a, b, c), 5, done=lambda: a.isPacketSent() and c.isPacketSent())
+		self.assertGreater(a.stats.lbtBackoffs, 0)
+		self.assertEqual(a.stats.cadDetected, a.stats.lbtBackoffs)
+		self.assertEqual(channel.collided, 0)
+		self.assertEqual(payloads(b), [b'long' * 20, b'polite'])
+
+	def test_low_power_receive(self):
+		''' a sniffing receiver sleeps between checks and still catches a frame
+			with a long enough preamble '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		b = node(channel)
+		b.setLowPowerReceive(200, listenMs=1000)
+		a.setWakePreamble(200 + 10)
+		run(channel, (a, b), 3, stepUs=5000)
+		a.sendPacket(0x42, 0x41, b'wake up')
+		run(channel, (a, b), 3, stepUs=5000)
+		self.assertEqual(payloads(b), [b'wake up'])
+		modeUs = b.spic.radio.modeUs
+		self.assertGreater(modeUs[sx127x.MODE_SLEEP], 2 * modeUs[sx127x.MODE_RX_CONTINUOUS])
+		self.assertGreater(b.stats.cadChecks, 20)
+
+class InterruptingSpi(EmuSpi):
+	''' raises a DIO0 interrupt (by calling interrupt()) in the middle of the next
+		register read or write '''
+	interrupt = None
+
+	def write_readinto(self, outBuffer, inBuffer):
+		interrupt = self.interrupt
+		if interrupt:
+			self.interrupt = None
+			interrupt()
+		EmuSpi.write_readinto(self, outBuffer, inBuffer)
+
+class SharedBusTest(unittest.TestCase):
+	def setUp(self):
+		self.channel = VirtualChannel(seed=1)
+		self.spi = InterruptingSpi()
+		self.bus = spicontrol.SpiBus(spi=self.spi)
+
+	def radio(self, **kwargs):
+		radio = self.channel.addRadio().radio
+		spic = spicontrol.SpiControl(self.bus, cs=self.spi.select(radio), reset=EmuPin(), dio0=radio.dio0)
+		lu = lorautil.LoraUtil(spiControl=spic, ticksMs=self.channel.ticks_ms, **kwargs)
+		lu.radio = radio
+		return lu
+
+	def test_guarded_read(self):
+		''' a DIO0 interrupt during a read is held until the read is done, and the
+			handler's own transfers don't change what the read returns '''
+		a = self.radio()
+		a.radio.regs[sx127x.REG_SYNC_WORD] = 0xaa
+		frame = b'\x41\x42\x01\x05hello'
+		self.spi.interrupt = lambda: a.radio.deliver(frame, False)
+		self.assertEqual(a.spic.transfer(sx127x.REG_SYNC_WORD)[0], 0xaa)
+		self.assertIsNone(self.spi.interrupt)
+		self.assertFalse(self.bus.held)
+		self.assertEqual(payloads(a), [b'hello'])
+
+	def test_guarded_write(self):
+		''' a write interrupted the same way still lands '''
+		a = self.radio()
+		self.spi.interrupt = lambda: a.radio.deliver(b'\x41\x42\x01\x02hi', False)
+		a.lora.setSyncWord(0x34)
+		self.assertEqual(a.radio.regs[sx127x.REG_SYNC_WORD], 0x34)
+		self.assertEqual(payloads(a), [b'hi'])
+
+	def test_radio_group(self):
+		''' two radios on one bus, on different channels, used as one '''
+		r0 = self.radio()
+		r1 = self.radio()
+		r1.setFrequency(916e6)
+		group = multiradio.RadioGroup([r0, r1])
+		c = node(self.channel)
+		d = node(self.channel)
+		d.setFrequency(916e6)
+		c.sendPacket(0x01, 0x0c, b'from c')
+		run(self.channel, (c, d, r0, r1), 2, done=c.isPacketSent)
+		d.sendPacket(0x01, 0x0d, b'from d')
+		run(self.channel, (c, d, r0, r1), 2, done=d.isPacketSent)
+		got = []
+		while group.isPacketAvailable():
+			pkt = group.readPacket()
+			got.append((group.lastRadio, bytes(pkt.payload)))
+			pkt.release()
+		self.assertEqual(sorted(got), [(0, b'from c'), (1, b'from d')])
+		# replies go out on the radio that heard the peer
+		self.assertTrue(group.sendPacket(0x0d, 0x01, b'to d'))
+		self.assertTrue(group.sendPacket(0x0c, 0x01, b'to c'))
+		run(self.channel, (c, d, r0, r1), 2, done=lambda: r0.isPacketSent() and r1.isPacketSent())
+		self.assertEqual(payloads(c), [b'to c'])
+		self.assertEqual(payloads(d), [b'to d'])
+
+class HoppingTest(unittest.TestCase):
+	def setUp(self):
+		self.channel = VirtualChannel(seed=1)
+		self.plan = hopping.ChannelPlan(key=0x5a)
+		self.plan.useChannels((3, 7, 11))
+		for address, home in ((0x41, 3), (0x42, 7), (0x43, 11)):
+			self.plan.assign(address, home)
+		self.nodes = {}
+		for address in (0x41, 0x42, 0x43):
+			lu = node(self.channel)
+			lu.setHopping(self.plan, address)
+			self.nodes[address] = lu
+
+	def serve(self, sender):
+		run(self.channel, self.nodes.values(), 5, done=sender.isPacketSent)
+
+	def test_unicast(self):
+		''' a frame goes out on its destination's home channel and only it hears it '''
+		a = self.nodes[0x41]
+		a.sendPacket(0x43, 0x41, b'to 0x43')
+		self.serve(a)
+		self.assertEqual(a.stats.txPackets, 1)
+		self.assertEqual(payloads(self.nodes[0x43]), [b'to 0x43'])
+		self.assertEqual(payloads(self.nodes[0x42]), [])
+		self.assertEqual(a.lora._frequency, self.plan.frequencies[3]) # back home
+
+	def test_broadcast(self):
+		''' a broadcast is sent on every home channel, so every node hears it once '''
+		self.assertEqual(list(self.plan.channels), [3, 7, 11])
+		a = self.nodes[0x41]
+		a.sendPacket(0xff, 0x41, b'all')
+		a.sendPacket(0x42, 0x41, b'after')
+		self.serve(a)
+		self.assertEqual(a.stats.txPackets, 4)
+		self.assertEqual(a.txFinished, 2)
+		self.assertEqual(payloads(self.nodes[0x42]), [b'all', b'after'])
+		self.assertEqual(payloads(self.nodes[0x43]), [b'all'])
+
+	def test_relayed_broadcast(self):
+		''' a relay hears a broadcast on its channel and sends it on to all of them '''
+		d = node(self.channel)
+		d.setHopping(self.plan, 0x44)
+		self.channel.setLink(d.spic, self.nodes[0x42].spic, 10)
+		self.channel.setLink(self.nodes[0x42].spic, self.nodes[0x43].spic, 10)
+		self.channel.setLink(d.spic, self.nodes[0x43].spic, -40) # out of reach
+		self.nodes[0x42].setRelay(relay.Relay(0x42))
+		d.sendPacket(0xff, 0x44, b'pass it on')
+		run(self.channel, list(self.nodes.values()) + [d], 10)
+		self.assertEqual(payloads(self.nodes[0x42]), [b'pass it on'])
+		self.assertEqual(payloads(self.nodes[0x43]), [b'pass it on'])
+
+class AddressFilterTest(unittest.TestCase):
+	def setUp(self):
+		self.channel = VirtualChannel(seed=1)
+		self.a = node(self.channel)
+		self.b = node(self.channel, rxDepth=8)
+
+	def send(self, *destinations):
+		for dst in destinations:
+			self.a.sendPacket(dst, 0x41, b'to %02x' % dst + b'.' * 40)
+			run(self.channel, (self.a, self.b), 2, done=self.a.isPacketSent)
+		return [p[3:5] for p in payloads(self.b)]
+
+	def test_filter(self):
+		''' ours, broadcasts and groups are kept, the rest dropped unread '''
+		self.b.setAddressFilter(0x42, groups=(0xe0,))
+		self.assertEqual(self.send(0x42, 0x43, 0xff, 0xe0, 0xe1), [b'42', b'ff', b'e0'])
+		stats = self.b.stats
+		self.assertEqual((stats.rxPackets, stats.rxFiltered), (3, 2))
+		self.assertEqual(stats.rxFilteredBytes, 2 * (4 + 45))
+
+	def test_spi_saved(self):
+		''' a filtered packet costs only its header on the bus '''
+		self.b.setAddressFilter(0x42)
+		spic = self.b.spic
+		self.send(0x42)
+		spic.resetCounters()
+		self.send(0x42)
+		kept = spic.busBytes
+		spic.resetCounters()
+		self.send(0x43)
+		self.assertLess(spic.busBytes, kept - 40)
+
+	def test_off(self):
+		self.b.setAddressFilter(0x42)
+		self.b.setAddressFilter(None)
+		self.assertEqual(self.send(0x42, 0x43), [b'42', b'43'])
+		self.assertEqual(self.b.stats.rxFiltered, 0)
+
+class WarmStartTest(unittest.TestCase):
+	def setUp(self):
+		self.channel = VirtualChannel(seed=1)
+		self.a = node(self.channel)
+		self.b = node(self.channel)
+
+	def restart(self, spic):
+		''' like waking from a deep sleep, a new driver on the same radio '''
+		spic.resetCounters()
+		return lorautil.LoraUtil(spiControl=spic, ticksMs=self.channel.ticks_ms, warmStart=True)
+
+	def test_image(self):
+		''' the configuration goes out in a few bursts and the chip ends up holding it '''
+		image = self.a.lora.compileImage()
+		self.assertLess(len(image.runs), 8)
+		regs = self.a.spic.radio.regs
+		for register, values in image.runs:
+			for i in range(len(values)):
+				if image.used[register + i]:
+					self.assertEqual(regs[register + i], values[i], hex(register + i))
+		self.assertTrue(image.matches(self.a.spic))
+
+	def test_warm(self):
+		''' a radio that kept its configuration is only read, and works straight away '''
+		self.a.lora.sleep()
+		a = self.restart(self.a.spic)
+		self.assertTrue(a.warm)
+		self.assertLess(a.spic.transactions, 6)
+		a.sendPacket(0x42, 0x41, b'awake')
+		run(self.channel, (a, self.b), 2, done=a.isPacketSent)
+		self.assertEqual(payloads(self.b), [b'awake'])
+
+	def test_cold(self):
+		''' a radio that lost its configuration is reset and configured '''
+		spic = self.a.spic
+		spic.radio.reset()
+		a = self.restart(spic)
+		self.assertFalse(a.warm)
+		self.assertTrue(a.lora.compileImage().matches(spic))
+		a.sendPacket(0x42, 0x41, b'cold')
+		run(self.channel, (a, self.b), 2, done=a.isPacketSent)
+		self.assertEqual(payloads(self.b), [b'cold'])
+
+	def test_changed(self):
+		''' a setting that differs from the configuration means it isn't warm '''
+		self.a.lora.setSpreadingFactor(7)
+		self.assertFalse(self.restart(self.a.spic).warm)
+		self.assertEqual(self.a.spic.radio.regs[sx127x.REG_MODEM_CONFIG_2] >> 4, 9)
+
+class CaptureTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.directory.name, 'lora.cap')
+
+	def tearDown(self):
+		self.directory.cleanup()
+
+	def test_round_trip(self):
+		''' frames sent and received come back out of the file with their settings '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		b = node(channel)
+		cap = capture.Capture(self.path, ticksMs=channel.ticks_ms)
+		b.setCapture(cap)
+		a.sendPacket(0x42, 0x41, b'one')
+		run(channel, (a, b), 2, done=a.isPacketSent)
+		b.sendPacket(0x41, 0x42, b'two')
+		run(channel, (a, b), 2, done=b.isPacketSent)
+		cap.close()
+		records = list(capturetool.records(self.path))
+		self.assertEqual([(r.tx, bytes(r.frame[4:])) for r in records], [(False, b'one'), (True, b'two')])
+		self.assertTrue(records[0].start)
+		self.assertAlmostEqual(records[0].frequency, b.lora._frequency, delta=sx127x.FSTEP)
+		self.assertEqual((records[1].spreading, records[1].bandwidth), (9, 125000))
+		self.assertGreater(records[1].timeMs, records[0].timeMs)
+
+	def test_unknown_frequency(self):
+		''' a frame captured while the driver doesn't know the frequency says so,
+			rather than repeating the one before '''
+		channel = VirtualChannel(seed=1)
+		a = node(channel)
+		cap = capture.Capture(self.path, ticksMs=channel.ticks_ms)
+		a.setCapture(cap)
+		a.sendPacket(0xff, 0x41, b'known')
+		run(channel, (a,), 2, done=a.isPacketSent)
+		a.lora.invalidateRegisters()
+		cap.add(capture.TX, b'\xff\x41\x02\x05later', 9, 0, 0, a.lora)
+		cap.close()
+		records = list(capturetool.records(self.path))
+		self.assertGreater(records[0].frequency, 0)
+		self.assertEqual(records[1].frequency, 0)
+		self.assertIn('unknown sf9 bw125000', capturetool.summarize(self.path)['settings'])
+
+class ScanTest(unittest.TestCase):
+	def setUp(self):
+		self.channel = VirtualChannel(seed=1)
+		self.a = node(self.channel)
+		self.b = node(self.channel)
+		self.channel.setNoise(915.2e6, -80)
+
+	def test_scan(self):
+		''' the noisy channel stands out and the radio listens again afterwards '''
+		survey = self.a.scanChannels([915e6, 915.2e6, 915.4e6])
+		self.assertIsInstance(survey, list)
+		self.assertEqual(len(survey), 3)
+		self.assertGreater(survey[1]['rssiMean'], survey[0]['rssiMean'] + 20)
+		self.assertLessEqual(survey[1]['rssiMin'], survey[1]['rssiMax'])
+		self.assertEqual(self.a.rankChannels([915.2e6, 915e6])[-1], 0)
+		self.b.sendPacket(0x41, 0x42, b'still here')
+		run(self.channel, (self.a, self.b), 2, done=self.b.isPacketSent)
+		self.assertEqual(payloads(self.a), [b'still here'])
+
+	def test_plan(self):
+		''' without frequencies it scans the hopping plan '''
+		plan = hopping.ChannelPlan(firstHz=914.6e6, count=5)
+		self.a.setHopping(plan, 0x41)
+		self.assertEqual(self.a.rankChannels()[-1], 3)
+		self.assertEqual(len(self.a.scanChannels()), 5)
+
+	def test_nothing_to_scan(self):
+		with self.assertRaises(ValueError):
+			self.a.scanChannels()
+		with self.assertRaises(ValueError):
+			self.a.rankChannels()
+
+if __name__ == '__main__':
+	unittest.main()